@@ -4,8 +4,8 @@ desaster package initiation file.
 
 @author: Scott Miles (milessb@uw.edu)
 """
-from desaster import entities, structures, hazus, financial, technical, policies, io
-from desaster.io import importEntities, importSingleFamilyResidenceStock, output_summary
+from desaster import entities, structures, hazus, financial, technical, policies, io, cohort, sampling, branching, checkpoint, pipeline, service, environment, sharding, distributed, server, sharedmemory, streaming, status, sketches, store, aggregation, streams, sequential, selection, sensitivity
+from desaster.io import importEntities, importSingleFamilyResidenceStock, output_summary, validateEntities
 from desaster.hazus import setStructuralDamageValueHAZUS, setContentsDamageValueHAZUS
 from desaster.entities import Entity, Owner, Household, OwnerHousehold, RenterHousehold, Landlord
 from desaster.technical import TechnicalRecoveryProgram, RepairProgram, InspectionProgram, DemolitionProgram
@@ -13,6 +13,28 @@ from desaster.technical import EngineeringAssessment, PermitProgram
 from desaster.financial import FinancialRecoveryProgram, HousingAssistanceFEMA, OwnersInsurance, RealPropertyLoanSBA
 from desaster.structures import Building, SingleFamilyResidential
 from desaster.policies import RepairVacantBuilding, Insurance_IA_SBA_Sequential, Insurance_SBA_Sequential
+from desaster.cohort import CohortModel
+from desaster.sampling import stratifiedSample, scalePrograms, importSample, estimateTotals
+from desaster.branching import applyChanges, runBranches
+from desaster.checkpoint import Task, ProgramTask, saveCheckpoint, loadCheckpoint, runWithCheckpoints, hashInputs, loadScenario
+from desaster.pipeline import Pipeline, PipelineEngine, ownerPipeline, landlordPipeline, renterPipeline
+from desaster.service import BatchedService
+from desaster.environment import Environment, HeapQueue, BucketQueue, CalendarQueue
+from desaster.sharding import partitionRegions, runShards
+from desaster.distributed import Coordinator, BatchRunner, sharedKey, runWorker, startLocalWorkers, stopWorkers, runEnsemble
+from desaster.server import SimulationServer, reportProgress, submitJob
+from desaster.sharedmemory import SharedTable, shareInputs
+from desaster.streaming import ResultsWriter, entityRow, runUntil
+from desaster.status import StatusCounter
+from desaster.sketches import Moments, TDigest, Sketch, summarizeOutputs, mergeSummaries, summaryTable
+from desaster.store import EnsembleStore, runReplications
+from desaster.aggregation import stackCurves, outputCurves, aggregateCurves
+from desaster.streams import RandomStreams, useStreams, compareAlternatives
+from desaster.sequential import outputMetrics, intervalPrecision, runToPrecision
+from desaster.selection import alternativeGrid, allocateOCBA, probabilityCorrect, selectBest
+from desaster.sensitivity import SensitivityStudy, programArguments
 
 __all__ = ["technical", "financial", "structures",
-            "entities", "policies", "hazus", "io"]
+            "entities", "policies", "hazus", "io", "cohort", "sampling", "branching", "checkpoint",
+            "pipeline", "service", "environment", "sharding",
+            "distributed", "server", "sharedmemory", "streaming", "status", "sketches", "store", "aggregation", "streams", "sequential", "selection", "sensitivity"]
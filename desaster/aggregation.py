@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of functions for combining the recovery curves of many replications
+(e.g., a Monte Carlo ensemble) into mean curves with quantile bands and
+bootstrap confidence intervals, per status, per day, and optionally per group
+(e.g., zip code or region).
+
+Curves are the cumulative number of entities that have reached each status
+(or milestone) by each day: from status.StatusCounter.curves(),
+io.milestone_curves(), store.EnsembleStore.curves(), or computed here from
+each replication's outputs with outputCurves(). They are stacked into one
+(replication, group, day, status) array, and the statistics are computed for
+all days, statuses, and groups at once. The result is a long dataframe (one row
+per group, day, and status) that can be passed to a Bokeh ColumnDataSource,
+e.g., with visualize.ensemble_plot().
+
+Functions:
+stackCurves
+outputCurves
+aggregateCurves
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from desaster.io import milestone_curves
+import numpy as np
+import pandas as pd
+
+def stackCurves(runs, days = None):
+    """Return the curves of several replications as one array.
+
+    Keyword Arguments:
+    runs -- List of dataframes of curves indexed by day, one per replication,
+            with a column per status (e.g., from io.milestone_curves()) or
+            columns (group, status) (e.g., from a grouped StatusCounter)
+    days -- Last day (default: the last day of the longest run). Shorter runs
+            are extended with their last day's counts.
+
+    Returns:
+    (curves, groups, statuses), where curves is an array indexed
+    (replication, group, day, status).
+    """
+    if len(runs) == 0:
+        raise AttributeError("No runs to stack.")
+
+    # Groups and statuses of all runs (a group may be missing from some runs)
+    columns = runs[0].columns
+    if isinstance(columns, pd.MultiIndex):
+        groups = list(pd.unique(pd.concat([run.columns.to_frame().iloc[:, 0] for run in runs])))
+        statuses = list(pd.unique(pd.concat([run.columns.to_frame().iloc[:, 1] for run in runs])))
+    else:
+        groups = ['all']
+        statuses = list(pd.unique(pd.concat([run.columns.to_series() for run in runs])))
+
+    if days is None:
+        days = max(int(run.index.max()) for run in runs)
+
+    curves = np.zeros((len(runs), len(groups), days + 1, len(statuses)))
+    day_range = pd.Index(np.arange(days + 1), name = 'day')
+
+    for i, run in enumerate(runs):
+        run = run.reindex(day_range).ffill()
+        if isinstance(columns, pd.MultiIndex):
+            run = run.reindex(columns = pd.MultiIndex.from_product([groups, statuses]))
+        else:
+            run = run.reindex(columns = statuses)
+        values = run.fillna(0).values
+        curves[i] = values.reshape(days + 1, len(groups), len(statuses)).transpose(1, 0, 2)
+
+    return curves, groups, statuses
+
+def outputCurves(outputs, milestones, days, group = None):
+    """Return the curves of several replications computed from their outputs.
+
+    Keyword Arguments:
+    outputs -- List of dataframes of entity outputs (milestone tables), one per
+                replication, e.g., from io.households_to_df()
+    milestones -- List of milestone columns (e.g., 'inspection_get', 'repair_get')
+    days -- Last day of the curves
+    group -- Optional column to group entities by (e.g., 'zip' or a region column)
+
+    Returns:
+    (curves, groups, statuses) as stackCurves().
+    """
+    if group is None:
+        groups = ['all']
+    else:
+        groups = list(pd.unique(pd.concat([df[group] for df in outputs])))
+
+    curves = np.zeros((len(outputs), len(groups), days + 1, len(milestones)))
+    for i, df in enumerate(outputs):
+        for j, key in enumerate(groups):
+            part = df if group is None else df[df[group] == key]
+            curves[i, j] = milestone_curves(part, milestones, days).values
+
+    return curves, groups, list(milestones)
+
+def aggregateCurves(curves, statuses = None, groups = None, quantiles = (0.05, 0.95),
+                    confidence = 0.95, bootstrap = 1000, seed = None):
+    """Return the mean curves of an ensemble with quantile bands (the spread of
+    the replications) and bootstrap confidence intervals of the mean.
+
+    Keyword Arguments:
+    curves -- List of dataframes of curves (see stackCurves()), the tuple
+                returned by stackCurves() or outputCurves(), or an array
+                indexed (replication, day, status) (e.g., from
+                store.EnsembleStore.curves()) or (replication, group, day, status)
+    statuses -- Names of the statuses, if curves is an array
+    groups -- Names of the groups, if curves is a 4-dimensional array
+    quantiles -- (lower, upper) quantiles of the replications' curves
+    confidence -- Confidence level of the bootstrap intervals
+    bootstrap -- Number of bootstrap resamples of the replications (0 for none)
+    seed -- Seed of the bootstrap's random number generator
+
+    Returns:
+    Dataframe with columns group, day, status, mean, lower, upper (quantile
+    band), ci_lower, and ci_upper (confidence interval of the mean), and
+    replications.
+    """
+    if isinstance(curves, list):
+        curves, groups, statuses = stackCurves(curves)
+    elif isinstance(curves, tuple):
+        curves, groups, statuses = curves
+
+    curves = np.asarray(curves, dtype = float)
+    if curves.ndim == 3:
+        curves = curves[:, np.newaxis]
+        groups = ['all']
+    if curves.ndim != 4:
+        raise AttributeError("Curves array must be indexed (replication, [group,] day, status).")
+
+    replications, n_groups, n_days, n_statuses = curves.shape
+    if statuses is None:
+        statuses = list(range(n_statuses))
+    if groups is None:
+        groups = list(range(n_groups))
+
+    flat = curves.reshape(replications, -1)
+    mean = flat.mean(axis = 0)
+    lower, upper = np.quantile(flat, quantiles, axis = 0)
+
+    if bootstrap > 0 and replications > 1:
+        # Resample replications as multinomial counts, so each resample's mean
+        # is a matrix product rather than a copy of the curves.
+        random_state = np.random.RandomState(seed)
+        counts = random_state.multinomial(replications, np.full(replications, 1.0 / replications),
+                                            size = bootstrap)
+        alpha = (1 - confidence) / 2
+        ci_lower = np.empty(flat.shape[1])
+        ci_upper = np.empty(flat.shape[1])
+        # Columns in chunks, to bound the (bootstrap x columns) array
+        chunk = max(1, 5000000 // bootstrap)
+        for start in range(0, flat.shape[1], chunk):
+            means = counts @ flat[:, start:start + chunk] / replications
+            ci_lower[start:start + chunk], ci_upper[start:start + chunk] = np.quantile(
+                                                            means, [alpha, 1 - alpha], axis = 0)
+    else:
+        ci_lower = np.full(flat.shape[1], np.nan)
+        ci_upper = np.full(flat.shape[1], np.nan)
+
+    index = pd.MultiIndex.from_product([groups, np.arange(n_days), statuses],
+                                        names = ['group', 'day', 'status'])
+    df = pd.DataFrame({'mean': mean, 'lower': lower, 'upper': upper,
+                        'ci_lower': ci_lower, 'ci_upper': ci_upper}, index = index).reset_index()
+    df['replications'] = replications
+
+    return df
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of functions for branching a DESaster simulation into policy variants
+that share a common "warm" prefix. The simulation is run once up to the branch
+day; the process is then forked (copy-on-write, so entities, stocks, and
+program queues are shared until modified) once per variant. Each child applies
+its variant's changes to named recovery programs (e.g., more contractors, a
+budget injection, a later deadline), runs to the end, and sends its results
+back to the parent through a pipe.
+
+Because children inherit the parent's random number generator states, the
+variants share common random numbers after the branch day, which reduces the
+variance of differences between variants.
+
+Requires os.fork() (i.e., Linux or macOS).
+
+Functions:
+applyChanges
+runBranches
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from simpy import Resource, Container
+import os
+import pickle
+import traceback
+
+def applyChanges(programs, changes):
+    """Apply parameter changes to named recovery programs at the current
+    simulation time.
+
+    Keyword Arguments:
+    programs -- Dictionary of recovery program objects keyed by name,
+                e.g., {'repair': RepairProgram(...), 'fema': HousingAssistanceFEMA(...)}
+    changes -- Dictionary keyed by program name of dictionaries of changes, e.g.,
+                {'repair': {'staff': 200}, 'fema': {'budget': 5000000, 'deadline': 720}}
+                * 'staff', 'officers', 'inspectors' -- New capacity of the
+                    simpy.Resource(). Waiting requests are granted immediately if
+                    capacity increases; on a decrease, staff already working
+                    finish their current request.
+                * 'budget', 'materials' -- Amount added to (or, if negative,
+                    removed from) the simpy.Container(). A cut is removed
+                    immediately, ahead of any waiting requests; AttributeError
+                    is raised if the container's level can't cover it.
+                * Any other existing program attribute (e.g., 'deadline',
+                    'max_outlay', 'deductible') is set to the given value.
+
+    Attribute Changes:
+    Program attributes named in changes.
+    """
+    for name, program_changes in changes.items():
+        if name not in programs:
+            raise AttributeError("Program ({0}) not recognized. Can't apply changes.".format(name))
+        program = programs[name]
+
+        for attribute, value in program_changes.items():
+            current = getattr(program, attribute, None)
+
+            if isinstance(current, Resource):
+                current._capacity = value
+                current._trigger_put(None)
+            elif isinstance(current, Container):
+                if value > 0:
+                    current.put(value)
+                elif value < 0:
+                    # Not a get(), which would queue behind waiting requests
+                    # and, if larger than the level, block them forever.
+                    if -value > current.level:
+                        raise AttributeError("{0} {1} level ({2}) can't cover a cut of {3}.".format(
+                                                program.__class__.__name__, attribute,
+                                                current.level, -value))
+                    current._level -= -value
+                    current._trigger_put(None)
+            elif hasattr(program, attribute):
+                setattr(program, attribute, value)
+            else:
+                raise AttributeError("{0} has no attribute {1}. Can't apply changes.".format(
+                                        program.__class__.__name__, attribute))
+
+def runBranches(env, programs, branch_day, until, variants, collect, max_workers = None):
+    """Run a simulation to branch_day, then fork one child process per variant
+    that applies the variant's changes and runs the simulation to until.
+
+    All entity processes must already be started in env. The parent's env is
+    left at branch_day (it can be used for further branching).
+
+    Keyword Arguments:
+    env -- simpy.Environment() with the scenario's processes started
+    programs -- Dictionary of recovery program objects keyed by name
+    branch_day -- Simulation time at which the variants diverge
+    until -- Simulation time at which each variant stops
+    variants -- Dictionary keyed by variant name of changes (see applyChanges());
+                use an empty dictionary for the unchanged (baseline) variant
+    collect -- Function collect(env, programs) called in each child at until;
+                its (picklable) return value is the variant's result, e.g., a
+                dataframe from io.households_to_df()
+    max_workers -- Maximum number of children running at once (default: os.cpu_count())
+
+    Returns:
+    Dictionary of collect() results keyed by variant name.
+    """
+    if not hasattr(os, 'fork'):
+        raise AttributeError("runBranches() requires os.fork(), which is not available on this platform.")
+
+    if env.now < branch_day:
+        env.run(until = branch_day)
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    results = {}
+    running = []
+    pending = list(variants.items())
+
+    while pending or running:
+        while pending and len(running) < max_workers:
+            name, changes = pending.pop(0)
+            running.append((name, _forkVariant(env, programs, until, changes, collect)))
+
+        name, (pid, read_fd) = running.pop(0)
+        results[name] = _receive(name, pid, read_fd)
+
+    return results
+
+def _forkVariant(env, programs, until, changes, collect):
+    """Fork a child that runs one variant; return (pid, read end of the pipe)."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            try:
+                applyChanges(programs, changes)
+                env.run(until = until)
+                result = collect(env, programs)
+                # Pickle before writing, so an unpicklable result is reported
+                # as an error rather than sent as a truncated pickle.
+                data = pickle.dumps((True, result), protocol = pickle.HIGHEST_PROTOCOL)
+            except BaseException:
+                data = pickle.dumps((False, traceback.format_exc()), protocol = pickle.HIGHEST_PROTOCOL)
+            with os.fdopen(write_fd, 'wb') as pipe:
+                pipe.write(data)
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    return pid, read_fd
+
+def _receive(name, pid, read_fd):
+    """Read a child's result from its pipe and reap the child."""
+    with os.fdopen(read_fd, 'rb') as pipe:
+        data = pipe.read()
+    os.waitpid(pid, 0)
+
+    if not data:
+        raise RuntimeError("Variant {0} exited without returning results.".format(name))
+
+    ok, result = pickle.loads(data)
+    if not ok:
+        raise RuntimeError("Variant {0} failed:\n{1}".format(name, result))
+
+    return result
@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of classes and functions for saving a running DESaster simulation to
+disk and resuming it later.
+
+SimPy processes are Python generators, which can't be pickled. A checkpointable
+simulation therefore expresses each entity's recovery pipeline as a Task: a
+plain object that records its position in the pipeline as attributes and is
+advanced by event callbacks instead of by a suspended generator. Everything else
+(the environment's event queue and pending timeouts, resource and container
+queues and levels, building stocks, entities, programs) is ordinary object state
+and is pickled as is, together with the states of Python's and numpy's global
+random number generators. Resuming from a checkpoint and running to time T gives
+exactly the same results as an uninterrupted run to T with the same seeds.
+
+The same snapshot format is used to cache a fully instantiated scenario before
+it is run (entities, buildings with their HAZUS damage values and limit
+states, building stocks, and programs). loadScenario() builds a scenario once
+and rehydrates it on later runs with the same inputs and damage-sampling seed.
+
+Classes:
+Task
+ProgramTask
+
+Functions:
+saveCheckpoint
+loadCheckpoint
+runWithCheckpoints
+hashInputs
+loadScenario
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from simpy.events import Event, Timeout, Process, Interrupt, PENDING, URGENT
+from desaster.service import BatchedService
+from itertools import count
+import hashlib
+import numpy as np
+import pandas as pd
+import os
+import pickle
+import random
+import types
+
+class Task(object):
+    """A base class for resumable (picklable) processes. A Task is started when
+    it is created (like simpy.Process) and advanced by its step() method each time
+    the event it is waiting on is processed. Subclasses keep their position in
+    the pipeline as attributes and implement step().
+
+    Other processes and Tasks can wait for a Task to finish by yielding (or
+    returning from step()) its 'finished' event, whose value is self.result.
+
+    Methods:
+    __init__(self, env)
+    step(self, event)
+    interrupt(self, cause = None)
+    is_alive
+    """
+    __slots__ = ('env', 'result', 'finished', 'target')
+
+    # If True, continue immediately (without a scheduler round trip) when step()
+    # returns a resource/container/store event that has already succeeded.
+    eager = False
+
+    def __init__(self, env):
+        """Initiate a Task object and schedule its first step.
+
+        Keyword Arguments:
+        env -- simpy.Environment() object
+
+        Attribute Changes:
+        self.finished -- A simpy.Event() that succeeds with self.result when the
+                        task finishes.
+        self.target -- The event the task is currently waiting on.
+        self.result -- Value of self.finished (default None)
+        """
+        self.env = env
+        self.result = None
+        self.finished = Event(env)
+
+        # Start like simpy.events.Initialize: an urgent, already triggered event
+        start = Event(env)
+        start._ok = True
+        start._value = None
+        start.callbacks.append(self._resume)
+        env.schedule(start, URGENT)
+        self.target = start
+
+    @property
+    def is_alive(self):
+        """True until the task has finished."""
+        return not self.finished.triggered
+
+    def step(self, event):
+        """Advance the task after event has been processed. Must be implemented
+        by subclasses.
+
+        Keyword Arguments:
+        event -- The processed event the task was waiting on. If event.ok is
+                False (e.g., a failed event or an Interrupt from interrupt()),
+                event.value is the exception and the task must handle it.
+
+        Returns:
+        The next event to wait on, or None if the task is finished.
+        """
+        raise NotImplementedError("{0} must implement step().".format(self.__class__.__name__))
+
+    def interrupt(self, cause = None):
+        """Interrupt the task: stop waiting on its current target and call step()
+        with a failed event whose value is a simpy.Interrupt(cause).
+        """
+        if not self.is_alive:
+            raise RuntimeError("{0} has finished and cannot be interrupted.".format(self))
+
+        interruption = Event(self.env)
+        interruption._ok = False
+        interruption._value = Interrupt(cause)
+        interruption._defused = True
+        interruption.callbacks.append(self._interrupt)
+        self.env.schedule(interruption, URGENT)
+
+    def _interrupt(self, event):
+        if not self.is_alive:
+            return
+        self.target.callbacks.remove(self._resume)
+        self._resume(event)
+
+    def _resume(self, event):
+        while True:
+            if not event._ok:
+                event._defused = True
+
+            next_event = self.step(event)
+
+            if next_event is None:
+                self.target = None
+                self.finished.succeed(self.result)
+                return
+
+            if (self.eager and next_event._value is not PENDING
+                    and next_event._ok and not isinstance(next_event, Timeout)):
+                # Event already succeeded (e.g., a free staff member); continue.
+                event = next_event
+                continue
+
+            if next_event.callbacks is not None:
+                # Event not yet processed; wait for it.
+                next_event.callbacks.append(self._resume)
+                self.target = next_event
+                return
+
+            # Event already processed; continue immediately.
+            event = next_event
+
+class ProgramTask(Task):
+    """A Task that runs one request to a recovery program (or a funding or home
+    search) by calling a step function, e.g., a program's step() method, each
+    time the event it is waiting on is processed: step(task, *args, event)
+    returns the next event to wait on, or None when the request is finished.
+    The task holds the request's state as attributes: its position (sub), an
+    outstanding staff request and container or store get, and a building or
+    home taken from a stock.
+
+    The recovery programs' process() methods and the entities' find_home() and
+    occupy() methods run their step functions in a ProgramTask, and
+    pipeline.PipelineTask (a subclass) runs the same step functions inline, so
+    both follow the same logic.
+
+    Methods:
+    __init__(self, env, function, *args)
+    step(self, event)
+    join(self)
+    withdraw(self)
+    """
+    __slots__ = ('function', 'args', 'sub', 'request', 'resource', 'get', 'container',
+                    'item', 'store', 'patience', 'round', 'search_start', 'children')
+
+    eager = True
+
+    def __init__(self, env, function, *args):
+        """Initiate a ProgramTask object and schedule its first step.
+
+        Keyword Arguments:
+        env -- simpy.Environment() object
+        function -- Step function function(task, *args, event), e.g.,
+                    sba_program.step; must be picklable (e.g., a bound method)
+                    for the task to be checkpointed
+        args -- Arguments of the step function, e.g., the entity
+
+        Attribute Changes:
+        self.sub -- Position within the request (0 at the start)
+        self.request, self.resource -- Outstanding staff request (or batched
+                    service case) and the simpy.Resource() (or
+                    service.BatchedService()) it was made to
+        self.get, self.container -- Outstanding container get and the container
+        self.item, self.store -- Building or home taken from a stock (or
+                    outstanding store get) and the stock (simpy.FilterStore())
+        self.patience -- Patience event (e.g., a timeout) of a search; when it is
+                    processed, the task stops waiting and steps with it
+        self.round, self.search_start, self.children -- State of a funding search
+                    (see policies.FinancialRecoveryPolicy.searchStep())
+        """
+        self.function = function
+        self.args = args
+        self.sub = 0
+        self.request = None
+        self.resource = None
+        self.get = None
+        self.container = None
+        self.item = None
+        self.store = None
+        self.patience = None
+        self.round = None
+        self.search_start = None
+        self.children = None
+        Task.__init__(self, env)
+
+    def step(self, event):
+        return self.function(self, *self.args, event)
+
+    def join(self):
+        """A process (generator) to wait for the task to finish, for use with
+        'yield from' (e.g., in a program's process() method). If the waiting
+        process is interrupted (e.g., by policies.withPatience()), the task is
+        interrupted too, and the process waits while the task withdraws its
+        request.
+
+        Returns:
+        The task's result.
+        """
+        try:
+            yield self.finished
+        except Interrupt as interrupt:
+            if self.is_alive:
+                self.interrupt(interrupt.cause)
+            yield self.finished
+
+        return self.result
+
+    def withdraw(self):
+        """Withdraw the request's outstanding staff request and container or store
+        get, and put back a building or home taken from a stock.
+        """
+        if self.request is not None:
+            if isinstance(self.resource, BatchedService):
+                self.resource.cancel(self.request)
+            elif self.request.triggered:
+                self.resource.release(self.request)
+            else:
+                self.request.cancel()
+            self.request = None
+            self.resource = None
+
+        if self.get is not None:
+            if not self.get.triggered:
+                self.get.cancel()
+            elif self.container is not None:
+                self.container.put(self.get.amount)
+            else:
+                self.store.put(self.get.value)
+            self.get = None
+            self.container = None
+
+        if self.item is not None:
+            self.store.put(self.item)
+            self.item = None
+        self.store = None
+
+    def _patienceExpired(self, event):
+        """Callback of a patience event: stop waiting and step with the patience
+        event, so the step function can handle giving up.
+        """
+        if event is not self.patience or not self.is_alive:
+            return
+        if self.target is not None and self.target.callbacks is not None:
+            self.target.callbacks.remove(self._resume)
+        self._resume(event)
+
+def _bindClass(cls, instance):
+    """Recreate a SimPy bound event class (e.g., env.timeout, container.get)."""
+    return types.MethodType(cls, instance)
+
+class _CheckpointPickler(pickle.Pickler):
+    """Pickler that handles SimPy's bound event classes and refuses generator-based
+    processes with a helpful message.
+    """
+    def reducer_override(self, obj):
+        if isinstance(obj, types.MethodType) and isinstance(obj.__func__, type):
+            return _bindClass, (obj.__func__, obj.__self__)
+        if isinstance(obj, Process):
+            raise TypeError("Can't checkpoint {0}: generator-based SimPy processes "
+                            "can't be saved. Express the process as a "
+                            "checkpoint.Task (e.g., with pipeline.PipelineEngine).".format(obj))
+        return NotImplemented
+
+def saveCheckpoint(path, env, objects):
+    """Save a snapshot of a simulation to disk.
+
+    The snapshot includes env (current time and all pending events), every
+    object reachable from objects, and the states of the random and numpy.random
+    global random number generators. Shared references (e.g., entities that
+    share a building stock) are preserved.
+
+    Keyword Arguments:
+    path -- File path of the checkpoint. Written atomically (via a temporary file).
+    env -- simpy.Environment() object, e.g., after env.run(until = day)
+    objects -- Any picklable object(s) needed to continue and evaluate the run,
+                e.g., {'entities': owners, 'programs': programs, 'tasks': tasks}
+    """
+    # itertools.count can't be (portably) pickled; store the next event id
+    eid = next(env._eid)
+    env._eid = eid
+
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            _CheckpointPickler(f, protocol = pickle.HIGHEST_PROTOCOL).dump({
+                                'env': env,
+                                'objects': objects,
+                                'random_state': random.getstate(),
+                                'numpy_state': np.random.get_state()
+                                })
+        os.replace(temp_path, path)
+    finally:
+        env._eid = count(eid)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def loadCheckpoint(path):
+    """Load a snapshot saved with saveCheckpoint() and restore the global random
+    number generator states.
+
+    Keyword Arguments:
+    path -- File path of the checkpoint.
+
+    Returns:
+    (env, objects) as passed to saveCheckpoint().
+    """
+    with open(path, 'rb') as f:
+        snapshot = pickle.load(f)
+
+    env = snapshot['env']
+    env._eid = count(env._eid)
+    random.setstate(snapshot['random_state'])
+    np.random.set_state(snapshot['numpy_state'])
+
+    return env, snapshot['objects']
+
+def runWithCheckpoints(env, until, every, path, objects):
+    """Run a simulation to until, saving a checkpoint every 'every' days. Can be
+    called again on the env and objects returned by loadCheckpoint() to resume.
+
+    Keyword Arguments:
+    env -- simpy.Environment() object
+    until -- Simulation time at which to stop
+    every -- Simulation days between checkpoints
+    path -- File path of the checkpoint. May contain '{0}' to keep one file per
+            checkpoint time, e.g., 'run_{0:.0f}.pkl'; otherwise it is overwritten.
+    objects -- See saveCheckpoint()
+
+    Returns:
+    List of paths of the saved checkpoints.
+    """
+    saved = []
+    while env.now < until:
+        stop = min(until, (np.floor(env.now / every) + 1) * every)
+        env.run(until = stop)
+        checkpoint_path = path.format(env.now)
+        saveCheckpoint(checkpoint_path, env, objects)
+        saved.append(checkpoint_path)
+
+    return saved
+
+def hashInputs(inputs):
+    """Return a hash (hexadecimal string) of a scenario's inputs, which changes if
+    any input value, column, or file changes.
+
+    Keyword Arguments:
+    inputs -- A dataframe, a path of an input file, or a list, tuple, or
+                dictionary of these (e.g., {'owners': owners_df, 'renters': renters_df})
+    """
+    digest = hashlib.sha256()
+
+    def update(value):
+        if isinstance(value, pd.DataFrame):
+            digest.update(repr((list(value.columns), [str(dtype) for dtype in value.dtypes])).encode())
+            digest.update(pd.util.hash_pandas_object(value, index = True).values.tobytes())
+        elif isinstance(value, dict):
+            for key in sorted(value, key = str):
+                digest.update(repr(key).encode())
+                update(value[key])
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                update(item)
+        elif isinstance(value, str) and os.path.isfile(value):
+            with open(value, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+        else:
+            digest.update(repr(value).encode())
+
+    update(inputs)
+    return digest.hexdigest()
+
+def loadScenario(build, inputs, seed, directory = 'snapshots', refresh = False):
+    """Return an instantiated (not yet run) scenario, from a snapshot if one was
+    saved for the same inputs and seed, otherwise by building it and saving a
+    snapshot for later runs.
+
+    To build, the random and numpy.random global random number generators are
+    seeded with seed (e.g., for sampling damage states) and build(env, inputs)
+    is called. The snapshot includes every object reachable from its return
+    value -- e.g., entities with their residences, landlords, and tenants;
+    buildings with their damage values and limit states; and the building
+    stocks (owned, rented, for sale, for rent) with their members -- and the
+    random number generator states after building, so a rehydrated scenario
+    runs exactly as a freshly built one.
+
+    Entities' processes (generators) can't be saved, so build() should create
+    the scenario but not start processes; start them on the returned objects.
+
+    Keyword Arguments:
+    build -- Function build(env, inputs) that creates the scenario and returns
+            any picklable object(s), e.g., {'owners': owners, 'renters': renters,
+            'owned_stock': owned_stock, 'programs': programs}
+    inputs -- The scenario's inputs, passed to build() and hashed with
+            hashInputs() to key the snapshot
+    seed -- Damage-sampling (random number generator) seed
+    directory -- Directory of the snapshots
+    refresh -- If True, build and save a new snapshot even if one exists (e.g.,
+            after changing build())
+
+    Returns:
+    (env, objects), where objects is the return value of build().
+    """
+    key = hashInputs([inputs, seed])
+    path = os.path.join(directory, 'scenario_{0}.pkl'.format(key[:32]))
+
+    if not refresh and os.path.exists(path):
+        env, snapshot = loadCheckpoint(path)
+        if snapshot['key'] == key:
+            return env, snapshot['objects']
+
+    import simpy
+
+    random.seed(seed)
+    np.random.seed(seed)
+    env = simpy.Environment()
+    objects = build(env, inputs)
+
+    os.makedirs(directory, exist_ok = True)
+    saveCheckpoint(path, env, {'key': key, 'objects': objects})
+
+    return env, objects
@@ -0,0 +1,625 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of classes for a cohort (fluid) approximation of DESaster recovery
+processes. Rather than simulating each household as a SimPy process, households
+are grouped into cohorts of similar households and the *fractions* of each
+cohort are pushed through the same inspection, financial assistance, assessment,
+permit, repair, and occupancy stages in daily time steps. Staff, budget, and
+material constraints are read from the same recovery program objects used in
+the discrete event simulation (e.g., technical.InspectionProgram,
+financial.HousingAssistanceFEMA) so that the two can be compared directly.
+
+Intended for very large (e.g., state-wide) what-if screening where per-household
+trajectories are not needed.
+
+Classes:
+CohortModel
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from desaster.hazus import (structural_damage_ratios, acceleration_damage_ratios,
+                            drift_damage_ratios)
+from desaster.io import milestone_curves
+import numpy as np
+import pandas as pd
+
+damage_states = ['None', 'Slight', 'Moderate', 'Extensive', 'Complete']
+
+class CohortModel(object):
+    """A class to approximate the recovery of a large population of households by
+    grouping them into cohorts by occupancy, damage state, tenure, insurance band,
+    credit band, and income band. Each recovery stage is represented as a fluid
+    queue with the stage's program staff as servers and the mean of the program's
+    duration distribution as (deterministic) service time. Program budgets, the
+    repair program's materials, and the number of vacant homes are depleted as
+    cohort fractions draw on them. Households that wait longer than their
+    funding or home search patience give up, first in, first out.
+
+    The stage logic mirrors the owner and renter (landlord) processes in
+    scenarios/desaster_application_template.ipynb with a sequential
+    insurance -> FEMA -> SBA funding search.
+
+    Methods:
+    __init__
+    run(self, days)
+    calibrate(self, des_df, days = None)
+    """
+    def __init__(self, entities_df, entity_type, inspection_program, assessment_program,
+                permit_program, repair_program, demolition_program = None,
+                insurance_program = None, fema_program = None, sba_program = None,
+                occupy_duration = None, find_home_duration = None, vacant_homes = 0,
+                start_delay = 0.0, income_bands = 3, dt = 1.0,
+                funding_patience = float('inf'), home_patience = float('inf'),
+                insurance_budget = None, fema_budget = None, sba_budget = None,
+                repair_materials = None):
+        """Initiate a CohortModel object and group the input households into cohorts.
+
+        Keyword Arguments:
+        entities_df -- Dataframe w/ entities' input attributes (same format as
+                        used by io.importEntities()).
+        entity_type -- 'OwnerHousehold' or 'RenterHousehold'
+        inspection_program -- A technical.InspectionProgram object
+        assessment_program -- A technical.EngineeringAssessment object
+        permit_program -- A technical.PermitProgram object
+        repair_program -- A technical.RepairProgram object
+        demolition_program -- A technical.DemolitionProgram object
+        insurance_program -- A financial.OwnersInsurance object
+        fema_program -- A financial.HousingAssistanceFEMA object (owners only)
+        sba_program -- A financial.RealPropertyLoanSBA object
+        occupy_duration -- Distribution of time to (re)occupy a home
+        find_home_duration -- Distribution of time to close on a new home
+        vacant_homes -- Number of vacant homes available to displaced households
+        start_delay -- Days between the event and the start of inspections
+        income_bands -- Number of income quantile bands used to form cohorts
+        dt -- Length of a time step in days
+        funding_patience -- Days after the start of the search for repair money
+                            (see policies.FinancialRecoveryPolicy.search())
+                            after which households give up the search
+        home_patience -- Days after the start of the search for a new home (see
+                            entities.Household.find_home()) after which
+                            households give up the search
+        insurance_budget -- Initial level of the insurance program's budget
+                            (default: its level when the CohortModel is created)
+        fema_budget -- Initial level of the FEMA program's budget (default: its
+                        level when the CohortModel is created)
+        sba_budget -- Initial level of the SBA program's budget (default: its
+                        level when the CohortModel is created)
+        repair_materials -- Initial level of the repair program's materials
+                            (default: its level when the CohortModel is created)
+
+        Attribute Changes:
+        self.cohorts -- Dataframe with one row per cohort: cohort key, number of
+                        households, and mean funding amounts and fractions.
+        self.levels -- Dictionary of the initial budget and materials levels
+        """
+        if entity_type.lower() in ['ownerhousehold', 'owner household']:
+            self.renters = False
+        elif entity_type.lower() in ['renterhousehold', 'renter household']:
+            self.renters = True
+        else:
+            raise AttributeError("Entity type ({0}) not supported by CohortModel.".format(entity_type))
+
+        self.inspection_program = inspection_program
+        self.assessment_program = assessment_program
+        self.permit_program = permit_program
+        self.repair_program = repair_program
+        self.demolition_program = demolition_program
+        self.insurance_program = insurance_program
+        self.fema_program = None if self.renters else fema_program
+        self.sba_program = sba_program
+        self.occupy_duration = occupy_duration
+        self.find_home_duration = find_home_duration
+        self.vacant_homes = vacant_homes
+        self.start_delay = start_delay
+        self.dt = dt
+        self.funding_patience = funding_patience
+        self.home_patience = home_patience
+
+        # Initial levels are fixed now so that runs don't start from budgets and
+        # materials already used by a discrete event simulation of the programs.
+        self.levels = {'insurance': _level(self.insurance_program, 'budget', insurance_budget),
+                        'fema': _level(self.fema_program, 'budget', fema_budget),
+                        'sba': _level(self.sba_program, 'budget', sba_budget),
+                        'materials': _level(self.repair_program, 'materials', repair_materials)}
+
+        self.cohorts = self.groupCohorts(entities_df, income_bands)
+
+    def groupCohorts(self, entities_df, income_bands):
+        """Calculate each household's (deterministic) funding amounts and then
+        group households into cohorts.
+
+        Keyword Arguments:
+        entities_df -- Dataframe w/ entities' input attributes
+        income_bands -- Number of income quantile bands
+
+        Returns:
+        Dataframe with one row per cohort.
+        """
+        df = pd.DataFrame(index = entities_df.index)
+        df['occupancy'] = entities_df['occupancy'].values
+        df['damage_state'] = entities_df['damage_state'].fillna('None').values
+        df['tenure'] = entities_df['tenure'].values
+        df['income'] = entities_df['income'].astype(float).values
+
+        # Renters' housing is repaired with their landlord's funds
+        if self.renters:
+            savings = entities_df['landlord_savings'].astype(float).values
+            insurance = entities_df['landlord_insurance'].astype(float).values
+            credit = entities_df['landlord_credit'].astype(float).values
+        else:
+            savings = entities_df['savings'].astype(float).values
+            insurance = entities_df['insurance'].astype(float).values
+            credit = entities_df['credit'].astype(float).values
+        value = entities_df['value'].astype(float).values
+
+        # Use HAZUS lookup tables to assign damage value (vectorized version of
+        # hazus.setStructuralDamageValueHAZUS())
+        ratios = (structural_damage_ratios[damage_states].stack()
+                    + acceleration_damage_ratios[damage_states].stack()
+                    + drift_damage_ratios[damage_states].stack()) / 100.0
+        keys = pd.MultiIndex.from_arrays([df['occupancy'], df['damage_state']])
+        damage_value = value * ratios.reindex(keys).values
+
+        # Insurance claim (see financial.OwnersInsurance.process())
+        claim = np.zeros(len(df))
+        if self.insurance_program is not None:
+            deductible_amount = value * insurance * self.insurance_program.deductible
+            claim = np.where((insurance > 0.0) & (damage_value >= deductible_amount),
+                                damage_value - deductible_amount, 0.0)
+
+        # FEMA assistance (see financial.HousingAssistanceFEMA.process()). Only
+        # requested if savings and claim don't cover damage (see
+        # policies.Insurance_IA_SBA_Sequential.policy())
+        fema = np.zeros(len(df))
+        if self.fema_program is not None:
+            fema = np.clip(np.minimum(self.fema_program.max_outlay, damage_value - claim), 0.0, None)
+            fema = np.where(savings + claim < damage_value, fema, 0.0)
+
+        # SBA loan (see financial.RealPropertyLoanSBA.setLoanAmount())
+        sba_apply = np.zeros(len(df))
+        sba = np.zeros(len(df))
+        sba_apply_nofema = np.zeros(len(df))
+        sba_nofema = np.zeros(len(df))
+        if self.sba_program is not None:
+            sba_apply = np.where(savings + claim + fema < damage_value,
+                                    self._loanAmount(damage_value - claim - fema, df['income'].values), 0.0)
+            sba_apply_nofema = np.where(savings + claim < damage_value,
+                                    self._loanAmount(damage_value - claim, df['income'].values), 0.0)
+            approved = credit >= self.sba_program.min_credit
+            sba = np.where(approved, sba_apply, 0.0)
+            sba_nofema = np.where(approved, sba_apply_nofema, 0.0)
+
+        df['households'] = 1
+        df['damage_value'] = damage_value
+        df['claim'] = claim
+        df['claim_frac'] = claim > 0.0
+        df['fema'] = fema
+        df['fema_frac'] = fema > 0.0
+        df['sba'] = sba
+        df['sba_apply_frac'] = sba_apply > 0.0
+        df['sba_approved_frac'] = sba > 0.0
+        df['sba_over_25k_frac'] = sba > 25000
+        df['sba_nofema'] = sba_nofema
+        df['sba_apply_frac_nofema'] = sba_apply_nofema > 0.0
+        df['sba_approved_frac_nofema'] = sba_nofema > 0.0
+        df['funded_frac'] = savings + claim + fema + sba >= damage_value
+        df['funded_frac_nofema'] = savings + claim + sba_nofema >= damage_value
+
+        # Bands used to define cohorts
+        df['insurance_band'] = np.where(insurance > 0.0, 'Insured', 'Uninsured')
+        if self.sba_program is not None:
+            df['credit_band'] = np.where(credit >= self.sba_program.min_credit,
+                                            'Qualified', 'Not qualified')
+        else:
+            df['credit_band'] = 'Any'
+        df['income_band'] = pd.qcut(df['income'].rank(method = 'first'),
+                                    min(income_bands, len(df)), labels = False)
+
+        keys = ['occupancy', 'damage_state', 'tenure', 'insurance_band',
+                'credit_band', 'income_band']
+        agg = {column: 'mean' for column in df.columns if column not in keys}
+        agg['households'] = 'sum'
+        agg['income'] = 'mean'
+
+        return df.groupby(keys).agg(agg).reset_index()
+
+    def _loanAmount(self, required_loan, income):
+        """Vectorized version of financial.RealPropertyLoanSBA.setLoanAmount()
+        before the credit check.
+        """
+        required_loan = np.clip(required_loan, 0.0, None)
+
+        # Landlords do not have an income attribute
+        if self.renters:
+            qualified_loan = required_loan * 0.44
+        else:
+            monthly_rate = self.sba_program.interest_rate / 12
+            periods = self.sba_program.loan_term * 12
+            qualified_monthly_payment = (income / 12) * self.sba_program.debt_income_ratio
+            qualified_loan = (qualified_monthly_payment
+                                * (1.0 - (1.0 + monthly_rate) ** -periods) / monthly_rate)
+
+        return np.minimum(np.minimum(required_loan, qualified_loan), self.sba_program.max_loan)
+
+    def run(self, days):
+        """Push cohort fractions through the recovery stages for the specified
+        number of days.
+
+        Keyword Arguments:
+        days -- Number of days to simulate
+
+        Returns:
+        Dataframe indexed by day with the cumulative number of households that
+        have reached each milestone (same column names as entity attributes, e.g.,
+        'inspection_get', 'repair_get').
+        """
+        c = self.cohorts
+        n = len(c)
+        dt = self.dt
+        steps = int(np.ceil(days / dt)) + 1
+        damaged = (c['damage_state'] != 'None').values
+        demolish = c['damage_state'].isin(['Extensive', 'Complete']).values
+        complete = (c['damage_state'] == 'Complete').values
+
+        # Stages use program staff as servers and mean durations as service times
+        delay = _FluidStage(n, self.start_delay, dt = dt)
+        inspection = _programStage(n, self.inspection_program, dt)
+        insurance = _programStage(n, self.insurance_program, dt)
+        fema = _programStage(n, self.fema_program, dt)
+        sba_review = _FluidStage(n, 0.0, dt = dt)
+        sba_inspection = _FluidStage(n, 1.0, dt = dt) # Assumed 1 day inspection duration.
+        sba_disbursement = _FluidStage(n, 0.0, dt = dt)
+        assessment = _programStage(n, self.assessment_program, dt)
+        permit = _programStage(n, self.permit_program, dt)
+        demolition = _programStage(n, self.demolition_program, dt)
+        repair = _programStage(n, self.repair_program, dt)
+        home_search = _FluidStage(n, _mean(self.find_home_duration), dt = dt)
+        occupy = _FluidStage(n, _mean(self.occupy_duration), dt = dt)
+
+        if self.sba_program is not None:
+            sba_duration = _mean(self.sba_program.duration)
+            sba_review = _FluidStage(n, sba_duration, self.sba_program.officers.capacity,
+                                        dt, self.sba_program.declaration)
+            sba_inspection = _FluidStage(n, 1.0, self.sba_program.inspectors.capacity, dt)
+            sba_disbursement = _FluidStage(n, sba_duration * c['sba_over_25k_frac'].values, dt = dt)
+        if self.fema_program is not None:
+            fema.opens = self.fema_program.declaration
+
+        # Budgets, materials, and vacant homes are depleted as cohorts draw on them
+        claim_budget = _Gate(n, self.levels['insurance'])
+        fema_budget = _Gate(n, self.levels['fema'])
+        sba_budget = _Gate(n, self.levels['sba'])
+        materials = _Gate(n, self.levels['materials'])
+        homes = _Gate(n, self.vacant_homes)
+
+        # Searches for money start at inspection, or for the uninsured at the
+        # disaster declaration (see policies.FinancialRecoveryPolicy.searchStep())
+        funding_search = _Patience(n, self.funding_patience, steps, dt)
+        home_search_patience = _Patience(n, self.home_patience, steps, dt)
+        declaration = next((program.declaration for program in [self.fema_program, self.sba_program]
+                            if program is not None), 0.0)
+        insured = (c['insurance_band'] == 'Insured').values
+        funding_queues = [insurance.queue, claim_budget.queue, fema.queue, fema_budget.queue,
+                            sba_review.queue, sba_inspection.queue, sba_budget.queue]
+
+        milestones = ['inspection_get', 'claim_get', 'fema_get', 'sba_get',
+                        'gave_up_funding_search', 'assessment_get', 'permit_get',
+                        'demolition_get', 'repair_get', 'home_put', 'home_get',
+                        'gave_up_home_search', 'occupy_get']
+        reached = {m: np.zeros(n) for m in milestones}
+        sba_missed = np.zeros(n) # Households that missed the FEMA deadline
+        sba_entered = np.zeros(n)
+        curves = []
+
+        # All households enter at time 0; undamaged renters only need to occupy
+        if self.renters:
+            delay.queue += c['households'].values * damaged
+            occupy.queue += c['households'].values * ~damaged
+        else:
+            delay.queue += c['households'].values
+
+        for step in range(steps):
+            now = step * dt
+
+            inspection.queue += delay.step(now)
+            inspected = inspection.step(now)
+            reached['inspection_get'] += inspected
+            occupy.queue += inspected * ~damaged
+
+            # Sequential insurance -> FEMA -> SBA funding search
+            to_fema = inspected * damaged
+            funding_search.enter(to_fema, np.where(insured, now, max(declaration, now)))
+            if self.insurance_program is not None:
+                insurance.queue += to_fema * c['claim_frac'].values
+                to_fema = to_fema * (1 - c['claim_frac'].values)
+            claim_budget.queue += insurance.step(now)
+            claimed = claim_budget.step(c['claim'].values / np.maximum(c['claim_frac'].values, 1e-12))
+            reached['claim_get'] += claimed
+            to_fema = to_fema + claimed
+
+            to_sba = to_fema
+            if self.fema_program is not None:
+                # Applications are rejected after the FEMA deadline
+                if now > self.fema_program.deadline:
+                    sba_missed += to_fema * c['fema_frac'].values
+                else:
+                    fema.queue += to_fema * c['fema_frac'].values
+                to_sba = to_fema * (1 - c['fema_frac'].values)
+                fema_budget.queue += fema.step(now)
+                received = fema_budget.step(c['fema'].values / np.maximum(c['fema_frac'].values, 1e-12))
+                reached['fema_get'] += received
+                to_sba = to_sba + received + (to_fema * c['fema_frac'].values
+                                                if now > self.fema_program.deadline else 0.0)
+
+            sba_entered += to_sba
+            missed = np.divide(sba_missed, sba_entered, out = np.zeros(n), where = sba_entered > 0)
+            to_decision = to_sba
+            if self.sba_program is not None:
+                apply_frac = _mix(c, 'sba_apply_frac', missed)
+                approved_frac = np.divide(_mix(c, 'sba_approved_frac', missed), apply_frac,
+                                            out = np.zeros(n), where = apply_frac > 0)
+                to_decision = to_sba * (1 - apply_frac)
+                if now > self.sba_program.deadline:
+                    to_decision = to_decision + to_sba * apply_frac
+                else:
+                    sba_review.queue += to_sba * apply_frac
+                reviewed = sba_review.step(now)
+                to_decision = to_decision + reviewed * (1 - approved_frac)
+                sba_inspection.queue += reviewed * approved_frac
+                sba_budget.queue += sba_inspection.step(now)
+                sba_amount = np.divide(_mix(c, 'sba', missed), _mix(c, 'sba_approved_frac', missed),
+                                        out = np.zeros(n), where = _mix(c, 'sba_approved_frac', missed) > 0)
+                sba_disbursement.queue += sba_budget.step(sba_amount)
+                loaned = sba_disbursement.step(now)
+                reached['sba_get'] += loaned
+                to_decision = to_decision + loaned
+
+            # Households whose patience ran out give up waiting for money and
+            # search for a new home (renters are evicted by their landlords)
+            funding_search.leave(to_decision)
+            gave_up = funding_search.step(step, funding_queues)
+            reached['gave_up_funding_search'] += gave_up
+
+            # Households with enough funds repair, others search for a new home
+            funded_frac = _mix(c, 'funded_frac', missed)
+            to_repair = to_decision * funded_frac * (~complete if not self.renters else 1)
+            assessment.queue += to_repair
+            displaced = to_decision - to_repair + gave_up
+
+            permit.queue += assessment.step(now)
+            reached['assessment_get'] += assessment.completed
+            permitted = permit.step(now)
+            reached['permit_get'] += permitted
+            demolition.queue += permitted * demolish
+            demolished = demolition.step(now)
+            reached['demolition_get'] += demolished
+            materials.queue += permitted * ~demolish + demolished
+            repair.queue += materials.step(c['damage_value'].values)
+            repaired = repair.step(now)
+            reached['repair_get'] += repaired
+
+            # Renters are evicted from extensively/completely damaged homes
+            if self.renters:
+                displaced = displaced + repaired * demolish
+                occupy.queue += repaired * ~demolish
+            else:
+                occupy.queue += repaired
+
+            reached['home_put'] += displaced
+            homes.queue += displaced
+            home_search_patience.enter(displaced, now)
+            housed = homes.step(np.ones(n))
+            home_search_patience.leave(housed)
+            reached['gave_up_home_search'] += home_search_patience.step(step, [homes.queue])
+            home_search.queue += housed
+            found = home_search.step(now)
+            reached['home_get'] += found
+            occupy.queue += found
+
+            reached['occupy_get'] += occupy.step(now)
+
+            curves.append([reached[m].sum() for m in milestones])
+
+        index = pd.Index(np.arange(len(curves)) * dt, name = 'day')
+        return pd.DataFrame(curves, index = index, columns = milestones)
+
+    def calibrate(self, des_df, days = None):
+        """Compare cohort recovery curves against curves from the discrete event
+        simulation of the same households and report the approximation error.
+
+        Keyword Arguments:
+        des_df -- Dataframe of DES outputs, e.g., from io.households_to_df()
+        days -- Number of days to compare. Defaults to the last DES milestone.
+
+        Returns:
+        Dataframe indexed by milestone with the root mean squared error, maximum
+        absolute error, and error in the final count (as number of households
+        and as a fraction of the number of households).
+        """
+        milestones = [m for m in ['inspection_get', 'claim_get', 'fema_get', 'sba_get',
+                        'gave_up_funding_search', 'assessment_get', 'permit_get',
+                        'demolition_get', 'repair_get', 'home_put', 'home_get',
+                        'gave_up_home_search', 'occupy_get'] if m in des_df.columns]
+        if days is None:
+            days = int(np.ceil(np.nanmax(des_df[milestones].apply(pd.to_numeric,
+                                                errors = 'coerce').values)))
+
+        cohort = self.run(days).reindex(np.arange(days + 1), method = 'ffill')
+        des = milestone_curves(des_df, milestones, days)
+        error = cohort[milestones].values - des.values
+        total = float(self.cohorts['households'].sum())
+
+        return pd.DataFrame({'rmse': np.sqrt(np.mean(error ** 2, axis = 0)),
+                                'max_abs_error': np.abs(error).max(axis = 0),
+                                'final_des': des.values[-1],
+                                'final_cohort': cohort[milestones].values[-1],
+                                'final_error_pct': error[-1] / total},
+                                index = pd.Index(milestones, name = 'milestone'))
+
+class _FluidStage(object):
+    """A fluid queue with a (possibly infinite) number of servers and a
+    deterministic, cohort-specific service time. Service times are split between
+    the two neighboring time steps to preserve the mean. A service time shorter
+    than a time step only uses that fraction of a server's step, so each server
+    can start dt / service time households per step.
+    """
+    def __init__(self, n, delay, capacity = float('inf'), dt = 1.0, opens = 0.0):
+        self.steps = np.broadcast_to(np.asarray(delay, dtype = float) / dt, (n,)).copy()
+        self.capacity = capacity
+        self.opens = opens # Time before which no service starts (e.g., declaration)
+        self.queue = np.zeros(n)
+        self.completed = np.zeros(n)
+        self.busy = 0.0
+        self.head = 0
+        self.ring = np.zeros((int(self.steps.max()) + 2, n))
+        self.release = np.zeros_like(self.ring) # Servers freed by step, for services of a step or more
+
+    def step(self, now):
+        # Service completions due this step
+        completed = self.ring[self.head].copy()
+        self.ring[self.head] = 0.0
+        self.busy -= self.release[self.head].sum()
+        self.release[self.head] = 0.0
+
+        # Start service for as much of the queue as the free servers' time allows
+        starts = np.zeros_like(self.queue)
+        waiting = self.queue.sum()
+        if waiting > 0 and now >= self.opens:
+            free = max(self.capacity - self.busy, 0.0)
+            # Mean fraction of a server's step used per start
+            use = (self.queue * np.minimum(self.steps, 1.0)).sum() / waiting
+            startable = free / use if use > 0 else float('inf')
+            starts = self.queue * min(1.0, startable / waiting)
+            self.queue -= starts
+
+        lo = np.floor(self.steps).astype(int)
+        weight = self.steps - lo
+        now_part = np.where(lo == 0, starts * (1 - weight), 0.0)
+        later_part = np.where(lo == 0, 0.0, starts * (1 - weight))
+        columns = np.arange(len(starts))
+        length = len(self.ring)
+        self.ring[(self.head + lo) % length, columns] += later_part
+        self.ring[(self.head + lo + 1) % length, columns] += starts * weight
+
+        # Services shorter than a step were paid for with this step's server
+        # time; longer ones hold a server until they complete.
+        held = lo > 0
+        self.release[(self.head + lo) % length, columns] += later_part
+        self.release[(self.head + lo + 1) % length, columns] += np.where(held, starts * weight, 0.0)
+        self.busy += starts[held].sum()
+        self.head = (self.head + 1) % length
+
+        self.completed = completed + now_part
+        return self.completed
+
+class _Gate(object):
+    """A fluid queue that admits households only while a shared level (e.g., a
+    program budget) can cover their per-household amount.
+    """
+    def __init__(self, n, level = float('inf')):
+        self.level = level
+        self.queue = np.zeros(n)
+
+    def step(self, amount):
+        request = (self.queue * amount).sum()
+        if request <= self.level:
+            admitted = self.queue.copy()
+            self.level -= request
+        else:
+            admitted = self.queue * (self.level / request)
+            self.level = 0.0
+        self.queue -= admitted
+        return admitted
+
+class _Patience(object):
+    """Deterministic patience of households waiting in first-in, first-out
+    fluid queues: those that started waiting at time t and have not left the
+    queues by t + patience give up.
+    """
+    def __init__(self, n, patience, steps, dt):
+        self.patience = patience
+        self.dt = dt
+        self.due = np.zeros((steps, n)) # Households whose patience runs out, by step
+        self.overdue = np.zeros(n)
+        self.left = np.zeros(n) # Households that left the queues or gave up
+
+    def enter(self, amount, start):
+        """Add households that started waiting at time start."""
+        if self.patience == float('inf'):
+            return
+        amount = np.broadcast_to(amount, self.left.shape)
+        ends = np.ceil((np.broadcast_to(start, self.left.shape) + self.patience)
+                        / self.dt - 1e-9).astype(int)
+        columns = np.flatnonzero((ends < len(self.due)) & (amount > 0))
+        np.add.at(self.due, (ends[columns], columns), amount[columns])
+
+    def leave(self, amount):
+        """Record households that left the queues without giving up."""
+        self.left += amount
+
+    def step(self, step, queues):
+        """Remove the households whose patience ran out by this step from the
+        queues (arrays, changed in place) and return the number that gave up.
+        Households in service are not removed.
+        """
+        self.overdue += self.due[step]
+        queued = sum(queues)
+        quitting = np.minimum(np.clip(self.overdue - self.left, 0.0, None), queued)
+        fraction = np.divide(quitting, queued, out = np.zeros_like(queued), where = queued > 0)
+        for queue in queues:
+            queue *= 1 - fraction
+        self.left += quitting
+        return quitting
+
+def _programStage(n, program, dt):
+    """Return a _FluidStage using a recovery program's staff and duration."""
+    if program is None:
+        return _FluidStage(n, 0.0, dt = dt)
+    return _FluidStage(n, _mean(program.duration), program.staff.capacity, dt)
+
+def _mean(duration):
+    """Return the mean of a duration distribution (0 if None)."""
+    if duration is None:
+        return 0.0
+    with np.errstate(invalid = 'ignore'):
+        mean = float(duration.mean())
+
+    # Degenerate scipy distributions (e.g., norm(loc = 10, scale = 0)) have an
+    # undefined mean but always return loc.
+    if not np.isfinite(mean):
+        shapes, loc, scale = duration.dist._parse_args(*duration.args, **duration.kwds)
+        mean = float(loc)
+    return mean
+
+def _level(program, container, level = None):
+    """Return level if given, otherwise the current level of a program's
+    simpy.Container (inf if no program).
+    """
+    if level is not None:
+        return level
+    if program is None:
+        return float('inf')
+    return getattr(program, container).level
+
+def _mix(cohorts, column, missed):
+    """Blend a cohort column with its no-FEMA counterpart by the fraction of
+    households that missed the FEMA deadline.
+    """
+    if column + '_nofema' not in cohorts:
+        return cohorts[column].values
+    return (cohorts[column].values * (1 - missed)
+                + cohorts[column + '_nofema'].values * missed)
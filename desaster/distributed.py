@@ -0,0 +1,519 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of classes and functions for running ensembles of DESaster simulations
+(replications and parameter sweeps) on worker processes on one or more hosts.
+
+A Coordinator listens on a TCP port and hands out jobs -- (scenario, seed)
+pairs -- to the workers that connect to it. A worker imports desaster (which
+loads the HAZUS tables) and runs an optional preload function once, then
+repeatedly asks for a job, runs function(scenario, seed), and sends back the
+result (e.g., a dataframe of entity milestones), compressed. While running a
+job, a worker sends a heartbeat every few seconds; if a worker's connection
+drops or its heartbeats stop, its job is given to another worker (up to
+retries times). No external scheduler is needed: start workers on each host
+with
+
+    python -m desaster.distributed HOST:PORT
+
+(with the shared key in the DESASTER_AUTHKEY environment variable), or on the
+local host with startLocalWorkers(). Connections are authenticated with the
+shared key, and messages are unpickled on receipt, so anyone with the key can
+run code on the coordinator and workers. A coordinator on the local host
+without a given key (or DESASTER_AUTHKEY) uses a random key that only its
+local workers get; listening on any other address requires an explicit key.
+Only use the protocol on trusted networks.
+
+The job function is sent by reference, so it must be a module-level function
+that workers can import, e.g., mymodel.runScenario(scenario, seed).
+
+Classes:
+Coordinator
+BatchRunner
+
+Functions:
+sharedKey
+runWorker
+startLocalWorkers
+stopWorkers
+runEnsemble
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from collections import deque
+from multiprocessing import Process
+from multiprocessing.connection import Listener, Client
+import ipaddress
+import os
+import pickle
+import queue
+import sys
+import threading
+import traceback
+import zlib
+import pandas as pd
+
+class Coordinator(object):
+    """A class to hand out ensemble jobs to workers over TCP and collect their
+    results.
+
+    Methods:
+    __init__(self, function, jobs, address = ('127.0.0.1', 0), authkey = None,
+                retries = 2, heartbeat = 5.0, keep_alive = False)
+    submit(self, jobs)
+    next(self)
+    results(self)
+    close(self)
+    """
+    def __init__(self, function, jobs, address = ('127.0.0.1', 0), authkey = None,
+                    retries = 2, heartbeat = 5.0, keep_alive = False):
+        """Initiate a Coordinator object and start listening for workers.
+
+        Keyword Arguments:
+        function -- Module-level function function(scenario, seed) run by workers
+                    for each job; its (picklable) return value is the job's result.
+        jobs -- List of (scenario, seed) pairs. scenario is any picklable object
+                (e.g., a dictionary of program parameters).
+        address -- (host, port) to listen on. Port 0 picks a free port; use
+                    ('0.0.0.0', port) to accept workers from other hosts
+                    (requires an explicit authkey or DESASTER_AUTHKEY).
+        authkey -- Shared key (bytes) that workers must present (default: the
+                    DESASTER_AUTHKEY environment variable or, on a loopback
+                    address, a random key)
+        retries -- Number of times a job is given to another worker when its
+                    worker is lost
+        heartbeat -- Seconds between worker heartbeats. A worker is considered
+                    lost after three missed heartbeats.
+        keep_alive -- Whether workers wait for more jobs (see submit()) when all
+                    jobs are done, rather than stop, until close() is called
+
+        Attribute Changes:
+        self.address -- (host, port) the coordinator is listening on
+        self.authkey -- The shared key, for local workers (see startLocalWorkers())
+        self.pending -- Jobs (job id, attempts) not yet handed out
+        """
+        self.function = function
+        self.jobs = list(jobs)
+        self.retries = retries
+        self.heartbeat = heartbeat
+        self.keep_alive = keep_alive
+
+        self.pending = deque((job_id, 0) for job_id in range(len(self.jobs)))
+        self.outstanding = len(self.jobs)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.finished = queue.Queue()
+        self.closed = False
+
+        self.authkey = sharedKey(authkey, address)
+        self.listener = Listener(address, authkey = self.authkey)
+        self.address = self.listener.address
+
+        accept = threading.Thread(target = self._accept, daemon = True)
+        accept.start()
+
+    def submit(self, jobs):
+        """Add jobs (e.g., another batch of replications) and return their job
+        ids. Use keep_alive = True so that workers don't stop while the
+        coordinator waits to submit more jobs.
+        """
+        jobs = list(jobs)
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Coordinator is closed.")
+            start = len(self.jobs)
+            self.jobs.extend(jobs)
+            self.pending.extend((job_id, 0) for job_id in range(start, len(self.jobs)))
+            self.outstanding += len(jobs)
+            self.changed.notify_all()
+
+        return list(range(start, start + len(jobs)))
+
+    def next(self):
+        """Wait for the next completed job and return (job id, scenario, seed,
+        result). Raises RuntimeError if the job failed or ran out of retries.
+        """
+        job_id, ok, result = self.finished.get()
+        scenario, seed = self.jobs[job_id]
+        if not ok:
+            raise RuntimeError("Job {0} (seed {1}) failed:\n{2}".format(job_id, seed, result))
+        return job_id, scenario, seed, result
+
+    def results(self):
+        """A generator of (job id, scenario, seed, result) as jobs are completed,
+        in order of completion. The job id is the job's index in jobs. Raises
+        RuntimeError if a job fails or runs out of retries.
+        """
+        try:
+            for i in range(len(self.jobs)):
+                yield self.next()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop accepting workers. Workers are told to stop when they next ask
+        for a job.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.pending.clear()
+            self.changed.notify_all()
+        self.listener.close()
+
+    def _accept(self):
+        """Accept worker connections, each served by its own thread."""
+        while not self.closed:
+            try:
+                connection = self.listener.accept()
+            except Exception:
+                # Listener closed, or a worker failed to authenticate.
+                if self.closed:
+                    return
+                continue
+            worker = threading.Thread(target = self._serve, args = (connection,), daemon = True)
+            worker.start()
+
+    def _next(self):
+        """Return the next job (job id, attempts), or None if all jobs are done
+        or the coordinator is closed. If all jobs are handed out but some may
+        still be retried (or, with keep_alive, more may be submitted), block
+        until submit(), a lost worker, a finished job, or close() changes that.
+        """
+        with self.changed:
+            while True:
+                if self.pending:
+                    return self.pending.popleft()
+                if self.closed or (self.outstanding == 0 and not self.keep_alive):
+                    return None
+                self.changed.wait()
+
+    def _finish(self, job_id, ok, result):
+        with self.changed:
+            self.outstanding -= 1
+            self.changed.notify_all()
+        self.finished.put((job_id, ok, result))
+
+    def _serve(self, connection):
+        """Hand out jobs to one worker until all jobs are done or it is lost."""
+        job = None
+        try:
+            while True:
+                message = connection.recv()
+
+                if message[0] == 'ready':
+                    job = self._next()
+                    if job is None:
+                        connection.send(('stop',))
+                        return
+                    job_id, attempts = job
+                    scenario, seed = self.jobs[job_id]
+                    connection.send(('job', job_id, self.function, scenario, seed, self.heartbeat))
+
+                    # Wait for the result, with heartbeats in between.
+                    while True:
+                        if not connection.poll(3 * self.heartbeat):
+                            raise TimeoutError("Worker missed its heartbeats.")
+                        message = connection.recv()
+                        if message[0] == 'heartbeat':
+                            continue
+                        if message[0] == 'result':
+                            self._finish(job_id, True, pickle.loads(zlib.decompress(message[2])))
+                        elif message[0] == 'error':
+                            self._finish(job_id, False, message[2])
+                        job = None
+                        break
+        except (EOFError, OSError, TimeoutError):
+            # Worker lost: give its job to another worker, if retries are left.
+            if job is not None:
+                job_id, attempts = job
+                if attempts < self.retries:
+                    with self.changed:
+                        self.pending.append((job_id, attempts + 1))
+                        self.changed.notify()
+                else:
+                    self._finish(job_id, False, "Worker lost {0} times.".format(attempts + 1))
+        finally:
+            connection.close()
+
+def sharedKey(authkey = None, address = None):
+    """Return the shared key (bytes) of a coordinator and its workers: authkey
+    if given, otherwise the DESASTER_AUTHKEY environment variable, otherwise,
+    for a coordinator listening on a loopback address, a new random key. Raises
+    AttributeError if there is no key (e.g., a coordinator listening on
+    ('0.0.0.0', port) without an explicit key).
+
+    Keyword Arguments:
+    authkey -- Shared key (bytes or string), or None
+    address -- (host, port) the coordinator listens on, or None for a worker
+    """
+    if authkey is None:
+        authkey = os.environ.get('DESASTER_AUTHKEY')
+    if authkey is not None:
+        return authkey.encode() if isinstance(authkey, str) else bytes(authkey)
+
+    if address is not None:
+        host = address[0]
+        try:
+            loopback = ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            loopback = host == 'localhost'
+        if loopback:
+            return os.urandom(32)
+        raise AttributeError("A coordinator listening on {0} needs an explicit authkey (or the "
+                                "DESASTER_AUTHKEY environment variable).".format(host))
+
+    raise AttributeError("No authkey given and DESASTER_AUTHKEY is not set.")
+
+def runWorker(address, authkey = None, preload = None):
+    """Connect to a Coordinator and run jobs until told to stop.
+
+    Keyword Arguments:
+    address -- (host, port) of the coordinator
+    authkey -- Shared key (bytes) of the coordinator (default: the
+                DESASTER_AUTHKEY environment variable)
+    preload -- Optional function called once before the first job, e.g., to
+                parse input files into a module-level cache
+    """
+    authkey = sharedKey(authkey)
+
+    import desaster
+
+    if preload is not None:
+        preload()
+
+    connection = Client(tuple(address), authkey = authkey)
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            connection.send(message)
+
+    try:
+        while True:
+            send(('ready',))
+            message = connection.recv()
+
+            # The coordinator answers when it has a job for this worker.
+            if message[0] == 'stop':
+                return
+
+            command, job_id, function, scenario, seed, heartbeat = message
+
+            # Send heartbeats while the job runs.
+            running = threading.Event()
+            def beat():
+                while not running.wait(heartbeat):
+                    send(('heartbeat',))
+            beater = threading.Thread(target = beat, daemon = True)
+            beater.start()
+
+            try:
+                result = function(scenario, seed)
+                reply = ('result', job_id, zlib.compress(pickle.dumps(result, protocol = pickle.HIGHEST_PROTOCOL)))
+            except Exception:
+                reply = ('error', job_id, traceback.format_exc())
+            finally:
+                running.set()
+                beater.join()
+
+            send(reply)
+    except (EOFError, OSError):
+        # Coordinator closed.
+        return
+    finally:
+        connection.close()
+
+def startLocalWorkers(address, workers, authkey = None, preload = None):
+    """Start worker processes on the local host.
+
+    Keyword Arguments:
+    address -- (host, port) of the coordinator
+    workers -- Number of worker processes
+    authkey -- Shared key (bytes) of the coordinator, e.g., its
+                Coordinator.authkey (default: the DESASTER_AUTHKEY environment
+                variable)
+    preload -- See runWorker()
+
+    Returns:
+    List of the started multiprocessing.Process objects.
+    """
+    authkey = sharedKey(authkey)
+    processes = []
+    for i in range(workers):
+        process = Process(target = runWorker, args = (address, authkey, preload), daemon = True)
+        process.start()
+        processes.append(process)
+
+    return processes
+
+def stopWorkers(coordinator, processes):
+    """Close a coordinator and wait for its local worker processes (from
+    startLocalWorkers()) to stop, killing any that don't.
+    """
+    coordinator.close()
+    for process in processes:
+        process.join(timeout = 1)
+        if process.is_alive():
+            # E.g., a hung worker whose job was given to another worker
+            process.kill()
+            process.join()
+
+class BatchRunner(object):
+    """A class to run batches of replications of named scenarios (e.g., for
+    sequential stopping or ranking and selection) on a keep-alive Coordinator
+    and local workers, collecting each scenario's results in replication order.
+    Replication i of every scenario uses seed + i.
+
+    Methods:
+    __init__(self, function, scenarios, seed = 0, measure = None, workers = None,
+                address = ('127.0.0.1', 0), authkey = None, retries = 2, heartbeat = 5.0)
+    submit(self, name, size)
+    next(self)
+    wait(self)
+    table(self, names = ('scenario', 'replication'))
+    close(self)
+    """
+    def __init__(self, function, scenarios, seed = 0, measure = None, workers = None,
+                    address = ('127.0.0.1', 0), authkey = None, retries = 2, heartbeat = 5.0):
+        """Initiate a BatchRunner object and start its coordinator and workers.
+        Use it as a context manager (or call close()) to stop them.
+
+        Keyword Arguments:
+        function -- See Coordinator()
+        scenarios -- Dictionary of scenarios keyed by name
+        seed -- Seed of replication 0
+        measure -- Optional function measure(result) applied to each result as
+                    it is received (e.g., to reduce it to a dictionary of metrics)
+        workers -- Number of local worker processes to start (default:
+                    os.cpu_count()); 0 to only use workers started separately
+        address, authkey, retries, heartbeat -- See Coordinator()
+
+        Attribute Changes:
+        self.results -- Dictionary of lists of results (by replication) keyed by
+                        scenario name
+        self.outstanding -- Dictionary of numbers of submitted jobs not yet
+                            completed, keyed by scenario name
+        self.running -- Dictionary of (scenario name, replication) by job id
+        """
+        self.scenarios = scenarios
+        self.seed = seed
+        self.measure = measure
+        self.results = {name: [] for name in scenarios}
+        self.outstanding = {name: 0 for name in scenarios}
+        self.running = {}
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.coordinator = Coordinator(function, [], address, authkey, retries, heartbeat,
+                                        keep_alive = True)
+        self.processes = startLocalWorkers(self.coordinator.address, workers, self.coordinator.authkey)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, name, size):
+        """Submit a scenario's next size replications; return their numbers."""
+        start = len(self.results[name])
+        replications = range(start, start + size)
+        self.results[name].extend([None] * size)
+        job_ids = self.coordinator.submit((self.scenarios[name], self.seed + i) for i in replications)
+        self.running.update(zip(job_ids, ((name, i) for i in replications)))
+        self.outstanding[name] += size
+        return list(replications)
+
+    def next(self):
+        """Wait for the next completed replication, store its (measured) result,
+        and return (scenario name, replication, result). If a job failed, the
+        workers are stopped and RuntimeError is raised.
+        """
+        try:
+            job_id, scenario, seed, result = self.coordinator.next()
+        except RuntimeError:
+            self.close()
+            raise
+
+        name, replication = self.running.pop(job_id)
+        if self.measure is not None:
+            result = self.measure(result)
+        self.results[name][replication] = result
+        self.outstanding[name] -= 1
+        return name, replication, result
+
+    def wait(self):
+        """Wait for all submitted replications."""
+        while self.running:
+            self.next()
+
+    def table(self, names = ('scenario', 'replication')):
+        """Return a dataframe of the results (e.g., dictionaries of metrics),
+        indexed by (scenario name, replication).
+        """
+        return pd.concat({name: pd.DataFrame(rows) for name, rows in self.results.items()},
+                            names = list(names))
+
+    def close(self):
+        """Stop the coordinator and the local workers."""
+        stopWorkers(self.coordinator, self.processes)
+
+def runEnsemble(function, jobs, workers = None, address = ('127.0.0.1', 0),
+                authkey = None, retries = 2, heartbeat = 5.0, combine = None):
+    """Run an ensemble of jobs on workers and return the results in job order,
+    or combined as they are completed.
+
+    Keyword Arguments:
+    function -- See Coordinator()
+    jobs -- List of (scenario, seed) pairs
+    workers -- Number of local worker processes to start (default:
+                os.cpu_count()). Use 0 to only use workers started separately
+                (e.g., on other hosts with 'python -m desaster.distributed').
+    address, authkey, retries, heartbeat -- See Coordinator()
+    combine -- Optional function combine(combined, result) that returns the
+                combination of two results (e.g., sketches.mergeSummaries), so
+                that results needn't all be kept
+
+    Returns:
+    List of results, one per job, or the combined result if combine is given.
+    """
+    coordinator = Coordinator(function, jobs, address, authkey, retries, heartbeat)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    processes = startLocalWorkers(coordinator.address, workers, coordinator.authkey)
+
+    try:
+        results = [None] * len(coordinator.jobs)
+        combined = None
+        for i, (job_id, scenario, seed, result) in enumerate(coordinator.results()):
+            if combine is None:
+                results[job_id] = result
+            else:
+                combined = result if i == 0 else combine(combined, result)
+    finally:
+        stopWorkers(coordinator, processes)
+
+    if combine is not None:
+        return combined
+    return results
+
+if __name__ == '__main__':
+    # Start a worker: DESASTER_AUTHKEY=... python -m desaster.distributed HOST:PORT
+    host, port = sys.argv[1].rsplit(':', 1)
+    runWorker((host, int(port)))
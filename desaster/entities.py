@@ -29,6 +29,8 @@ Landlord(Owner)
 """
 from desaster.structures import SingleFamilyResidential, Building
 from desaster.hazus import setContentsDamageValueHAZUS
+from desaster import streams
+from desaster.checkpoint import ProgramTask
 import names, warnings, sys
 from simpy import Container
 
@@ -85,6 +87,17 @@ class Entity(object):
         """Join list of story strings into a single story string."""
         return ''.join(self.story)
 
+    def __setattr__(self, name, value):
+        """Set an attribute, notifying the status.StatusCounter that counts the
+        entity (if any) when an attribute (e.g., a milestone) is first set.
+        """
+        attributes = self.__dict__
+        if value is not None and attributes.get(name) is None:
+            counter = attributes.get('_status_counter')
+            if counter is not None:
+                counter._reach(self, name)
+        attributes[name] = value
+
 class Owner(Entity):
     """An class that inherits from the Entity() class to represent any entity
     that owns property.  An owner does not necessarily have a residence (e.g., 
@@ -146,8 +159,14 @@ class Household(Entity):
     subclasses with Household() attributes. Also includes methods for writing 
     household stories.
 
+    The subclasses' find_home() and occupy() methods run findHomeStep() and
+    occupyStep() in a checkpoint.ProgramTask; pipeline.PipelineEngine runs the
+    same steps inline.
+
     Methods:
     __init__(self, env, name = None, savings = 0, insurance = 0, credit = 0, write_story = False)
+    findHomeStep(self, task, search_stock, duration, search_patience, preferences, event)
+    occupyStep(self, task, duration, event)
     writeResides(self):
     writeResides(self):
     writeResides(self):
@@ -189,7 +208,145 @@ class Household(Entity):
                                     # the entity vacates.
 
         self.writeResides()
-                            
+
+    def findHomeStep(self, task, search_stock, duration, search_patience, preferences,
+                        event):
+        """Advance the entity's search for a new home to buy (if the entity is an
+        Owner) or rent, held by task (a checkpoint.ProgramTask). See
+        OwnerHousehold.find_home() and RenterHousehold.find_home().
+
+        Keyword Arguments:
+        task -- The checkpoint.ProgramTask running the search
+        search_stock -- A SimPy FilterStore of homes for sale or rent
+        duration -- Distribution of the time to close on or move into the new home
+        search_patience -- The search duration in which the entity is willing to wait
+                            to find a new home.
+        preferences -- Dictionary of find_home() keyword arguments (e.g.,
+                        down_payment_pct, move_in_ratio, housing_ratio, price_pct,
+                        area_pct, rooms_tol); missing ones take find_home() defaults
+        event -- The processed event the search was waiting on
+
+        Returns:
+        The next event to wait on, or None when the search is finished.
+        """
+        env = self.env
+        owner = isinstance(self, Owner)
+
+        if task.sub == 0:
+            # Record when housing search starts
+            self.home_put = env.now
+
+            # Record current residence as prior residence, current property as
+            # prior property
+            if owner:
+                self.prior_properties.append(self.property)
+            if self.residence:
+                self.prior_residences.append(self.residence)
+
+            # Write the story
+            self.writeStartSearch()
+
+            # Define timeout process representing entity's patience for finding home.
+            task.patience = env.timeout(self.home_put + search_patience - env.now,
+                                        value = 'Gave up')
+            task.patience.callbacks.append(task._patienceExpired)
+
+            # Define a FilterStore.get process to find a new home to buy or rent
+            # with similar attributes as *original* home.
+            task.get = search_stock.get(_HomeFilter(self, owner,
+                                        preferences.get('rooms_tol', 0),
+                                        preferences.get('area_pct', 0.9),
+                                        preferences.get('price_pct', 1.1),
+                                        preferences.get('housing_ratio', 0.3)))
+            task.store = search_stock
+            task.sub = 1
+            return task.get
+
+        if event is task.patience or not event.ok:
+            # Patience ran out (or the search was interrupted); withdraw the
+            # get and put back a home found but not paid for.
+            task.withdraw()
+            if owner:
+                del self.prior_properties[0] # Didn't replace home, so delete from prior
+                del self.prior_residences[0] # Didn't replace home, so delete from prior
+            elif task.sub == 2 and self.residence:
+                del self.prior_residences[0] # Didn't replace home, so delete from prior
+            self.gave_up_home_search = env.now
+            self.writeGaveUp()
+            task.patience = None
+            return None
+
+        if task.sub == 1:
+            task.item = event.value
+            task.get = None
+
+            # Withdraw down payment or move in cost; wait for more funds if
+            # don't have it yet
+            if owner:
+                cost = preferences.get('down_payment_pct', 0.10) * task.item.value
+            else:
+                cost = preferences.get('move_in_ratio', 2.5) * task.item.monthly_cost
+
+            task.get = self.recovery_funds.get(cost)
+            task.container = self.recovery_funds
+            task.sub = 2
+            return task.get
+
+        if task.sub == 2:
+            task.get = None
+            task.container = None
+            task.patience = None
+
+            # Change listings of the current and new homes (see changeListing()).
+            if self.residence:
+                self.changeListing(listed = True)
+            self.changeListing(listed = False)
+
+            # Take a timeout equal to specified time to close home purchase or
+            # before can move in
+            task.sub = 3
+            return env.timeout(streams.sample(env, duration, self, 'find_home'))
+
+        # Set the newly found home as the entity's property and residence.
+        if owner:
+            self.property = task.item
+        self.residence = task.item
+        task.item = None
+        task.store = None
+
+        # Record the time that the housing search ends.
+        self.home_get = env.now
+
+        # If write_story is True, then write results of successful home search to
+        # entity's story.
+        if owner:
+            self.writeHomeBuy()
+        else:
+            self.writeHomeRent()
+        return None
+
+    def occupyStep(self, task, duration, event):
+        """Advance the entity's occupation of a residence, held by task (a
+        checkpoint.ProgramTask). See OwnerHousehold.occupy() and
+        RenterHousehold.occupy().
+
+        Returns:
+        The next event to wait on, or None when the residence is occupied.
+        """
+        if task.sub == 0:
+            self.occupy_put = self.env.now
+
+            # Yield timeout equivalent to time required to move back into home.
+            task.sub = 1
+            return self.env.timeout(streams.sample(self.env, duration, self, 'occupy'))
+
+        # Record time got home
+        self.occupy_get = self.env.now
+
+        #If true, write process outcome to story
+        self.writeOccupy()
+        return None
+
     def writeResides(self):
         if self.write_story:
             self.story.append('{0} resides at {1}. '.format(
@@ -296,99 +453,11 @@ class OwnerHousehold(Owner, Household):
                                     search patience runs out.
         self.story -- If write_story == True, append entity story strings
         """
-        # Record when housing search starts
-        # Calculate the time that housing search patience ends
-        # If write_story, write search start time to entity's story
-        self.home_put = self.env.now
-        patience_end = self.home_put + search_patience
-
-        # Record current residence as prior residence, current property as
-        # prior property
-        self.prior_properties.append(self.property)
-        if self.residence:
-            self.prior_residences.append(self.residence)
-        
-        # Write the story
-        self.writeStartSearch()
-        
-        # Define timeout process representing entity's patience for finding home.
-        # Return 'Gave up' if timeout process completes.
-        home_search_patience = self.env.timeout(patience_end - self.env.now,
-            value='Gave up')
-        
-        # Define a FilterStore.get process to find a new home to buy from the vacant
-        # for sale stock with similar attributes as *original* property.
-        new_home = search_stock.get(lambda findHome:
-                        findHome.damage_state == 'None'
-                        and findHome.occupancy.lower() == self.prior_properties[0].occupancy.lower()
-                        and (findHome.bedrooms >= self.prior_properties[0].bedrooms + rooms_tol
-                        or findHome.area >= self.prior_properties[0].area * area_pct)
-                        and (findHome.value <= self.prior_properties[0].value * price_pct
-                        or findHome.monthly_cost <= (self.income / 12.0) * housing_ratio)
-                        and findHome.listed == True
-                                    )
-    
-        # Yield both the patience timeout and the housing stock FilterStore get.
-        # Wait until one or the other process is completed.
-        # Assign the process that is completed first to the variable.
-        home_search_outcome = yield home_search_patience | new_home
-        
-        # Exit the function if the patience timeout completes before a suitable
-        # home is found in the housing stock.
-        if home_search_outcome == {home_search_patience: 'Gave up'}:
-            del self.prior_properties[0] # Didn't replace home, so delete from prior
-            del self.prior_residences[0] # Didn't replace home, so delete from prior
-            self.gave_up_home_search = self.env.now
-            self.writeGaveUp()
-            return
-        
-        # Define timeout process representing entity's *remaining* search patience.
-        # Return 'Gave up' if timeout process completes.
-        down_payment_patience = self.env.timeout(patience_end - self.env.now,
-                                                value='Gave up')
-
-        # Withdraw 10% down payment; wait for more funds if don't have it yet
-        down_payment = down_payment_pct * home_search_outcome[new_home].value
-        get_down_payment = self.recovery_funds.get(down_payment)
-        
-        # Yield both the remaining patience timeout and down payment get.
-        down_payment_outcome = yield down_payment_patience | get_down_payment
-        
-        # Exit the function if the patience timeout completes before a suitable
-        # home is found in the housing stock.
-        if down_payment_outcome == {down_payment_patience: 'Gave up'}:
-            yield search_stock.put(home_search_outcome[new_home]) # Didn't buy it afterall
-            del self.prior_properties[0] # Didn't replace home, so delete from prior
-            del self.prior_residences[0] # Didn't replace home, so delete from prior
-            self.gave_up_home_search = self.env.now
-            self.writeGaveUp()
-            return
-        
-        # If a new home is found before patience runs out set current property's
-        # listed attributed to True -- put home up for sale.
-        # get and put from FilterStore to tell SimPy object's state changed
-        if self.property:
-            self.changeListing(listed = True)
-        
-        # Take new home off the market and place back in housing stock
-        # (in orde for SimPy to register the resource state change)
-        self.changeListing(listed = False)
-        
-        # Take a timeout equal to specified time to close home purchase
-        yield self.env.timeout(duration.rvs())
-        
-        # Set the newly found home as the entity's property.
-        self.property = home_search_outcome[new_home]
-
-        # Make the entity's property also their residence
-        self.residence = self.property
-        
-        # Record the time that the housing search ends.
-        self.home_get = self.env.now
+        preferences = {'down_payment_pct': down_payment_pct, 'housing_ratio': housing_ratio,
+                        'price_pct': price_pct, 'area_pct': area_pct, 'rooms_tol': rooms_tol}
 
-        # If write_story is True, then write results of successful home search to
-        # entity's story.
-        self.writeHomeBuy()
+        yield from ProgramTask(self.env, self.findHomeStep, search_stock, duration,
+                                search_patience, preferences).join()
 
     def changeListing(self, listed):
         get_home = yield self.property.stock.get(lambda getHome:
@@ -415,19 +484,10 @@ class OwnerHousehold(Owner, Household):
         self.occupy_put -- Recording beginning of occupany duration.
         self.occupy_get -- Record time of occupancy
         """
-        self.occupy_put = self.env.now
-
-        # Yield timeout equivalent to time required to move back into home.
-        yield self.env.timeout(duration.rvs())
-
-        # Record time got home
-        self.occupy_get = self.env.now
-
-        #If true, write process outcome to story
-        self.writeOccupy()
+        yield from ProgramTask(self.env, self.occupyStep, duration).join()
 
         if callbacks is not None:
-            yield self.env.process(callbacks)
+            yield from callbacks
         else:
             pass
 
@@ -532,94 +592,12 @@ class RenterHousehold(Household):
                                     search patience runs out.
         self.story -- If write_story == True, append entity story strings
         """
-        # Record when housing search starts
-        # Calculate the time that housing search patience ends
-        # If write_story, write search start time to entity's story
-        self.home_put = self.env.now
-        patience_end = self.home_put + search_patience
-
-        # Put current residence as a prior residence
-        if self.residence:
-            self.prior_residences.append(self.residence)
-        
-        # Define timeout process representing entity's *remaining* search patience.
-        # Return 'Gave up' if timeout process completes.
-        find_search_patience = self.env.timeout(patience_end - self.env.now,
-            value='Gave up')
-
-        self.writeStartSearch()
-        
-        # Define a FilterStore.get process to find a new home to rent from the vacant
-        # for rent stock with similar attributes as original residence.
-        new_home = search_stock.get(lambda findHome:
-                        findHome.damage_state == 'None'
-                        and findHome.occupancy.lower() == self.prior_residences[0].occupancy.lower()
-                        and (findHome.bedrooms >= self.prior_residences[0].bedrooms + rooms_tol
-                        or findHome.area >= self.prior_residences[0].area * area_pct)
-                        and findHome.monthly_cost <= (self.income / 12.0) * housing_ratio
-                        and findHome.listed == True
-                                    )
-        
-        # Yield both the patience timeout and the housing stock FilterStore get.
-        # Wait until one or the other process is completed.
-        # Assign the process that is completed first to the variable.
-        home_search_outcome = yield find_search_patience | new_home
-
-        # Exit the function if the patience timeout completes before a suitable
-        # home is found in the housing stock.
-        if home_search_outcome == {find_search_patience: 'Gave up'}:
-            self.gave_up_home_search = self.env.now
-            # If write_story, note in the story that the entity gave up
-            # the search.
-            self.writeGaveUp()
-            return
-
-        # Define timeout process representing entity's *remaining* search patience.
-        # Return 'Gave up' if timeout process completes.
-        move_in_cost_patience = self.env.timeout(patience_end - self.env.now,
-                                                value='Gave up')
-
-        # Withdraw 10% down payment; wait for more funds if don't have it yet
-        move_in_cost = move_in_ratio * home_search_outcome[new_home].monthly_cost
-        
-        get_move_in_cost = self.recovery_funds.get(move_in_cost)
-        
-        # Yield both the remaining patience timeout and down payment get.
-        move_in_cost_outcome = yield move_in_cost_patience | get_move_in_cost
-        
-        # Exit the function if the patience timeout completes before a suitable
-        # home is found in the housing stock.
-        if move_in_cost_outcome == {move_in_cost_patience: 'Gave up'}:
-            yield search_stock.put(home_search_outcome[new_home]) # Didn't buy it afterall
-            # Put current residence as a prior residence
-            if self.residence:
-                del self.prior_residences[0] # Didn't replace home, so delete from prior
-            self.gave_up_home_search = self.env.now
-            self.writeGaveUp()
-            return
-        
-        # If a new home is found before patience runs change current residence's 
-        # listed state to True to indicate residence is for rent (if tenant has a 
-        # residence)
-        if self.residence:
-            self.changeListing(listed = True)
-
-        # Set the newly found home as the entity's residence.
-        self.changeListing(listed = False)
-        
-        # Take a timeout equal to specified to notice time before can move in
-        yield self.env.timeout(duration.rvs())
-        
-        # Set newly found home as residence
-        self.residence = home_search_outcome[new_home]
+        preferences = {'move_in_ratio': move_in_ratio, 'housing_ratio': housing_ratio,
+                        'area_pct': area_pct, 'rooms_tol': rooms_tol}
 
-        # Record the time that the housing search ends.
-        self.home_get = self.env.now
+        yield from ProgramTask(self.env, self.findHomeStep, search_stock, duration,
+                                search_patience, preferences).join()
 
-        # If write_story is True, then write results of successful home search to
-        # entity's story.
-        self.writeHomeRent()
-        
     def changeListing(self, listed):
         get_home = yield self.residence.stock.get(lambda getHome:
                                                     getHome.__dict__ == self.property.__dict__
@@ -646,26 +624,13 @@ class RenterHousehold(Household):
         self.occupy_put -- Recording beginning of occupany duration.
         self.occupy_get -- Record time of occupancy
         """
-
-        self.occupy_put = self.env.now
-        ####
-        #### Hopefully put code here for checking if renter can still afford
-        #### the rent. Obviously need a function somewhere that estimates rent increases.
-        ####
-
-        # Yield timeout equivalent to time required to move back into home.
-        yield self.env.timeout(duration.rvs())
-
-        # Record time got home
-        self.occupy_get = self.env.now
-
-        self.writeOccupy()
+        yield from ProgramTask(self.env, self.occupyStep, duration).join()
 
         if callbacks is not None:
-            yield self.env.process(callbacks)
+            yield from callbacks
         else:
-            pass    
-        
+            pass
+
     def writeInitiateRenterHousehold(self):    
         if self.write_story:
             self.story.append(
@@ -744,3 +709,33 @@ class Landlord(Owner):
                                                                                     )
                                         )  
 
+class _HomeFilter(object):
+    """FilterStore filter for a home to buy or rent similar to the entity's
+    *original* home (picklable, unlike a lambda, so searches can be checkpointed).
+    """
+    __slots__ = ('entity', 'owner', 'rooms_tol', 'area_pct', 'price_pct', 'housing_ratio')
+
+    def __init__(self, entity, owner, rooms_tol, area_pct, price_pct, housing_ratio):
+        self.entity = entity
+        self.owner = owner
+        self.rooms_tol = rooms_tol
+        self.area_pct = area_pct
+        self.price_pct = price_pct
+        self.housing_ratio = housing_ratio
+
+    def __call__(self, home):
+        entity = self.entity
+        if self.owner:
+            prior = entity.prior_properties[0]
+            affordable = (home.value <= prior.value * self.price_pct
+                            or home.monthly_cost <= (entity.income / 12.0) * self.housing_ratio)
+        else:
+            prior = entity.prior_residences[0]
+            affordable = home.monthly_cost <= (entity.income / 12.0) * self.housing_ratio
+
+        return (home.damage_state == 'None'
+                and home.occupancy.lower() == prior.occupancy.lower()
+                and (home.bedrooms >= prior.bedrooms + self.rooms_tol
+                    or home.area >= prior.area * self.area_pct)
+                and affordable
+                and home.listed == True)
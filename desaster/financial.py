@@ -18,6 +18,9 @@
 """
 from simpy import Interrupt
 from simpy import Resource, Container
+from desaster.service import BatchedService
+from desaster import streams
+from desaster.checkpoint import ProgramTask
 import numpy as np
 
 
@@ -30,15 +33,23 @@ class FinancialRecoveryProgram(object):
     useless and should only be used as an example of how to implement a process in a
     subclass of  FinancialRecoveryProgram.
     
+    The subclasses' process() methods run step(), the program's logic for one
+    request, in a checkpoint.ProgramTask; pipeline.PipelineEngine and
+    policies.FinancialRecoveryPolicy.searchStep() run the same step().
+
     Methods:
     __init__
     process(self, entity = None, callbacks = None):
+    giveUp(self, task, entity):
     writeCompleted(self, entity):
     writeGaveUp(self, entity, recovery_program):
     writeWithdraw(self, entity, recovery_program):
     
     
     """
+    # Name of the program's provider in entities' stories (e.g., 'FEMA')
+    provider = 'the program'
+
     def __init__(self, env, duration, staff=float('inf'), budget=float('inf')):
         """Initiate financial recovery program attributes.
 
@@ -54,11 +65,14 @@ class FinancialRecoveryProgram(object):
         self.budget -- A simpy.Container() object with a initial value == budget arg
         self.duration -- A function that is used to calculate random durations
                             for the program process
+        self.stream -- Name of the program's random number streams (see
+                            streams.streamName())
         """
         self.env = env
         self.staff = Resource(self.env, capacity=staff)
         self.budget = Container(self.env, init=budget)
         self.duration = duration
+        self.stream = streams.streamName(env, self.__class__.__name__)
 
     def process(self, entity = None, callbacks = None):
         """Define generic financial recovery program process for entity.
@@ -84,7 +98,7 @@ class FinancialRecoveryProgram(object):
         yield staff_request
 
         # Yield timeout equivalent to program's process duration
-        yield self.env.timeout(self.duration.rvs())
+        yield self.env.timeout(streams.sample(self.env, self.duration, entity, self.stream))
 
         # Release release staff after process duation is complete.
         self.staff.release(staff_request)
@@ -100,10 +114,19 @@ class FinancialRecoveryProgram(object):
         self.writeCompleted(entity)
 
         if callbacks is not None:
-            yield self.env.process(callbacks)
+            yield from callbacks
         else:
             pass
             
+    def giveUp(self, task, entity):
+        """Withdraw an entity's request (held by task, a checkpoint.ProgramTask)
+        when it is interrupted, e.g., because the entity's search patience ran
+        out: cancel waiting staff requests and gets, release staff, and return
+        funds not yet received.
+        """
+        task.withdraw()
+        self.writeGaveUp(entity, self.provider)
+
     def writeCompleted(self, entity):
         if entity.write_story:
             entity.story.append("{0} process completed for {1} after {2} days, leaving a program budget of ${3:,.0f}. ".format(
@@ -133,11 +156,14 @@ class HousingAssistanceFEMA(FinancialRecoveryProgram):
     Methods:
     __init__
     process(self, entity, callbacks = None):
+    step(self, task, entity, event):
     writeDeadline(self, entity):
     writeRequest(self, entity):
     writeReceived(self, entity):
 
     """
+    provider = 'FEMA'
+
     def __init__(self, env, duration, staff=float('inf'), budget=float('inf'),
                 max_outlay=float('inf'), declaration=0, deadline=540):
         """Initiate FEMA individual assistance recovery program attributes.
@@ -178,9 +204,27 @@ class HousingAssistanceFEMA(FinancialRecoveryProgram):
         entity.fema_get -- Records sim time of fema assistance reciept
         entity.fema_amount -- Amount of FEMA aid given to the entity.
         """
-        # Exception handling in case interrupted by another process.
-        try:
-            
+        yield from ProgramTask(self.env, self.step, entity).join()
+
+        if callbacks is not None:
+            yield from callbacks
+        else:
+            pass
+
+    def step(self, task, entity, event):
+        """Advance an entity's request for FEMA individual assistance, held by
+        task (a checkpoint.ProgramTask); return the next event to wait on, or
+        None when the request is finished.
+        """
+        env = self.env
+        sub = task.sub
+
+        # Handle an interrupt from another process.
+        if event is not None and not event.ok:
+            self.giveUp(task, entity)
+            return None
+
+        if sub == 0:
             # Calculate assistance request.
             # Must subtract any insurance payout from FEMA payout and choose the lesser of
             # max assistance and deducted total
@@ -189,31 +233,41 @@ class HousingAssistanceFEMA(FinancialRecoveryProgram):
 
             #Ensure that entity does not have enough money already.
             if entity.fema_amount <= 0.0:
-                return
-            
+                return None
+
             # Check to see declaration has occurred; if not, wait
-            if self.env.now < self.declaration:
-                yield self.env.timeout(self.declaration - self.env.now)
-            
+            sub = 1
+            if env.now < self.declaration:
+                task.sub = 1
+                return env.timeout(self.declaration - env.now)
+
+        if sub == 1:
             # Record time requests FEMA assistance.
-            entity.fema_put = self.env.now
-            
+            entity.fema_put = env.now
+
             # Check to see if missed application deadline
-            if self.env.now > self.deadline:
-                self.writeDeadline(entity)    
-                return # Application rejected, end process
-            
+            if env.now > self.deadline:
+                self.writeDeadline(entity)
+                return None # Application rejected, end process
+
             self.writeRequest(entity)
 
             # Request a FEMA processor to review aid application.
-            request = self.staff.request()
-            yield request
-            
+            task.request = self.staff.request()
+            task.resource = self.staff
+            task.sub = 2
+            return task.request
+
+        if sub == 2:
             # Yield timeout for duration necessary to process FEMA aid request.
-            yield self.env.timeout(self.duration.rvs())
-            
+            task.sub = 3
+            return env.timeout(streams.sample(env, self.duration, entity, self.stream))
+
+        if sub == 3:
             # Release FEMA processors.
-            self.staff.release(request)
+            self.staff.release(task.request)
+            task.request = None
+            task.resource = None
 
             # Update assistance request in case of funding from parallel insurance process
             entity.fema_amount = min(self.max_outlay, (entity.property.damage_value
@@ -221,29 +275,26 @@ class HousingAssistanceFEMA(FinancialRecoveryProgram):
 
             if entity.fema_amount <= 0:
                 self.writeWithdraw(entity, 'FEMA')
-                return
+                return None
 
             # Request payout amount from FEMA budget
             # Must wait for request to be fulfilled
-            yield self.budget.get(entity.fema_amount)
-            
-            yield entity.recovery_funds.put(entity.fema_amount)
+            task.get = self.budget.get(entity.fema_amount)
+            task.container = self.budget
+            task.sub = 4
+            return task.get
 
-            # Record time received FEMA assistance.
-            entity.fema_get = self.env.now
-            
-            self.writeReceived(entity)
+        if sub == 4:
+            task.get = None
+            task.container = None
+            task.sub = 5
+            return entity.recovery_funds.put(entity.fema_amount)
 
-        # Catch any interrupt from another process.
-        except Interrupt as i:
-            #If true, write process outcome to story.
-            if entity.write_story:
-                self.writeGaveUp(entity, 'FEMA')
+        # Record time received FEMA assistance.
+        entity.fema_get = env.now
 
-        if callbacks is not None:
-            yield self.env.process(callbacks)
-        else:
-            pass
+        self.writeReceived(entity)
+        return None
 
     def writeDeadline(self, entity):
         if entity.write_story:
@@ -277,6 +328,8 @@ class OwnersInsurance(FinancialRecoveryProgram):
     Methods:
     __init__
     process(self, entity, callbacks = None):
+    step(self, task, entity, event):
+    deductibleAmount(self, entity):
     writeNoInsurance(self, entity):
     writeRequest(self, entity):
     writeDeductible(self, entity):
@@ -285,6 +338,8 @@ class OwnersInsurance(FinancialRecoveryProgram):
     Inheritance:
     financial.FinancialRecoveryProgram
     """
+    provider = 'their insurance company'
+
     def __init__(self, env, duration, staff=float('inf'), budget=float('inf'),
                 deductible=0.0):
         """Initiate owners insurance recovery program.
@@ -321,64 +376,87 @@ class OwnersInsurance(FinancialRecoveryProgram):
         entity.claim_get -- Record env time when entity recieves payout
         entity.story -- Append natural language sentences to entities story.
         """
-        # Exception handling in case interrupted by another process.
-        try:
-            # Ensure entity has insurance.
-            if entity.insurance <= 0.0:
-                self.writeNoInsurance(entity)
-                return
-
-            # Has insurance so submits a claim.
-            else:
-                # Record time that claim request is put.
-                entity.claim_put = self.env.now
-
-                #If true, write claim submission time to story.
-                self.writeRequest(entity)
-
-                # The insurance deductible amount is the home value multiplied by the
-                # coverage ratio multipled by the deductible percentage.
-                deductible_amount = entity.property.value * entity.insurance * self.deductible
-
-                # Determine payout amount and add to entity's repair money.
-                # Only payout amount equal to the damage, not the full coverage.
-                if entity.property.damage_value < deductible_amount:
-                    self.writeDeductible(entity)
-                    return
-
-                # If damage > deductible, submit request for insurance adjusters.
-                request = self.staff.request()
-                yield request
-
-                # Timeout process to simulate claims processing duration.
-                yield self.env.timeout(self.duration.rvs())
-
-                # Release insurance adjusters so they can process other claims.
-                self.staff.release(request)
+        yield from ProgramTask(self.env, self.step, entity).join()
 
-                entity.claim_amount = entity.property.damage_value - deductible_amount
+        if callbacks is not None:
+            yield from callbacks
+        else:
+            pass
 
-                # Make request for the claim amount from the insurance budget
-                # If get request, add to entity money to repair
-                yield self.budget.get(entity.claim_amount)
+    def step(self, task, entity, event):
+        """Advance an entity's insurance claim, held by task (a
+        checkpoint.ProgramTask); return the next event to wait on, or None when
+        the claim is finished.
+        """
+        env = self.env
+        sub = task.sub
 
-                yield entity.recovery_funds.put(entity.claim_amount)
+        # Handle an interrupt from another process.
+        if event is not None and not event.ok:
+            self.giveUp(task, entity)
+            return None
 
-                # Record when the time when entity gets claim payout
-                entity.claim_get = self.env.now
+        if sub == 0:
+            # Ensure entity has insurance.
+            if entity.insurance <= 0.0:
+                self.writeNoInsurance(entity)
+                return None
 
-                self.writeReceived(entity)
+            # Has insurance so submits a claim.
+            # Record time that claim request is put.
+            entity.claim_put = env.now
 
-        # Handle any interrupt thrown by another process.
-        except Interrupt as i:
-            #If true, write that the process was interrupted to the story.
-            if entity.write_story:
-                self.writeGaveUp(entity, 'their insurance company')
+            #If true, write claim submission time to story.
+            self.writeRequest(entity)
 
-        if callbacks is not None:
-            yield self.env.process(callbacks)
-        else:
-            pass
+            # Determine payout amount and add to entity's repair money.
+            # Only payout amount equal to the damage, not the full coverage.
+            if entity.property.damage_value < self.deductibleAmount(entity):
+                self.writeDeductible(entity)
+                return None
+
+            # If damage > deductible, submit request for insurance adjusters.
+            task.request = self.staff.request()
+            task.resource = self.staff
+            task.sub = 1
+            return task.request
+
+        if sub == 1:
+            # Timeout process to simulate claims processing duration.
+            task.sub = 2
+            return env.timeout(streams.sample(env, self.duration, entity, self.stream))
+
+        if sub == 2:
+            # Release insurance adjusters so they can process other claims.
+            self.staff.release(task.request)
+            task.request = None
+            task.resource = None
+
+            entity.claim_amount = entity.property.damage_value - self.deductibleAmount(entity)
+
+            # Make request for the claim amount from the insurance budget
+            # If get request, add to entity money to repair
+            task.get = self.budget.get(entity.claim_amount)
+            task.container = self.budget
+            task.sub = 3
+            return task.get
+
+        if sub == 3:
+            task.get = None
+            task.container = None
+            task.sub = 4
+            return entity.recovery_funds.put(entity.claim_amount)
+
+        # Record when the time when entity gets claim payout
+        entity.claim_get = env.now
+
+        self.writeReceived(entity)
+        return None
+
+    def deductibleAmount(self, entity):
+        # The insurance deductible amount is the home value multiplied by the
+        # coverage ratio multipled by the deductible percentage.
+        return entity.property.value * entity.insurance * self.deductible
 
     def writeNoInsurance(self, entity):
         if entity.write_story:
@@ -414,6 +492,7 @@ class RealPropertyLoanSBA(FinancialRecoveryProgram):
     Methods:
     __init__
     process(self, entity, callbacks = None):
+    step(self, task, entity, event):
     setLoanAmount(self, entity):
     writeDeadline(self, entity):
     writeApplied(self, entity):
@@ -426,10 +505,12 @@ class RealPropertyLoanSBA(FinancialRecoveryProgram):
     Inheritance:
     financial.FinancialRecoveryProgram
     """
+    provider = 'SBA'
+
     def __init__(self, env, duration, inspectors=float('inf'),
                 officers=float('inf'), budget = float('inf'), max_loan = float('inf'),
                 min_credit = 0, debt_income_ratio = 0.2, loan_term = 30.0,
-                interest_rate = 0.04, declaration = 0, deadline = 60):
+                interest_rate = 0.04, declaration = 0, deadline = 60, service_window = None):
 
         """Initiate SBA real property loan recovery program.
 
@@ -449,6 +530,9 @@ class RealPropertyLoanSBA(FinancialRecoveryProgram):
         deadline -- A value indicating how many days after the
                                 federal disaster declaration was made the applications
                                 must be submitted.
+        service_window -- If not None, applications are reviewed and inspected in
+                            batches, once per window (e.g., 1.0 for daily); see
+                            service.BatchedService()
 
         """
         FinancialRecoveryProgram.__init__(self, env, duration, budget)
@@ -457,6 +541,16 @@ class RealPropertyLoanSBA(FinancialRecoveryProgram):
         self.officers = Resource(self.env, capacity=officers)
         self.inspectors = Resource(self.env, capacity=inspectors)
 
+        # Batched service of loan officers and inspectors, if any
+        self.service_window = service_window
+
+        if service_window is not None:
+            self.officer_service = BatchedService(self.env, self, 'officers', service_window)
+            self.inspector_service = BatchedService(self.env, self, 'inspectors', service_window)
+        else:
+            self.officer_service = None
+            self.inspector_service = None
+
         # New attributes
         self.min_credit = min_credit
         self.debt_income_ratio = debt_income_ratio
@@ -480,106 +574,189 @@ class RealPropertyLoanSBA(FinancialRecoveryProgram):
         entity.sba_amount -- The amount of loan requested.
         entity.story -- Append natural language sentences to entities story.
         """
-        # Exception handling in case interrupted by another process.
-        try:
+        yield from ProgramTask(self.env, self.step, entity).join()
+
+        if callbacks is not None:
+            yield from callbacks
+        else:
+            pass
+
+    def step(self, task, entity, event):
+        """Advance an entity's SBA loan application, held by task (a
+        checkpoint.ProgramTask); return the next event to wait on, or None when
+        the application is finished.
+        """
+        env = self.env
+        sub = task.sub
+
+        # Handle an interrupt from another process.
+        if event is not None and not event.ok:
+            self.giveUp(task, entity)
+            return None
+
+        if sub == 0:
             # Check to see declaration has occurred; if not, wait
-            if self.env.now < self.declaration:
-                yield self.env.timeout(self.declaration - self.env.now)
-            
+            sub = 1
+            if env.now < self.declaration:
+                task.sub = 1
+                return env.timeout(self.declaration - env.now)
+
+        if sub == 1:
             # Record time application submitted.
-            entity.sba_put = self.env.now
+            entity.sba_put = env.now
 
             # Call function to set entity.sba_amount
             entity.sba_amount = self.setLoanAmount(entity)
-            
+
             # Ensure entity does not have enough funds.
             if entity.sba_amount <= 0:
-                return # Don't qualify for or need SBA loan, end process
-            
+                return None # Don't qualify for or need SBA loan, end process
+
             # Check to see if missed application deadline
-            if self.env.now > self.deadline:
-                self.writeDeadline(entity)    
-                return # Application rejected, end process
+            if env.now > self.deadline:
+                self.writeDeadline(entity)
+                return None # Application rejected, end process
 
             self.writeApplied(entity)
 
-            # Request a loan processor.
-            officer_request = self.officers.request()
-            yield officer_request
-
-            # # Yield process timeout for duration needed for officer to process application.
-            yield self.env.timeout(self.duration.rvs())
+            if self.officer_service is not None:
+                # Wait for the application to be reviewed in a batch with others.
+                task.request = self.officer_service.request(streams.sample(env, self.duration, entity, self.stream))
+                task.resource = self.officer_service
+                task.sub = 12
+                return task.request
 
+            # Request a loan processor.
+            task.request = self.officers.request()
+            task.resource = self.officers
+            task.sub = 2
+            return task.request
+
+        if sub == 12:
+            # Application assigned to an officer; wait for its review.
+            task.request = None
+            task.resource = None
+            task.sub = 13
+            return event.value
+
+        if sub == 13:
             if entity.credit < self.min_credit:
                 self.writeDeniedCredit(entity)
-                return
+                return None
+
+            # If approved (enough credit), wait for a batched inspection.
+            task.request = self.inspector_service.request(1) # Assumed 1 day inspection duration.
+            task.resource = self.inspector_service
+            task.sub = 14
+            return task.request
+
+        if sub == 14:
+            task.request = None
+            task.resource = None
+            task.sub = 15
+            return event.value
+
+        if sub == 15:
+            sub = 5
+
+        if sub == 2:
+            # Yield process timeout for duration needed for officer to process application.
+            task.sub = 3
+            return env.timeout(streams.sample(env, self.duration, entity, self.stream))
+
+        if sub == 3:
+            # Release loan officer so that they can process other loans (also if
+            # the application is denied).
+            self.officers.release(task.request)
+            task.request = None
+            task.resource = None
 
-            # Release loan officer so that they can process other loans.
-            self.officers.release(officer_request)
+            if entity.credit < self.min_credit:
+                self.writeDeniedCredit(entity)
+                return None
 
             # If approved (enough credit), request an inspector. Then release it.
             # %%% This increases duration by amount of time it takes
             # to get an inspector. Duration of 1 day assumed, currently. %%%%
-            inspector_request = self.inspectors.request()
-            yield inspector_request
-            yield self.env.timeout(1) # Assumed 1 day inspection duration.
-            self.inspectors.release(inspector_request)
+            task.request = self.inspectors.request()
+            task.resource = self.inspectors
+            task.sub = 4
+            return task.request
+
+        if sub == 4:
+            task.sub = 5
+            return env.timeout(1) # Assumed 1 day inspection duration.
+
+        if sub == 5:
+            if task.request is not None:
+                self.inspectors.release(task.request)
+                task.request = None
+                task.resource = None
 
             # Update loan amount (in case other processes in parallel)
             entity.sba_amount = self.setLoanAmount(entity)
-            
+
             self.writeInspected(entity)
 
             if entity.sba_amount <= 0:
                 self.writeWithdraw(entity, 'SBA')
-                return
+                return None
 
             # If loan amount is greater than $25k, it requires collateral and more paperwork
             if entity.sba_amount > 25000:
-                
                 # Receives $25k immediately as initial disbursement
-                yield self.budget.get(25000)
-                yield entity.recovery_funds.put(25000)
-                
-                self.writeFirstDisbursement(entity)
-                
-                #
-                # %%%% EVENTUALLY MAKE WAIT FOR A BUILDING PERMIT TO BE ISSUED %%%
-                # %%% FOR NOW: Yield another timeout equal to initial process application duration %%%
-                #
-
-                yield self.env.timeout(self.duration.rvs())
-
-                # Update loan amount (in case other processes in parallel)
-                entity.sba_amount = self.setLoanAmount(entity)
-
-                if entity.sba_amount <= 0:
-                    self.writeWithdraw(entity, 'SBA')
-                    return
-
-                yield self.budget.get(entity.sba_amount - 25000)
-                yield entity.recovery_funds.put(entity.sba_amount - 25000)
-
-                self.writeSecondDisbursement(entity)
-
-            else:
-                
-                # Add loan amount to entity's money to repair.
-                yield entity.recovery_funds.put(entity.sba_amount)
+                task.get = self.budget.get(25000)
+                task.container = self.budget
+                task.sub = 6
+                return task.get
+
+            # Add loan amount to entity's money to repair.
+            task.sub = 10
+            return entity.recovery_funds.put(entity.sba_amount)
+
+        if sub == 6:
+            task.get = None
+            task.container = None
+            task.sub = 7
+            return entity.recovery_funds.put(25000)
+
+        if sub == 7:
+            self.writeFirstDisbursement(entity)
+
+            #
+            # %%%% EVENTUALLY MAKE WAIT FOR A BUILDING PERMIT TO BE ISSUED %%%
+            # %%% FOR NOW: Yield another timeout equal to initial process application duration %%%
+            #
+            task.sub = 8
+            return env.timeout(streams.sample(env, self.duration, entity, self.stream))
+
+        if sub == 8:
+            # Update loan amount (in case other processes in parallel)
+            entity.sba_amount = self.setLoanAmount(entity)
 
-                self.writeOnlyDisbursement(entity)
+            if entity.sba_amount <= 0:
+                self.writeWithdraw(entity, 'SBA')
+                return None
 
-            # Record time full loan is approved.
-            entity.sba_get = self.env.now
+            task.get = self.budget.get(entity.sba_amount - 25000)
+            task.container = self.budget
+            task.sub = 9
+            return task.get
 
-        # Handle any interrupt from another process.
-        except Interrupt as i:
-            self.writeGaveUp(entity, 'SBA')
+        if sub == 9:
+            task.get = None
+            task.container = None
+            task.sub = 11
+            return entity.recovery_funds.put(entity.sba_amount - 25000)
 
-        if callbacks is not None:
-            yield self.env.process(callbacks)
+        if sub == 10:
+            self.writeOnlyDisbursement(entity)
         else:
-            pass
+            self.writeSecondDisbursement(entity)
+
+        # Record time full loan is approved.
+        entity.sba_get = env.now
+        return None
 
     def setLoanAmount(self, entity):
         required_loan = max(0, entity.property.damage_value - entity.claim_amount - entity.fema_amount)
@@ -113,7 +113,7 @@ def setContentsDamageValueHAZUS(building):
     if building.damage_state.lower() == 'complete':
         return 0.5*(building.area*30)
 
-def setRecoveryLimitState(building):
+def setRecoveryLimitState(building, random_streams = None):
     """ A function to set a building's recovery-based limit state.
     
     The function take a building's HAZUS-based damage state and maps it to a 
@@ -122,6 +122,9 @@ def setRecoveryLimitState(building):
     
     Arguments:
     building -- a desaster.structures.Building object
+    random_streams -- Optional streams.RandomStreams() to draw from (the
+                    building's stream, keyed by its address) instead of the
+                    global random number generator
     
     Attribute Changes:
     building.recovery_limit_state
@@ -129,6 +132,10 @@ def setRecoveryLimitState(building):
     """
     recovery_limit_state_dist = rv_discrete(values=([0, 1, 2, 3, 4],
                                 recovery_limit_states.loc[building.damage_state].values))
-    recovery_limit_state_code = recovery_limit_state_dist.rvs()
+    if random_streams is None:
+        recovery_limit_state_code = recovery_limit_state_dist.rvs()
+    else:
+        recovery_limit_state_code = int(random_streams.draw(recovery_limit_state_dist,
+                                                building.address, 'recovery_limit_state'))
     code_label_lookup = {0: 'Functional', 1: 'Disfunctional', 2: 'Unsafe', 3: 'Irreparable', 4: 'Collapse'}
     building.recovery_limit_state = code_label_lookup[recovery_limit_state_code]
@@ -19,12 +19,24 @@ Module of classes and functions for input/output related to DESaster.
 Classes:
 importSingleFamilyResidenceStock
 
+Functions:
+importEntities
+output_summary
+households_to_df
+milestone_curves
+parseBool
+validateEntities
+convertInputs
+readInputs
+importEntitiesChunked
+
 @author: Scott Miles (milessb@uw.edu), Derek Huling
 """
 from scipy.stats import uniform, beta, weibull_min
 from simpy import FilterStore
 from desaster.entities import Owner, Household, OwnerHousehold, RenterHousehold, Landlord
 from desaster.structures import SingleFamilyResidential, Building
+from desaster import hazus
 import pandas as pd
 import numpy as np
 
@@ -44,7 +56,8 @@ def importSingleFamilyResidenceStock(env, stock_df):
 
     return stock_fs
 
-def importEntities(env, entities_df, entity_type, building_stock = None, write_story = False):
+def importEntities(env, entities_df, entity_type, building_stock = None, write_story = False,
+                    validate = False, random_streams = None):
     """Return list of entities.OwnerHouseholds() objects from dataframe containing
     data describing entities' attributes.
 
@@ -54,14 +67,22 @@ def importEntities(env, entities_df, entity_type, building_stock = None, write_s
     entities_df -- Dataframe row w/ entities' input attributes.
     entity_type -- Indicate class of entity: Household, Owner, OwnerHousehold etc.
     write_story -- Boolean indicating whether to track a entities story.
+    validate -- Whether to check entities_df with validateEntities() first (all
+                problems are reported at once) and then skip the per-row checks.
+    random_streams -- Optional streams.RandomStreams() for the buildings' recovery
+                limit state draws (default: the global random number generator)
     """
+    if validate:
+        validateEntities(entities_df, entity_type)
+        entities_df = entities_df.assign(listed = parseBool(entities_df['listed']).astype(bool).values)
+
     # try:
     entities = []
     if entity_type.lower() == 'household':
         # Populate the env with entities from the entities dataframe
         for i in entities_df.index:
             
-            if entities_df.iloc[i]['occupancy'].lower() in ['single family house', 'single family home', 
+            if validate or entities_df.iloc[i]['occupancy'].lower() in ['single family house', 'single family home', 
                                     'single family dwelling', 'single family residence',
                                     'sfr', 'sfh', 'sfd', 'mobile home']:
                 
@@ -78,7 +99,9 @@ def importEntities(env, entities_df, entity_type, building_stock = None, write_s
                                     bathrooms = entities_df.iloc[i]['bathrooms'],
                                     listed = entities_df.iloc[i]['listed'],
                                     damage_state = entities_df.iloc[i]['damage_state'],
-                                    building_stock = building_stock
+                                    building_stock = building_stock,
+                                    check = not validate,
+                                    random_streams = random_streams
                                     )
             else:
                 raise AttributeError("Specified occupancy type ({0}) associated with entity \'{1}\' not supported. Can't complete import.".format(entities_df.iloc[i]['occupancy'], entities_df.iloc[i]['name']))
@@ -96,7 +119,7 @@ def importEntities(env, entities_df, entity_type, building_stock = None, write_s
     elif entity_type.lower() == 'owner':
         # Populate the env with entities from the entities dataframe
         for i in entities_df.index:
-            if entities_df.iloc[i]['occupancy'].lower() in ['single family house', 'single family home', 
+            if validate or entities_df.iloc[i]['occupancy'].lower() in ['single family house', 'single family home', 
                                     'single family dwelling', 'single family residence',
                                     'sfr', 'sfh', 'sfd', 'mobile home']:
                 real_property = SingleFamilyResidential(
@@ -112,7 +135,9 @@ def importEntities(env, entities_df, entity_type, building_stock = None, write_s
                                             bathrooms = entities_df.iloc[i]['bathrooms'],
                                             listed = entities_df.iloc[i]['listed'],
                                             damage_state = entities_df.iloc[i]['damage_state'],
-                                            building_stock = building_stock
+                                            building_stock = building_stock,
+                                            check = not validate,
+                                            random_streams = random_streams
                                                     )
                                                     
                 
@@ -138,7 +163,7 @@ def importEntities(env, entities_df, entity_type, building_stock = None, write_s
     elif entity_type.lower() == 'ownerhousehold' or entity_type.lower() == 'owner household':
         # Populate the env with entities from the entities dataframe
         for i in entities_df.index:
-            if entities_df.iloc[i]['occupancy'].lower() in ['single family house', 'single family home', 
+            if validate or entities_df.iloc[i]['occupancy'].lower() in ['single family house', 'single family home', 
                                     'single family dwelling', 'single family residence',
                                     'sfr', 'sfh', 'sfd', 'mobile home']:                  
                 real_property = SingleFamilyResidential(
@@ -154,7 +179,9 @@ def importEntities(env, entities_df, entity_type, building_stock = None, write_s
                                                     bathrooms = entities_df.iloc[i]['bathrooms'],
                                                     listed = entities_df.iloc[i]['listed'],
                                                     damage_state = entities_df.iloc[i]['damage_state'],
-                                                    building_stock = building_stock
+                                                    building_stock = building_stock,
+                                                    check = not validate,
+                                                    random_streams = random_streams
                                                     )
                 
                 
@@ -180,7 +207,7 @@ def importEntities(env, entities_df, entity_type, building_stock = None, write_s
     elif entity_type.lower() == 'renterhousehold' or entity_type.lower() == 'renter household':
         # Populate the env with entities from the entities dataframe
         for i in entities_df.index:
-            if entities_df.iloc[i]['occupancy'].lower() in ['single family house', 'single family home', 
+            if validate or entities_df.iloc[i]['occupancy'].lower() in ['single family house', 'single family home', 
                                     'single family dwelling', 'single family residence',
                                     'sfr', 'sfh', 'sfd', 'mobile home']:                           
                 real_property = SingleFamilyResidential(
@@ -196,7 +223,9 @@ def importEntities(env, entities_df, entity_type, building_stock = None, write_s
                                             bathrooms = entities_df.iloc[i]['bathrooms'],
                                             listed = entities_df.iloc[i]['listed'],
                                             damage_state = entities_df.iloc[i]['damage_state'],
-                                            building_stock = building_stock
+                                            building_stock = building_stock,
+                                            check = not validate,
+                                            random_streams = random_streams
                                                         )
             else:
                 raise AttributeError("Specified occupancy type ({0}) associated with entity \'{1}\' not supported. Can't complete import.".format(entities_df.iloc[i]['occupancy'], entities_df.iloc[i]['name']))
@@ -229,7 +258,7 @@ def importEntities(env, entities_df, entity_type, building_stock = None, write_s
     elif entity_type.lower() == 'landlord':
         # Populate the env with entities from the entities dataframe
         for i in entities_df.index:
-            if entities_df.iloc[i]['occupancy'].lower() in ['single family house', 'single family home', 
+            if validate or entities_df.iloc[i]['occupancy'].lower() in ['single family house', 'single family home', 
                                     'single family dwelling', 'single family residence',
                                     'sfr', 'sfh', 'sfd', 'mobile home']: 
                 real_property = SingleFamilyResidential(
@@ -245,7 +274,9 @@ def importEntities(env, entities_df, entity_type, building_stock = None, write_s
                                             bathrooms = entities_df.iloc[i]['bathrooms'],
                                             listed = entities_df.iloc[i]['listed'],
                                             damage_state = entities_df.iloc[i]['damage_state'],
-                                            building_stock = building_stock
+                                            building_stock = building_stock,
+                                            check = not validate,
+                                            random_streams = random_streams
                                                         )
                 
             else:
@@ -275,9 +306,12 @@ def importEntities(env, entities_df, entity_type, building_stock = None, write_s
 
 def output_summary(entities, entity_type):
     """ A band-aid function for printing out simulation outputs for entities
-    
+
+    If entities have a 'weight' attribute (e.g., from sampling.importSample()),
+    counts are weighted to represent the full population.
     """
     if entity_type.lower() in ['ownerhousehold', 'owner household']:
+        num_households = 0
         num_damaged = 0
         num_rebuilt = 0
         num_gave_up_funding_search = 0
@@ -287,21 +321,24 @@ def output_summary(entities, entity_type):
         num_vacant_fixed = 0
 
         for household in entities:
-            if household.residence.damage_state != None: num_damaged += 1
-            if household.repair_get != None: num_rebuilt += 1
-            if household.gave_up_funding_search: num_gave_up_funding_search += 1
-            if household.home_put != None: num_homesearch += 1
-            if household.home_get != None: num_relocated += 1
-            if household.gave_up_home_search: num_gave_up_home_search += 1
+            weight = getattr(household, 'weight', 1)
+            num_households += weight
+            if household.residence.damage_state != None: num_damaged += weight
+            if household.repair_get != None: num_rebuilt += weight
+            if household.gave_up_funding_search: num_gave_up_funding_search += weight
+            if household.home_put != None: num_homesearch += weight
+            if household.home_get != None: num_relocated += weight
+            if household.gave_up_home_search: num_gave_up_home_search += weight
           
-        print('{0} out of {1} owners suffered damage to their homes.\n'.format(num_damaged, len(entities)),
-          '{0} out of {1} owners rebuilt or repaired their damaged home.\n'.format(num_rebuilt, len(entities)),
-            '{0} out of {1} owners gave up searching for money.\n'.format(num_gave_up_funding_search, len(entities)),
-          '{0} out of {1} owners searchesd for a new home.\n'.format(num_homesearch, len(entities)),
-            '{0} out of {1} owners bought a new home.\n'.format(num_relocated, len(entities)),
-            '{0} out of {1} owners gave up searching for a home.'.format(num_gave_up_home_search, len(entities))
+        print('{0:.0f} out of {1:.0f} owners suffered damage to their homes.\n'.format(num_damaged, num_households),
+          '{0:.0f} out of {1:.0f} owners rebuilt or repaired their damaged home.\n'.format(num_rebuilt, num_households),
+            '{0:.0f} out of {1:.0f} owners gave up searching for money.\n'.format(num_gave_up_funding_search, num_households),
+          '{0:.0f} out of {1:.0f} owners searchesd for a new home.\n'.format(num_homesearch, num_households),
+            '{0:.0f} out of {1:.0f} owners bought a new home.\n'.format(num_relocated, num_households),
+            '{0:.0f} out of {1:.0f} owners gave up searching for a home.'.format(num_gave_up_home_search, num_households)
             )
     if entity_type.lower() in ['renterhousehold', 'renter household']:
+        num_households = 0
         num_damaged = 0
         num_rebuilt = 0
         num_relocated = 0
@@ -311,16 +348,18 @@ def output_summary(entities, entity_type):
         num_vacant_fixed = 0
 
         for renter in entities:
-            if renter.landlord.property.damage_state != None: num_damaged += 1
-            if renter.landlord.repair_get != None: num_rebuilt += 1
-            if renter.landlord.gave_up_funding_search != None: num_gave_up_funding_search += 1
-            if not renter.residence: num_displaced += 1
-            if renter.gave_up_home_search: num_displaced += 1
-
-        print('{0} out of {1} renters\' homes suffered damage.\n'.format(num_damaged, len(entities)),
-              '{0} out of {1} renters\' damaged home was rebuilt or repaired.\n'.format(num_rebuilt, len(entities)),
-              '{0} out of {1} renters\' were displaced.\n'.format(num_displaced, len(entities)),
-              '{0} landlords gave up searching for repair money.'.format(num_gave_up_funding_search)
+            weight = getattr(renter, 'weight', 1)
+            num_households += weight
+            if renter.landlord.property.damage_state != None: num_damaged += weight
+            if renter.landlord.repair_get != None: num_rebuilt += weight
+            if renter.landlord.gave_up_funding_search != None: num_gave_up_funding_search += weight
+            if not renter.residence: num_displaced += weight
+            if renter.gave_up_home_search: num_displaced += weight
+
+        print('{0:.0f} out of {1:.0f} renters\' homes suffered damage.\n'.format(num_damaged, num_households),
+              '{0:.0f} out of {1:.0f} renters\' damaged home was rebuilt or repaired.\n'.format(num_rebuilt, num_households),
+              '{0:.0f} out of {1:.0f} renters\' were displaced.\n'.format(num_displaced, num_households),
+              '{0:.0f} landlords gave up searching for repair money.'.format(num_gave_up_funding_search)
              )
 
 def households_to_df(entities):
@@ -408,4 +447,262 @@ def households_to_df(entities):
         
     return df
 
-         
+def milestone_curves(df, milestones, days):
+    """Return the cumulative number of entities that have reached each milestone
+    on each day, e.g., for plotting recovery curves.
+
+    If df has a 'weight' column (e.g., from sampling.importSample()), each entity
+    counts as 'weight' entities.
+
+    Keyword Arguments:
+    df -- Dataframe of simulation outputs, e.g., from households_to_df()
+    milestones -- List of milestone columns (e.g., 'inspection_get', 'repair_get')
+    days -- Last day of the curves.
+
+    Returns:
+    Dataframe indexed by day with one column per milestone.
+    """
+    day_range = np.arange(days + 1)
+    curves = pd.DataFrame(index = pd.Index(day_range, name = 'day'))
+
+    for milestone in milestones:
+        times = pd.to_numeric(df[milestone], errors = 'coerce')
+        reached = times.notnull()
+        order = np.argsort(times[reached].values, kind = 'mergesort')
+        times = times[reached].values[order]
+        if 'weight' in df:
+            counts = np.concatenate([[0.0], np.cumsum(df['weight'][reached].values.astype(float)[order])])
+        else:
+            counts = np.arange(len(times) + 1)
+        curves[milestone] = counts[np.searchsorted(times, day_range, side = 'right')]
+
+    return curves
+
+# Text input columns with few distinct values, stored as categoricals in the
+# columnar input format
+input_categories = ['occupancy', 'damage_state', 'tenure']
+
+def parseBool(values):
+    """Return a boolean Series parsed from a Series of booleans, numbers, or
+    strings such as 'True', 'yes', 'n', '0' (as distutils.util.strtobool()).
+    Values that can't be parsed are NaN.
+    """
+    true = ('y', 'yes', 't', 'true', 'on', '1', '1.0')
+    false = ('n', 'no', 'f', 'false', 'off', '0', '0.0')
+    text = pd.Series(values).astype(str).str.strip().str.lower()
+    parsed = pd.Series(np.nan, index = text.index, dtype = object)
+    parsed[text.isin(true)] = True
+    parsed[text.isin(false)] = False
+    return parsed
+
+# Occupancy types supported by importEntities()
+supported_occupancies = ['single family house', 'single family home', 'single family dwelling',
+                        'single family residence', 'sfr', 'sfh', 'sfd', 'mobile home']
+
+# Input columns required for each entity type by importEntities()
+building_columns = ['occupancy', 'tenure', 'address', 'longitude', 'latitude', 'value',
+                    'monthly_cost', 'area', 'bedrooms', 'bathrooms', 'listed', 'damage_state']
+landlord_columns = ['landlord', 'landlord_savings', 'landlord_insurance', 'landlord_credit']
+required_columns = {
+    'household': ['name', 'income'] + building_columns,
+    'owner': ['name', 'savings', 'insurance', 'credit'] + building_columns,
+    'ownerhousehold': ['name', 'income', 'savings', 'insurance', 'credit'] + building_columns,
+    'renterhousehold': ['name', 'income', 'savings', 'insurance', 'credit'] + building_columns + landlord_columns,
+    'landlord': building_columns + landlord_columns
+    }
+numeric_columns = ['longitude', 'latitude', 'value', 'monthly_cost', 'area', 'bedrooms', 'bathrooms',
+                    'income', 'savings', 'insurance', 'credit',
+                    'landlord_savings', 'landlord_insurance', 'landlord_credit']
+
+def validateEntities(entities_df, entity_type, raise_errors = True):
+    """Check an entities input dataframe in one (vectorized) pass before entities
+    are created: required columns, numeric columns, supported occupancy types
+    that are in the HAZUS lookup tables, damage states in the HAZUS lookup
+    tables, and boolean 'listed' values. All problems are reported at once.
+
+    Keyword Arguments:
+    entities_df -- Dataframe of entities' input attributes (see importEntities())
+    entity_type -- Entity type as for importEntities(), e.g., 'OwnerHousehold'
+    raise_errors -- Whether to raise an AttributeError listing all problems
+
+    Returns:
+    Dataframe of problems with columns 'row' (index of entities_df), 'column',
+    'value', and 'problem'; empty if there are none.
+    """
+    key = entity_type.lower().replace(' ', '')
+    if key not in required_columns:
+        raise AttributeError("Entity type ({0}) not recognized. Can't validate.".format(entity_type))
+
+    problems = []
+
+    def report(rows, column, problem):
+        for row in entities_df.index[rows]:
+            problems.append({'row': row, 'column': column,
+                            'value': entities_df.at[row, column], 'problem': problem})
+
+    missing = [column for column in required_columns[key] if column not in entities_df]
+    for column in missing:
+        problems.append({'row': None, 'column': column, 'value': None,
+                        'problem': 'required column missing'})
+
+    for column in required_columns[key]:
+        if column in missing:
+            continue
+        values = entities_df[column]
+        absent = values.isnull().values
+        if column == 'damage_state':
+            report(absent, column, "missing (use 'None' for no damage)")
+        else:
+            report(absent, column, 'missing')
+
+        if column in numeric_columns:
+            numbers = pd.to_numeric(values, errors = 'coerce')
+            report((numbers.isnull() & ~values.isnull()).values, column, 'not a number')
+
+    if 'occupancy' not in missing:
+        occupancy = entities_df['occupancy']
+        present = occupancy.notnull().values
+        text = occupancy.astype(str)
+        report(present & ~text.str.lower().isin(supported_occupancies).values, 'occupancy',
+                'occupancy type not supported')
+        report(present & text.str.lower().isin(supported_occupancies).values &
+                ~text.isin(hazus.structural_damage_ratios.index).values, 'occupancy',
+                'occupancy type not in HAZUS lookup tables (e.g., use \'Single Family Dwelling\')')
+
+    if 'damage_state' not in missing:
+        damage_states = [state for state in hazus.structural_damage_ratios.columns
+                            if state == 'None' or state in hazus.recovery_limit_states.index]
+        damage_state = entities_df['damage_state']
+        report((damage_state.notnull() & ~damage_state.astype(str).isin(damage_states)).values,
+                'damage_state', 'damage state not in HAZUS lookup tables')
+
+    if 'listed' not in missing:
+        listed = entities_df['listed']
+        report((listed.notnull() & parseBool(listed).isnull()).values, 'listed', 'not a boolean')
+
+    problems = pd.DataFrame(problems, columns = ['row', 'column', 'value', 'problem'])
+
+    if raise_errors and len(problems) > 0:
+        lines = ["Row {0}, {1} ({2}): {3}".format(problem.row, problem.column, problem.value,
+                    problem.problem) if problem.row is not None else
+                    "Column {0}: {1}".format(problem.column, problem.problem)
+                    for problem in problems.itertuples()]
+        raise AttributeError("{0} problem(s) in {1} inputs. Can't import entities.\n{2}".format(
+                                len(problems), entity_type, '\n'.join(lines)))
+
+    return problems
+
+def _columnarInputs(df):
+    """Return a copy of an input dataframe with the columnar format's types:
+    categoricals for input_categories and booleans for 'listed'.
+    """
+    df = df.copy()
+    for column in input_categories:
+        if column in df:
+            df[column] = df[column].astype('category')
+    if 'listed' in df:
+        listed = parseBool(df['listed'])
+        if listed.notnull().all():
+            df['listed'] = listed.astype(bool)
+    return df
+
+def convertInputs(excel_path, out_dir = None, file_format = 'parquet', chunksize = 10000,
+                    overwrite = False):
+    """Convert (once) the sheets of an Excel input file, e.g., the DESaster input
+    data template, to Parquet or Feather files with the same columns, to be read
+    with readInputs() or importEntitiesChunked(). Text columns in input_categories
+    are stored as categoricals and 'listed' as booleans. Files that are newer
+    than the Excel file are kept, unless overwrite is True. Requires pyarrow.
+
+    Keyword Arguments:
+    excel_path -- File path of the Excel input file
+    out_dir -- Directory of the converted files (default: the Excel file's directory)
+    file_format -- 'parquet' or 'feather'
+    chunksize -- Rows per row group (Parquet) or record batch (Feather)
+    overwrite -- Whether to convert even if the converted files are up to date
+
+    Returns:
+    Dictionary of the converted files' paths keyed by sheet name.
+    """
+    import os
+
+    if file_format not in ('parquet', 'feather'):
+        raise AttributeError("File format ({0}) not recognized. Use 'parquet' or 'feather'.".format(file_format))
+
+    if out_dir is None:
+        out_dir = os.path.dirname(os.path.abspath(excel_path))
+    stem = os.path.splitext(os.path.basename(excel_path))[0]
+
+    sheets = pd.ExcelFile(excel_path).sheet_names
+    paths = {sheet: os.path.join(out_dir, '{0}_{1}.{2}'.format(stem, sheet, file_format))
+                for sheet in sheets}
+
+    if not overwrite and all(os.path.exists(path) and
+                            os.path.getmtime(path) >= os.path.getmtime(excel_path)
+                            for path in paths.values()):
+        return paths
+
+    os.makedirs(out_dir, exist_ok = True)
+    frames = pd.read_excel(excel_path, sheet_name = None)
+
+    for sheet, df in frames.items():
+        df = _columnarInputs(df)
+        if file_format == 'parquet':
+            df.to_parquet(paths[sheet], engine = 'pyarrow', index = False,
+                            row_group_size = chunksize)
+        else:
+            df.reset_index(drop = True).to_feather(paths[sheet], chunksize = chunksize)
+
+    return paths
+
+def readInputs(path, chunksize = None):
+    """Read an input file written by convertInputs() (Parquet or Feather).
+    Requires pyarrow.
+
+    Keyword Arguments:
+    path -- File path of the Parquet (.parquet) or Feather (.feather) file
+    chunksize -- None to return one dataframe, or the maximum number of rows of
+                each of the dataframes returned by a generator
+
+    Returns:
+    A dataframe, or a generator of dataframes (each with index 0, 1, ...).
+    """
+    if path.endswith('.parquet'):
+        file_format = 'parquet'
+    elif path.endswith('.feather'):
+        file_format = 'feather'
+    else:
+        raise AttributeError("Input file ({0}) must be .parquet or .feather.".format(path))
+
+    if chunksize is None:
+        if file_format == 'parquet':
+            return pd.read_parquet(path, engine = 'pyarrow')
+        return pd.read_feather(path)
+
+    return _readChunks(path, file_format, chunksize)
+
+def _readChunks(path, file_format, chunksize):
+    """Generator of the dataframes of an input file, chunksize rows at a time."""
+    import pyarrow.dataset
+
+    dataset = pyarrow.dataset.dataset(path, format = file_format)
+    for batch in dataset.to_batches(batch_size = chunksize):
+        if batch.num_rows:
+            yield batch.to_pandas()
+
+def importEntitiesChunked(env, path, entity_type, building_stock = None, write_story = False,
+                            chunksize = 10000, validate = False, random_streams = None):
+    """Return list of entities read, chunksize rows at a time, from an input file
+    written by convertInputs(), so that the whole input table is never held in
+    memory. See importEntities() for the keyword arguments.
+
+    Keyword Arguments:
+    path -- File path of the Parquet or Feather input file
+    chunksize -- Rows read at a time
+    """
+    entities = []
+    for chunk in readInputs(path, chunksize):
+        entities.extend(importEntities(env, chunk, entity_type, building_stock, write_story,
+                                        validate, random_streams))
+
+    return entities
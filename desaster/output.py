@@ -83,7 +83,7 @@ class Output():
 
         # Filter data
         self._filteredData = self._filterByZip(zipFilter).reset_index(drop=True)
-        self._filteredNumHomes = len(self._filteredData)
+        self._filteredNumHomes = self._countHomes(self._filteredData)
         self._onlyStateData = self._filteredData[desiredStates].reset_index(drop=True)
 
 
@@ -151,6 +151,14 @@ class Output():
             raise TypeError('Invalid Zipcode. Zipcodes currently available: ' + str(self._uniqueZipcodes) +
             "\nIf you would like to process the entire data source, pass None")
 
+    # Initialisation: Number of homes represented by the data. Sampled homes
+    # (see sampling.importSample()) each represent 'weight' homes.
+    # returns a number
+    def _countHomes(self, data):
+        if 'weight' in data:
+            return data['weight'].sum()
+        return len(data)
+
     # Initialisation: Generate a DataFrame that shows the status of every entity
     # at every point of time.
     # returns a single DataFrame
@@ -179,7 +187,11 @@ class Output():
     def _generateStatusCounts(self):
         status_count_list = []
         for time in range(1, self._simTime):
-            status_count_list.append(pd.Series(data = self._allHomeStates[time].value_counts(), name = str(time)))
+            if 'weight' in self._filteredData:
+                weights = self._filteredData['weight'].astype(float)
+                status_count_list.append(pd.Series(data = weights.groupby(self._allHomeStates[time]).sum(), name = str(time)))
+            else:
+                status_count_list.append(pd.Series(data = self._allHomeStates[time].value_counts(), name = str(time)))
         status_count_df = pd.concat(status_count_list, axis = 1).fillna(value = 0)
         missing = [status for status in self._desiredStates if status not in status_count_df.index]
         return status_count_df.reindex(status_count_df.index.union(missing)).fillna(value = 0).reindex(self._desiredStates_ns)
@@ -208,7 +220,7 @@ class Output():
     # refilters and prints confirmation
     def filterByZip(self, desiredZipcode):
         self._filteredData = self._filterByZip(desiredZipcode).reset_index(drop=True)
-        self._filteredNumHomes = len(self._filteredData)
+        self._filteredNumHomes = self._countHomes(self._filteredData)
         self._desiredZipcode = desiredZipcode
         self._onlyStateData = self._filteredData[self._desiredStates].reset_index(drop=True)
         self._run()
@@ -0,0 +1,644 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of classes for declaring recovery pipelines (the sequence of recovery
+program stages an entity goes through, with branches on damage state and
+funding) and an engine that drives entities through them.
+
+A Pipeline is a plain description: stages refer to recovery programs and
+building stocks by name, so the same pipeline can be reused across scenarios
+and pickled. PipelineEngine compiles a pipeline against a scenario's programs
+into a flat list of operations and drives each entity through it with a single
+PipelineTask (a checkpoint.ProgramTask): a compact state machine holding the
+entity's position in the pipeline. Program stages are run inline by the task
+rather than as nested SimPy processes, and funding/home search patience is a
+single timeout per search. Pipelines run this way can be saved with
+checkpoint.saveCheckpoint().
+
+Stages run the same step() methods as the programs' process() methods
+(technical.TechnicalRecoveryProgram.step(), financial.FinancialRecoveryProgram
+subclasses' step()), the policies' policy() methods
+(policies.FinancialRecoveryPolicy.searchStep()), and the households' find_home()
+and occupy() methods (entities.Household.findHomeStep() and occupyStep()), so a
+pipeline gives the same results as the equivalent process generators.
+
+Classes:
+Pipeline
+Delay
+Program
+FundingSearch
+FindHome
+Occupy
+Call
+Branch
+Stop
+With
+DamageState
+Funded
+GaveUpFunding
+GaveUpHomeSearch
+HasResidence
+Not
+And
+Or
+PipelineEngine
+PipelineTask
+
+Functions:
+ownerPipeline
+landlordPipeline
+renterPipeline
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from desaster.checkpoint import ProgramTask
+from desaster.streams import sample
+
+class Pipeline(object):
+    """A declarative recovery pipeline: an ordered list of stages.
+
+    Methods:
+    __init__(self, stages, name = None)
+    """
+    def __init__(self, stages, name = None):
+        """Initiate a Pipeline object.
+
+        Keyword Arguments:
+        stages -- List of stage objects (e.g., Delay, Program, FundingSearch,
+                    FindHome, Occupy, Call, Branch, Stop, With)
+        name -- Optional name for the pipeline
+        """
+        self.stages = list(stages)
+        self.name = name
+
+# ----------------------------------------------------------------------------
+# Stages
+# ----------------------------------------------------------------------------
+
+class Delay(object):
+    """Stage: wait for a duration drawn from a distribution (e.g., time for
+    inspectors to mobilize).
+    """
+    def __init__(self, duration):
+        """Keyword Arguments:
+        duration -- A scipy.stats frozen distribution (or any object with rvs())
+        """
+        self.duration = duration
+
+    def compile(self, compiler):
+        compiler.emit(_DelayOp(self.duration))
+
+class Program(object):
+    """Stage: request a technical recovery program (inspection, engineering
+    assessment, permit, demolition, or repair) for the entity's building.
+    """
+    def __init__(self, program, structure = 'property'):
+        """Keyword Arguments:
+        program -- Name of a technical.TechnicalRecoveryProgram subclass object
+                    in the engine's programs dictionary
+        structure -- Name of the entity's attribute holding the building
+        """
+        self.program = program
+        self.structure = structure
+
+    def compile(self, compiler):
+        compiler.emit(_TechnicalOp(compiler.program(self.program), self.structure))
+
+class FundingSearch(object):
+    """Stage: search for recovery funds from insurance, FEMA, and/or SBA
+    following a policies.FinancialRecoveryPolicy, with search patience.
+    """
+    def __init__(self, policy, patience, insurance = 'insurance', fema = 'fema',
+                    sba = 'sba'):
+        """Keyword Arguments:
+        policy -- A policies.FinancialRecoveryPolicy subclass (or object), e.g.,
+                    policies.Insurance_IA_SBA_Sequential
+        patience -- Days the entity is willing to search for funds
+        insurance -- Name of the financial.OwnersInsurance program
+        fema -- Name of the financial.HousingAssistanceFEMA program
+        sba -- Name of the financial.RealPropertyLoanSBA program
+        """
+        self.policy = policy
+        self.patience = patience
+        self.insurance = insurance
+        self.fema = fema
+        self.sba = sba
+
+    def compile(self, compiler):
+        policy = self.policy
+        if isinstance(policy, type):
+            policy = policy(compiler.env)
+
+        if getattr(policy, 'rounds', None) is None:
+            raise AttributeError("Financial recovery policy ({0}) has no funding rounds "
+                                "and is not supported by PipelineEngine.".format(
+                                policy.__class__.__name__))
+
+        names = {'insurance': self.insurance, 'fema': self.fema, 'sba': self.sba}
+        rounds = [([compiler.program(names[name]) for name in programs], condition)
+                    for programs, condition in policy.rounds]
+
+        compiler.emit(_FundingOp(policy, rounds, self.patience))
+
+class FindHome(object):
+    """Stage: search the given building stock for a new home to buy
+    (OwnerHousehold) or rent (RenterHousehold), with search patience. Same
+    keyword arguments as entities.OwnerHousehold.find_home() and
+    entities.RenterHousehold.find_home().
+    """
+    def __init__(self, stock, duration, patience = float('inf'), **kwargs):
+        """Keyword Arguments:
+        stock -- Name of the building stock (simpy.FilterStore) in the engine's
+                    stocks dictionary
+        duration -- Distribution of time to close on / move into the new home
+        patience -- Days the entity is willing to search
+        kwargs -- E.g., down_payment_pct, housing_ratio, price_pct, area_pct,
+                    rooms_tol, move_in_ratio
+        """
+        self.stock = stock
+        self.duration = duration
+        self.patience = patience
+        self.kwargs = kwargs
+
+    def compile(self, compiler):
+        compiler.emit(_FindHomeOp(compiler.stock(self.stock), self.duration,
+                                    self.patience, self.kwargs))
+
+class Occupy(object):
+    """Stage: (re)occupy a residence after a duration drawn from a distribution."""
+    def __init__(self, duration):
+        """Keyword Arguments:
+        duration -- A scipy.stats frozen distribution (or any object with rvs())
+        """
+        self.duration = duration
+
+    def compile(self, compiler):
+        compiler.emit(_OccupyOp(self.duration))
+
+class Call(object):
+    """Stage: call function(entity) (e.g., evictTenant). The function must be a
+    module-level function for the pipeline to be picklable.
+    """
+    def __init__(self, function):
+        self.function = function
+
+    def compile(self, compiler):
+        compiler.emit(_CallOp(self.function))
+
+class Branch(object):
+    """Stage: run 'then' stages if condition(entity) is True, else 'otherwise'."""
+    def __init__(self, condition, then, otherwise = None):
+        """Keyword Arguments:
+        condition -- A condition object, e.g., DamageState('Complete')
+        then -- List of stages run if the condition is True
+        otherwise -- List of stages run if the condition is False
+        """
+        self.condition = condition
+        self.then = list(then)
+        self.otherwise = list(otherwise or [])
+
+    def compile(self, compiler):
+        branch = compiler.emit(_BranchOp(self.condition))
+        for stage in self.then:
+            stage.compile(compiler)
+        if self.otherwise:
+            jump = compiler.emit(_JumpOp())
+            branch.target = len(compiler.ops)
+            for stage in self.otherwise:
+                stage.compile(compiler)
+            jump.target = len(compiler.ops)
+        else:
+            branch.target = len(compiler.ops)
+
+class Stop(object):
+    """Stage: end the pipeline (or, inside With, end the With block)."""
+    def compile(self, compiler):
+        compiler.stops[-1].append(compiler.emit(_JumpOp()))
+
+class With(object):
+    """Stage: run stages for a related entity, e.g., a renter's landlord."""
+    def __init__(self, attribute, stages):
+        """Keyword Arguments:
+        attribute -- Name of the entity's attribute holding the related entity
+        stages -- List of stages run for the related entity
+        """
+        self.attribute = attribute
+        self.stages = list(stages)
+
+    def compile(self, compiler):
+        compiler.emit(_EnterOp(self.attribute))
+        compiler.stops.append([])
+        for stage in self.stages:
+            stage.compile(compiler)
+        for stop in compiler.stops.pop():
+            stop.target = len(compiler.ops)
+        compiler.emit(_LeaveOp())
+
+# ----------------------------------------------------------------------------
+# Conditions
+# ----------------------------------------------------------------------------
+
+def _related(entity, of):
+    return entity if of is None else getattr(entity, of)
+
+class DamageState(object):
+    """Condition: the entity's building is in one of the given damage states."""
+    def __init__(self, *states, **kwargs):
+        """Keyword Arguments:
+        states -- One or more damage states, e.g., 'Extensive', 'Complete'
+        structure -- Name of the entity's attribute holding the building
+                    (default 'property'; e.g., 'residence' for renters)
+        """
+        self.states = states
+        self.structure = kwargs.get('structure', 'property')
+
+    def __call__(self, entity):
+        return getattr(entity, self.structure).damage_state in self.states
+
+class Funded(object):
+    """Condition: the entity's recovery funds cover its property's damage."""
+    def __call__(self, entity):
+        return entity.recovery_funds.level >= entity.property.damage_value
+
+class GaveUpFunding(object):
+    """Condition: the entity gave up its search for recovery funds."""
+    def __call__(self, entity):
+        return entity.gave_up_funding_search != None
+
+class GaveUpHomeSearch(object):
+    """Condition: the entity gave up its search for a new home."""
+    def __call__(self, entity):
+        return entity.gave_up_home_search != None
+
+class HasResidence(object):
+    """Condition: the entity (or a related entity, e.g., of = 'tenant') has a residence."""
+    def __init__(self, of = None):
+        self.of = of
+
+    def __call__(self, entity):
+        return _related(entity, self.of).residence != None
+
+class Not(object):
+    """Condition: negation of a condition."""
+    def __init__(self, condition):
+        self.condition = condition
+
+    def __call__(self, entity):
+        return not self.condition(entity)
+
+class And(object):
+    """Condition: all of the given conditions."""
+    def __init__(self, *conditions):
+        self.conditions = conditions
+
+    def __call__(self, entity):
+        return all(condition(entity) for condition in self.conditions)
+
+class Or(object):
+    """Condition: any of the given conditions."""
+    def __init__(self, *conditions):
+        self.conditions = conditions
+
+    def __call__(self, entity):
+        return any(condition(entity) for condition in self.conditions)
+
+# ----------------------------------------------------------------------------
+# Standard pipelines (see scenarios/desaster_application_template.ipynb)
+# ----------------------------------------------------------------------------
+
+def evictTenant(entity):
+    """Evict a landlord's tenant (for use with Call)."""
+    entity.evict_tenant()
+
+def writeDecidedNotToRepair(entity):
+    """Write that an entity decided not to repair (for use with Call)."""
+    if entity.write_story:
+        entity.story.append('{0} decided not to repair their {1}. '.format(
+                            entity.name, entity.property.occupancy.lower()))
+
+def appendLandlordStory(entity):
+    """Add a renter's landlord's story to the renter's story (for use with Call)."""
+    entity.story += entity.landlord.story
+
+def ownerPipeline(policy, start_delay, occupy_duration, find_home_duration,
+                    money_patience = 200000, home_patience = 15000, stock = 'search_stock',
+                    down_payment_pct = 0.10):
+    """Return the owner-occupied household pipeline: inspection, funding search,
+    then repair (assessment, permit, demolition if needed, repair) and reoccupy,
+    or, if not enough funds or completely damaged, search for a new home.
+
+    Keyword Arguments:
+    policy -- A policies.FinancialRecoveryPolicy subclass
+    start_delay -- Distribution of time until inspectors are mobilized
+    occupy_duration -- Distribution of time to (re)occupy a home
+    find_home_duration -- Distribution of time to close on a new home
+    money_patience -- Days until giving up the search for repair money
+    home_patience -- Days until giving up the search for a new home
+    stock -- Name of the stock of homes for sale
+    down_payment_pct -- Percentage of new home value required for a down payment
+    """
+    repair = [Program('assessment'), Program('permit'),
+                Branch(DamageState('Extensive', 'Complete'), [Program('demolition')]),
+                Program('repair'), Occupy(occupy_duration)]
+
+    relocate = [FindHome(stock, find_home_duration, home_patience,
+                            down_payment_pct = down_payment_pct),
+                Branch(Not(GaveUpHomeSearch()), [Occupy(occupy_duration)])]
+
+    return Pipeline([
+        Delay(start_delay),
+        Program('inspection'),
+        Branch(DamageState('None'),
+            [Occupy(occupy_duration)],
+            [FundingSearch(policy, money_patience),
+            Branch(Or(Not(Funded()), DamageState('Complete')), relocate, repair)])
+        ], name = 'owner')
+
+def landlordPipeline(policy, start_delay, money_patience = 100000):
+    """Return the landlord pipeline: inspection, tenant eviction if extensively
+    damaged, funding search, and repair if enough funds.
+
+    Keyword Arguments:
+    policy -- A policies.FinancialRecoveryPolicy subclass (without FEMA), e.g.,
+                policies.Insurance_SBA_Sequential
+    start_delay -- Distribution of time until inspectors are mobilized
+    money_patience -- Days until giving up the search for repair money
+    """
+    return Pipeline(_landlordStages(policy, start_delay, money_patience), name = 'landlord')
+
+def renterPipeline(policy, start_delay, occupy_duration, find_home_duration,
+                    money_patience = 365, home_patience = 550, stock = 'search_stock'):
+    """Return the renter household pipeline: if the residence is damaged, the
+    landlord pipeline is run for the renter's landlord; the renter then
+    reoccupies their residence or, if evicted, searches for a new rental.
+
+    Keyword Arguments:
+    policy -- A policies.FinancialRecoveryPolicy subclass for the landlord
+    start_delay -- Distribution of time until inspectors are mobilized
+    occupy_duration -- Distribution of time to (re)occupy a home
+    find_home_duration -- Distribution of time to move into a new rental
+    money_patience -- Days until the landlord gives up the search for repair money
+    home_patience -- Days until giving up the search for a new home
+    stock -- Name of the stock of homes for rent
+    """
+    relocate = [FindHome(stock, find_home_duration, home_patience),
+                Branch(Not(GaveUpHomeSearch()), [Occupy(occupy_duration)])]
+
+    return Pipeline([
+        Branch(DamageState('None', structure = 'residence'),
+            [Occupy(occupy_duration)],
+            [With('landlord', _landlordStages(policy, start_delay, money_patience)),
+            Branch(HasResidence(), [Occupy(occupy_duration)], relocate),
+            Call(appendLandlordStory)])
+        ], name = 'renter')
+
+def _landlordStages(policy, start_delay, money_patience):
+    return [
+        Delay(start_delay),
+        Program('inspection'),
+        Branch(Not(DamageState('None')), [
+            Branch(DamageState('Extensive', 'Complete'), [Call(evictTenant)]),
+            FundingSearch(policy, money_patience),
+            Branch(GaveUpFunding(), [Call(evictTenant), Call(writeDecidedNotToRepair), Stop()]),
+            Branch(Funded(),
+                [Program('assessment'), Program('permit'),
+                Branch(DamageState('Extensive', 'Complete'), [Program('demolition')]),
+                Program('repair')],
+                [Branch(HasResidence(of = 'tenant'), [Call(evictTenant)])])
+            ])
+        ]
+
+# ----------------------------------------------------------------------------
+# Engine
+# ----------------------------------------------------------------------------
+
+class PipelineEngine(object):
+    """A class to compile a Pipeline against a scenario's recovery programs and
+    building stocks and to drive entities through it.
+
+    Methods:
+    __init__(self, env, pipeline, programs, stocks = None)
+    start(self, entity)
+    startAll(self, entities)
+    """
+    def __init__(self, env, pipeline, programs, stocks = None):
+        """Initiate a PipelineEngine object.
+
+        Keyword Arguments:
+        env -- simpy.Environment() object
+        pipeline -- A Pipeline object
+        programs -- Dictionary of recovery program objects keyed by the names used
+                    in the pipeline, e.g., {'inspection': InspectionProgram(...), ...}
+        stocks -- Dictionary of building stocks (simpy.FilterStore) keyed by the
+                    names used in the pipeline, e.g., {'search_stock': ...}
+
+        Attribute Changes:
+        self.ops -- The compiled list of pipeline operations
+        """
+        self.env = env
+        self.pipeline = pipeline
+        self.programs = programs
+        self.stocks = stocks or {}
+
+        self.ops = []
+        self.stops = [[]]
+        for stage in pipeline.stages:
+            stage.compile(self)
+        for stop in self.stops.pop():
+            stop.target = len(self.ops)
+
+    def emit(self, op):
+        self.ops.append(op)
+        return op
+
+    def program(self, name):
+        try:
+            return self.programs[name]
+        except KeyError:
+            raise AttributeError("Program ({0}) used in pipeline but not given to "
+                                "PipelineEngine.".format(name))
+
+    def stock(self, name):
+        try:
+            return self.stocks[name]
+        except KeyError:
+            raise AttributeError("Building stock ({0}) used in pipeline but not given to "
+                                "PipelineEngine.".format(name))
+
+    def start(self, entity):
+        """Start driving an entity through the pipeline; return its PipelineTask."""
+        return PipelineTask(self.env, self.ops, entity)
+
+    def startAll(self, entities):
+        """Start driving each entity through the pipeline; return the PipelineTasks."""
+        return [PipelineTask(self.env, self.ops, entity) for entity in entities]
+
+class PipelineTask(ProgramTask):
+    """A checkpoint.ProgramTask holding one entity's position in a compiled
+    pipeline. Each operation advances the current stage with the task's request
+    state (e.g., by calling a program's step() method).
+
+    Methods:
+    __init__(self, env, ops, entity)
+    step(self, event)
+    """
+    __slots__ = ('ops', 'entity', 'pc', 'subject', 'subjects')
+
+    def __init__(self, env, ops, entity):
+        """Initiate a PipelineTask object and schedule its first step.
+
+        Keyword Arguments:
+        env -- simpy.Environment() object
+        ops -- Compiled pipeline operations (PipelineEngine.ops)
+        entity -- The entity (e.g., entities.OwnerHousehold()) to drive
+        """
+        self.ops = ops
+        self.entity = entity
+        self.pc = 0
+        self.subject = entity
+        self.subjects = None
+        ProgramTask.__init__(self, env, None)
+
+    def step(self, event):
+        ops = self.ops
+        while self.pc < len(ops):
+            result = ops[self.pc].step(self, event)
+            if result.__class__ is not int:
+                return result
+            self.pc = result
+            self.sub = 0
+            event = None
+        return None
+
+# ----------------------------------------------------------------------------
+# Operations
+# ----------------------------------------------------------------------------
+
+class _DelayOp(object):
+    __slots__ = ('duration',)
+
+    def __init__(self, duration):
+        self.duration = duration
+
+    def step(self, task, event):
+        if task.sub == 0:
+            task.sub = 1
+            return task.env.timeout(sample(task.env, self.duration, task.subject, 'delay'))
+        return task.pc + 1
+
+class _CallOp(object):
+    __slots__ = ('function',)
+
+    def __init__(self, function):
+        self.function = function
+
+    def step(self, task, event):
+        self.function(task.subject)
+        return task.pc + 1
+
+class _BranchOp(object):
+    __slots__ = ('condition', 'target')
+
+    def __init__(self, condition):
+        self.condition = condition
+        self.target = None
+
+    def step(self, task, event):
+        if self.condition(task.subject):
+            return task.pc + 1
+        return self.target
+
+class _JumpOp(object):
+    __slots__ = ('target',)
+
+    def __init__(self):
+        self.target = None
+
+    def step(self, task, event):
+        return self.target
+
+class _EnterOp(object):
+    __slots__ = ('attribute',)
+
+    def __init__(self, attribute):
+        self.attribute = attribute
+
+    def step(self, task, event):
+        task.subjects = (task.subject, task.subjects)
+        task.subject = getattr(task.subject, self.attribute)
+        return task.pc + 1
+
+class _LeaveOp(object):
+    __slots__ = ()
+
+    def step(self, task, event):
+        task.subject, task.subjects = task.subjects
+        return task.pc + 1
+
+class _OccupyOp(object):
+    """Runs entities.Household.occupyStep()."""
+    __slots__ = ('duration',)
+
+    def __init__(self, duration):
+        self.duration = duration
+
+    def step(self, task, event):
+        result = task.subject.occupyStep(task, self.duration, event)
+        return task.pc + 1 if result is None else result
+
+class _TechnicalOp(object):
+    """Runs technical.TechnicalRecoveryProgram.step() for the entity's building."""
+    __slots__ = ('program', 'structure')
+
+    def __init__(self, program, structure):
+        if getattr(program, 'milestone', None) is None:
+            raise AttributeError("Program type ({0}) not supported by Program stage.".format(
+                                    program.__class__.__name__))
+        self.program = program
+        self.structure = structure
+
+    def step(self, task, event):
+        entity = task.subject
+        result = self.program.step(task, getattr(entity, self.structure), entity, event)
+        return task.pc + 1 if result is None else result
+
+class _FundingOp(object):
+    """Runs policies.FinancialRecoveryPolicy.searchStep()."""
+    __slots__ = ('policy', 'rounds', 'patience')
+
+    def __init__(self, policy, rounds, patience):
+        self.policy = policy
+        self.rounds = rounds
+        self.patience = patience
+
+    def step(self, task, event):
+        result = self.policy.searchStep(task, self.rounds, self.patience, task.subject, event)
+        return task.pc + 1 if result is None else result
+
+class _FindHomeOp(object):
+    """Runs entities.Household.findHomeStep()."""
+    __slots__ = ('stock', 'duration', 'patience', 'kwargs')
+
+    def __init__(self, stock, duration, patience, kwargs):
+        self.stock = stock
+        self.duration = duration
+        self.patience = patience
+        self.kwargs = kwargs
+
+    def step(self, task, event):
+        result = task.subject.findHomeStep(task, self.stock, self.duration, self.patience,
+                                            self.kwargs, event)
+        return task.pc + 1 if result is None else result
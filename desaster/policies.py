@@ -25,25 +25,103 @@ Insurance_SBA_Sequential
 Insurance_SBA_Parallel
 RepairVacantBuilding
 
+Functions:
+withPatience
+
 @author: Scott Miles (milessb@uw.edu)
 """
 import random
 random.seed(15)
 from desaster.entities import Owner
+from desaster.checkpoint import ProgramTask
+from simpy.events import AllOf
+from desaster import streams
+from simpy import Interrupt
+
+def withPatience(env, process, patience):
+    """Run a program process (generator) within the calling process -- like
+    'yield from process', without creating a new simpy.Process -- but give up
+    when the patience event is processed first. On giving up, a
+    simpy.Interrupt(env.now) is thrown into the program process, which handles it
+    (e.g., writes to the entity's story) as it would a Process.interrupt().
+    Interrupts of the calling process are also passed on to the program process.
+
+    Usage (in a process generator):
+        completed = yield from withPatience(env, insurance_program.process(entity),
+                                            env.timeout(patience, value = 'gave up'))
+
+    Keyword Arguments:
+    env -- simpy.Environment() object
+    process -- A program process generator, e.g., sba_program.process(entity)
+    patience -- A simpy event (e.g., a timeout) that ends the wait
+
+    Returns:
+    True if the program process completed, False if patience ran out.
+    """
+    caller = env.active_process
+    patient = patience.callbacks is not None
+
+    # Interrupt the calling process (and so the program process) if patience
+    # runs out while waiting.
+    def expire(event):
+        if caller.is_alive:
+            caller.interrupt(patience)
+
+    if patient:
+        patience.callbacks.append(expire)
+
+    value = None
+    error = None if patient else Interrupt(env.now)
+    try:
+        while True:
+            try:
+                if error is None:
+                    event = process.send(value)
+                else:
+                    event = process.throw(error)
+            except StopIteration:
+                return patient
+
+            value = None
+            error = None
+            try:
+                value = yield event
+            except Interrupt as interrupt:
+                if interrupt.cause is patience:
+                    patient = False
+                    error = Interrupt(env.now)
+                else:
+                    error = interrupt
+            except Exception as exception:
+                error = exception
+    finally:
+        if patient and patience.callbacks is not None:
+            patience.callbacks.remove(expire)
 
 
 class FinancialRecoveryPolicy(object):
     """Base class for creating financial recovery policies. Serves to make
     pretty UML diagrams using pyreverse. And contains some story writing methods.
     
+    Subclasses describe their search as funding rounds (rounds): lists of
+    programs requested in parallel, each with when the round is run ('insured',
+    'unfunded' -- the entity still lacks enough funds -- or 'always'). The
+    subclasses' policy() methods run searchStep() in a checkpoint.ProgramTask;
+    pipeline.PipelineEngine runs the same searchStep() inline.
+
     Methods:
     __init__(self, env):
     policy(self):
+    search(self, entity, search_patience, **programs):
+    searchStep(self, task, rounds, search_patience, entity, event):
     writeHadEnough(self, entity):
     writeCompletedWithoutEnough(self, entity, search_duration):
     writeCompletedWithEnough(self, entity, search_duration):
     
     """
+    # Funding rounds: ([program names], condition) tuples, run in order
+    rounds = None
+
     def __init__(self, env):
         """ Initiate FinancialRecoveryPolicy object.
         
@@ -53,6 +131,136 @@ class FinancialRecoveryPolicy(object):
         self.env = env
     def policy(self):
         pass
+
+    def search(self, entity, search_patience, **programs):
+        """A process (generator) representing entity search for money to repair
+        following the policy's funding rounds, for use with 'yield from' in
+        policy().
+
+        Keyword Arguments:
+        entity -- A single entities object, such as Household().
+        search_patience -- The search duration in which the entity is willing to
+                            wait for recovery funds.
+        programs -- The financial programs named in the rounds, e.g.,
+                    insurance = OwnersInsurance(...), sba = RealPropertyLoanSBA(...)
+        """
+        rounds = [([programs[name] for name in names], condition)
+                    for names, condition in self.rounds]
+
+        yield from ProgramTask(self.env, self.searchStep, rounds, search_patience,
+                                entity).join()
+
+    def searchStep(self, task, rounds, search_patience, entity, event):
+        """Advance an entity's search for money to repair, held by task (a
+        checkpoint.ProgramTask, e.g., a pipeline.PipelineTask). A round with one
+        program runs the program's step() within the task; a round with several
+        runs each in its own ProgramTask and waits for all of them. If patience
+        runs out (or the task is interrupted), outstanding requests are withdrawn.
+
+        Keyword Arguments:
+        task -- The checkpoint.ProgramTask running the search
+        rounds -- The funding rounds with program objects in place of names
+        search_patience -- The search duration in which the entity is willing to
+                            wait for recovery funds.
+        entity -- A single entities object, such as Household().
+        event -- The processed event the search was waiting on
+
+        Returns:
+        The next event to wait on, or None when the search is finished.
+
+        Attribute Changes:
+        entity.gave_up_funding_search -- Record time money search stops if
+                                        patience runs out
+        entity.recovery_funds.level -- Increase recovery funds amount in $
+        """
+        env = self.env
+
+        if task.round is None:
+            # Return out of function if entity has enough money to repair and does not
+            # have any insurance coverage.
+            if (entity.recovery_funds.level >= entity.property.damage_value
+                and entity.insurance == 0.0):
+                self.writeHadEnough(entity)
+                return None
+
+            # Record when money search starts; if no insurance, money search
+            # starts after disaster declaration.
+            if entity.insurance > 0.0:
+                task.search_start = env.now
+            else:
+                declaration = next((program.declaration for programs, condition in rounds
+                                    for program in programs
+                                    if hasattr(program, 'declaration')), 0)
+                task.search_start = max(declaration, env.now)
+
+            # Define a timeout process to represent search patience.
+            task.patience = env.timeout(task.search_start + search_patience - env.now,
+                                        value = 'gave up')
+            task.patience.callbacks.append(task._patienceExpired)
+            task.round = -1
+            event = None
+
+        elif event is task.patience or not event.ok:
+            # Patience ran out (or the search was interrupted); withdraw
+            # outstanding requests.
+            if task.children is not None:
+                for child in task.children:
+                    if child.is_alive:
+                        child.interrupt(env.now)
+            else:
+                rounds[task.round][0][0].giveUp(task, entity)
+            if event is task.patience:
+                entity.gave_up_funding_search = env.now
+            return self._endSearch(task)
+
+        while True:
+            if task.round >= 0:
+                programs = rounds[task.round][0]
+                if len(programs) == 1:
+                    result = programs[0].step(task, entity, event)
+                    if result is not None:
+                        return result
+                elif task.children is None:
+                    task.children = [ProgramTask(env, program.step, entity)
+                                        for program in programs]
+                    return AllOf(env, [child.finished for child in task.children])
+                task.children = None
+
+            # Next round
+            task.round += 1
+            task.sub = 0
+            event = None
+            while task.round < len(rounds):
+                condition = rounds[task.round][1]
+                if (condition == 'always'
+                    or (condition == 'insured' and entity.insurance > 0.0)
+                    or (condition == 'unfunded'
+                        and entity.recovery_funds.level < entity.property.damage_value)):
+                    break
+                task.round += 1
+
+            if task.round >= len(rounds):
+                break
+
+        # Record the duration when entity's search for money ends without
+        # giving up.
+        search_duration = env.now - task.search_start
+
+        # If entity (STILL) does not have enough repair money then indicate so and
+        # that options have been exhausted.
+        if entity.recovery_funds.level < entity.property.damage_value:
+            self.writeCompletedWithoutEnough(entity, search_duration)
+        else:
+            self.writeCompletedWithEnough(entity, search_duration)
+
+        return self._endSearch(task)
+
+    def _endSearch(self, task):
+        task.patience = None
+        task.round = None
+        task.search_start = None
+        task.children = None
+        return None
         
     def writeHadEnough(self, entity):
         if entity.write_story:
@@ -86,6 +294,9 @@ class Insurance_IA_SBA_Sequential(FinancialRecoveryPolicy):
     Inheritance:
     FinancialRecoveryPolicy
     """
+    rounds = [(['insurance'], 'insured'), (['fema'], 'unfunded'),
+                (['sba'], 'unfunded')]
+
     def __init__(self, env):
         """ Initiate Insurance_IA_SBA_Sequential object.
         
@@ -115,123 +326,9 @@ class Insurance_IA_SBA_Sequential(FinancialRecoveryPolicy):
         entity.gave_up_funding_search -- Record time money search stops
         entity.recovery_funds.level -- Increase recovery funds amount in $
         """
-        # Calculate the time that money search patience ends
-        # patience_end = money_search_start + search_patience
-
-        # Return out of function if entity has enough money to repair and does not
-        # have any insurance coverage.
-        if (entity.recovery_funds.level >= entity.property.damage_value
-            and entity.insurance == 0.0):
-
-            self.writeHadEnough(entity)
-            return
-
-        # If entity has insurance then yield an insurance claim request, the duration
-        # of which is limited by entity's money search patience.
-        if entity.insurance > 0.0:
-            # Record when money search starts
-            money_search_start = self.env.now
-            patience_end = money_search_start + search_patience
-            patience_remain = patience_end - self.env.now
-            
-            # Define a timeout process to represent search patience, with duration
-            # equal to the *remaining* patience. Pass the value "Gave up" if the
-            # process completes.
-            find_search_patience = self.env.timeout(patience_remain, value='Gave up')
-
-            # Define insurance claim request process. Pass data about available
-            # insurance claim adjusters.
-            try_insurance = self.env.process(insurance_program.process(entity))
-
-            # Yield both the patience timeout and the insurance claim request.
-            # Pass result for the process that completes first.
-            money_search_outcome = yield find_search_patience | try_insurance
-            
-            # If patience process completes first, interrupt the insurance claim
-            # request and return out of function.
-            if money_search_outcome == {find_search_patience: 'Gave up'}:
-                if try_insurance.is_alive:
-                    try_insurance.interrupt(self.env.now)
-                entity.gave_up_funding_search = self.env.now
-                return
-                
-            patience_remain = patience_end - self.env.now
-
-        # If entity (still) does not have enough repair money then yield a FEMA IA
-        # request, the duration of which is limited by entity's money search patience.
-        if entity.recovery_funds.level < entity.property.damage_value:
-            # Define a timeout process to represent search patience, with duration
-            # equal to the *remaining* patience. Pass the value "Gave up" if the
-            # process completes.
-            if entity.insurance > 0.0:
-                # If has insurance, account for time it took to get claim
-                find_search_patience = self.env.timeout(patience_remain, value='gave up')
-            else:
-                #If no insurance, money search starts after disaster declaration
-                money_search_start = max(fema_program.declaration, self.env.now)
-                patience_end = money_search_start + search_patience
-                patience_remain = patience_end - self.env.now
-                
-                find_search_patience = self.env.timeout(patience_remain,
-                                                        value='gave up'
-                                                        )
-            
-            # Define FEMA aid request process. Pass data about available
-            # FEMA processors, budget, and maximum grant amount.
-            try_fema = self.env.process(fema_program.process(entity))
-            
-            # Yield both the patience timeout and the FEMA aid request.
-            # Pass result for the process that completes first.
-            money_search_outcome = yield find_search_patience | try_fema
-            
-            # If patience process completes first, interrupt the FEMA aid
-            # request and return out of function.
-            if 'gave up' in str(money_search_outcome).lower():
-                if try_fema.is_alive:
-                    try_fema.interrupt(self.env.now)
-                entity.gave_up_funding_search = self.env.now
-                return
-
-            patience_remain = patience_end - self.env.now
-            
-        # If entity (still) does not have enough repair money then yield a loan
-        # request, the duration of which is limited by entity's money search patience.
-        if entity.recovery_funds.level < entity.property.damage_value:
-            # Define a timeout process to represent search patience, with duration
-            # equal to the *remaining* patience. Pass the value "gave up" if the
-            # process completes.
-            find_search_patience = self.env.timeout(patience_remain, value='gave up')
-
-            # Define loan request process. Pass data about available
-            # loan processors.
-            try_loan = self.env.process(sba_program.process(entity))
-
-            # Yield both the patience timeout and the loan request.
-            # Pass result for the process that completes first.
-            money_search_outcome = yield find_search_patience | try_loan
-
-            # If patience process completes first, interrupt the loan
-            # request and return out of function.
-            if 'gave up' in str(money_search_outcome).lower():
-                if try_loan.is_alive:
-                    try_loan.interrupt(self.env.now)
-                entity.gave_up_funding_search = self.env.now
-                return
-
-        # Record the time and duration when entity's search for money ends without
-        # giving up.
-        search_duration = self.env.now - money_search_start
+        yield from self.search(entity, search_patience, insurance = insurance_program,
+                                fema = fema_program, sba = sba_program)
 
-        # If entity (STILL) does not have enough repair money then indicate so and
-        # that options have been exhausted.
-        if entity.recovery_funds.level < entity.property.damage_value:
-            # If write_story is True, then append money search outcome to entity's story.
-            self.writeCompletedWithoutEnough(entity, search_duration)
-            return
-
-        # If entity completed search and obtained sufficient funding.
-        self.writeCompletedWithEnough(entity, search_duration)
-                
 class Insurance_IA_SBA_Parallel(FinancialRecoveryPolicy):
     """ A class that organizes funding requests to insurance, FEMA, and SBA in 
     parallel. Also implements patience for waiting for funding.
@@ -243,6 +340,8 @@ class Insurance_IA_SBA_Parallel(FinancialRecoveryPolicy):
     Inheritance:
     FinancialRecoveryPolicy
     """
+    rounds = [(['insurance', 'sba', 'fema'], 'always')]
+
     def __init__(self, env):
         """ Initiate Insurance_IA_SBA_Sequential object.
         
@@ -271,95 +370,8 @@ class Insurance_IA_SBA_Parallel(FinancialRecoveryPolicy):
         entity.gave_up_funding_search -- Record time money search stops
         entity.recovery_funds.level -- Increase recovery funds amount in $
         """
-
-        # Return out of function if entity has enough money to repair and does not
-        # have any insurance coverage.
-        if (entity.recovery_funds.level >= entity.property.damage_value
-            and entity.insurance == 0):
-
-            self.writeHadEnough(entity)
-            return
-        
-        # Define insurance claim request process. Define loan request process.
-        try_insurance = self.env.process(insurance_program.process(entity))
-        try_loan = self.env.process(sba_program.process(entity))
-        try_fema = self.env.process(fema_program.process(entity))
-
-        # If entity has insurance then yield an insurance claim request, the duration
-        # of which is limited by entity's money search patience.
-        if entity.insurance > 0.0:
-            # Define a timeout process to represent search patience. Pass the value
-            # "gave up" if the process completes.
-            find_search_patience = self.env.timeout(search_patience, value='gave up')
-            
-            # Record when money search starts, if don't have insurance
-            money_search_start = self.env.now
-            
-            # At any point the entity has enough money to repair, stop looking.
-            while entity.recovery_funds.level < entity.property.damage_value:
-                
-                # Yield the patience timeout, the FEMA request, insurance claim request, and the loan request.
-                money_search_outcome = yield find_search_patience | ( try_insurance & try_loan & try_fema )
-    
-                # End looping if all recovery processes have completed.
-                if try_insurance.processed and try_loan.processed and try_fema.processed:
-                    break
-
-                # If patience process completes first, interrupt the insurance, FEMA,
-                # and SBA processes.
-                if 'gave up' in str(money_search_outcome).lower():
-                    if try_insurance.is_alive:
-                        try_insurance.interrupt(self.env.now)
-                    if try_fema.is_alive:
-                            try_fema.interrupt(self.env.now)
-                    if try_loan.is_alive:
-                        try_loan.interrupt(self.env.now)
-                    entity.gave_up_funding_search = self.env.now
-                    return
-        else:
-            # If no insurance, money search starts after disaster declaration
-            # Need to check current simulation time again when disaster declaration
-            # occurs to determine how much patience remains
-            money_search_start = max(fema_program.declaration, self.env.now)
-            patience_end = money_search_start + search_patience
-            patience_remain = patience_end - self.env.now
-            
-            # Define a timeout process to represent search patience. Pass the value
-            # "gave up" if the process completes.
-            find_search_patience = self.env.timeout(patience_remain, value='gave up')
-            
-            # At any point the entity has enough money to repair, stop looking.
-            while entity.recovery_funds.level < entity.property.damage_value:
-                # Yield the patience timeout and the loan request.
-                # No insurance so just yield FEMA & SBA loan request process.
-                money_search_outcome = yield find_search_patience | (try_loan & try_fema)
-                
-                # End looping if both recovery processes have completed
-                if try_loan.processed and try_fema.processed:
-                    break
-
-                # If patience process completes first, interrupt the insurance claim
-                # request and the loan request before ending process.
-                if 'gave up' in str(money_search_outcome).lower():
-                    if try_loan.is_alive:
-                        try_loan.interrupt(self.env.now)
-                    if try_fema.is_alive:
-                        try_fema.interrupt(self.env.now)
-                    entity.gave_up_funding_search = self.env.now
-                    return
-
-        # Record the duration when entity's search for money ends without
-        # giving up.
-        search_duration = self.env.now - money_search_start
-
-        # If entity (STILL) does not have enough repair money then indicate so and
-        # that options have been exhausted.
-        if entity.recovery_funds.level < entity.property.damage_value:
-            self.writeCompletedWithoutEnough(entity, search_duration)
-            return
-
-        # If entity completed search and obtained sufficient funding.
-        self.writeCompletedWithEnough(entity, search_duration)
+        yield from self.search(entity, search_patience, insurance = insurance_program,
+                                fema = fema_program, sba = sba_program)
 
 class Insurance_SBA_Sequential(FinancialRecoveryPolicy):
     """ A class that organizes funding requests to insurance and SBA in 
@@ -372,6 +384,8 @@ class Insurance_SBA_Sequential(FinancialRecoveryPolicy):
     Inheritance:
     FinancialRecoveryPolicy
     """
+    rounds = [(['insurance'], 'insured'), (['sba'], 'unfunded')]
+
     def __init__(self, env):
         FinancialRecoveryPolicy.__init__(self, env)
         """ Initiate Insurance_IA_SBA_Sequential object.
@@ -407,97 +421,8 @@ class Insurance_SBA_Sequential(FinancialRecoveryPolicy):
         entity.gave_up_funding_search -- Record time money search stops
         entity.recovery_funds.level -- Increase recovery funds amount in $
         """
-        # Return out of function if entity has enough money to repair and does not
-        # have any insurance coverage.
-        if (entity.recovery_funds.level >= entity.property.damage_value
-            and entity.insurance == 0.0):
-
-            self.writeHadEnough(entity)
-            return
-
-        # If entity has insurance then yield an insurance claim request, the duration
-        # of which is limited by entity's money search patience.
-        if entity.insurance > 0.0:
-
-            # Record when money search starts
-            money_search_start = self.env.now
-            patience_end = money_search_start + search_patience
-            patience_remain = patience_end - self.env.now
-            
-            # Define a timeout process to represent search patience, with duration
-            # equal to the *remaining* patience. Pass the value "gave up" if the
-            # process completes.
-            find_search_patience = self.env.timeout(patience_remain, value='gave up')
-
-            # Define insurance claim request process. Pass data about available
-            # insurance claim adjusters.
-            try_insurance = self.env.process(insurance_program.process(entity))
-
-            # Yield both the patience timeout and the insurance claim request.
-            # Pass result for the process that completes first.
-            money_search_outcome = yield find_search_patience | try_insurance
-
-            # Record when money search starts
-            money_search_start = entity.claim_put
-            
-            # If patience process completes first, interrupt the insurance claim
-            # request and return out of function.
-            if 'gave up' in str(money_search_outcome).lower():
-                if try_insurance.is_alive:
-                    try_insurance.interrupt(self.env.now)
-                entity.gave_up_funding_search = self.env.now
-                return
-
-            patience_remain = patience_end - self.env.now
-            
-        # If entity (still) does not have enough repair money then yield a loan
-        # request, the duration of which is limited by entity's money search patience.
-        if entity.recovery_funds.level < entity.property.damage_value:
-
-            # Define a timeout process to represent search patience, with duration
-            # equal to the *remaining* patience. Pass the value "Gave up" if the
-            # process completes.
-            if entity.insurance > 0.0:
-                # If has insurance, account for time it took to get claim
-                find_search_patience = self.env.timeout(patience_remain, value='gave up')
-            else:
-                # If no insurance, money search starts after disaster declaration
-                # Need to check current simulation time again when disaster declaration
-                # occurs to determine how much patience remains
-                money_search_start = max(sba_program.declaration, self.env.now)
-                patience_end = money_search_start + search_patience
-                patience_remain = patience_end - self.env.now
-                
-                find_search_patience = self.env.timeout(patience_remain, value='gave up')
-            
-            # Define loan request process. Pass data about available
-            # loan processors.
-            try_loan = self.env.process(sba_program.process(entity))
-
-            # Yield both the patience timeout and the loan request.
-            # Pass result for the process that completes first.
-            money_search_outcome = yield find_search_patience | try_loan
-
-            # If patience process completes first, interrupt the loan
-            # request and return out of function.
-            if 'gave up' in str(money_search_outcome).lower():
-                if try_loan.is_alive:
-                    try_loan.interrupt(self.env.now)
-                entity.gave_up_funding_search = self.env.now
-                return
-
-        # Record the duration when entity's search for money ends without
-        # giving up.
-        search_duration = self.env.now - money_search_start
-
-        # If entity (STILL) does not have enough repair money then indicate so and
-        # that options have been exhausted.
-        if entity.recovery_funds.level < entity.property.damage_value:
-            self.writeCompletedWithoutEnough(entity, search_duration)
-            return
-
-        # If entity completed search and obtained sufficient funding.
-        self.writeCompletedWithEnough(entity, search_duration)
+        yield from self.search(entity, search_patience, insurance = insurance_program,
+                                sba = sba_program)
 
 class Insurance_FirstThen_IA_SBA_Parallel(FinancialRecoveryPolicy):
     """ A class that organizes funding requests to insurance, FEMA, and SBA. 
@@ -512,6 +437,8 @@ class Insurance_FirstThen_IA_SBA_Parallel(FinancialRecoveryPolicy):
     Inheritance:
     FinancialRecoveryPolicy
     """
+    rounds = [(['insurance'], 'insured'), (['sba', 'fema'], 'always')]
+
     def __init__(self, env):
         """ Initiate Insurance_IA_SBA_Sequential object.
         
@@ -541,121 +468,8 @@ class Insurance_FirstThen_IA_SBA_Parallel(FinancialRecoveryPolicy):
         entity.gave_up_funding_search -- Record time money search stops
         entity.recovery_funds.level -- Increase recovery funds amount in $
         """
-
-        # Return out of function if entity has enough money to repair and does not
-        # have any insurance coverage.
-        if (entity.recovery_funds.level >= entity.property.damage_value
-            and entity.insurance == 0):
-
-            self.writeHadEnough(entity)
-            return
-        
-        # Define insurance claim request process. Define loan request process.
-        try_insurance = self.env.process(insurance_program.process(entity))
-        try_loan = self.env.process(sba_program.process(entity))
-        try_fema = self.env.process(fema_program.process(entity))
-
-        # If entity has insurance then yield an insurance claim request, the duration
-        # of which is limited by entity's money search patience.
-        if entity.insurance > 0.0:
-
-            
-            # At any point the entity has enough money to repair, stop looking.
-            while entity.recovery_funds.level < entity.property.damage_value:
-                # Record when money search starts 
-                money_search_start = self.env.now
-                
-                # Set patience parameters
-                patience_end = money_search_start + search_patience
-                patience_remain = patience_end - self.env.now
-
-                # Define a timeout process to represent search patience, with duration
-                # equal to the *remaining* patience. Pass the value "gave up" if the
-                # process completes.
-                find_search_patience = self.env.timeout(patience_remain, value='gave up')
-
-                # Define insurance claim request process. Pass data about available
-                # insurance claim adjusters.
-                try_insurance = self.env.process(insurance_program.process(entity))
-
-                # Yield both the patience timeout and the insurance claim request.
-                # Pass result for the process that completes first.
-                money_search_outcome = yield find_search_patience | try_insurance
-                
-                # If patience process completes first, interrupt the insurance claim
-                # request and return out of function.
-                if 'gave up' in str(money_search_outcome).lower():
-                    if try_insurance.is_alive:
-                        try_insurance.interrupt(self.env.now)
-                    entity.gave_up_funding_search = self.env.now
-                    return
-
-                # Calculate remaining patience and reset patience timeout to
-                # wait for FEMA and SBA processes to complete
-                patience_remain = patience_end - self.env.now
-                find_search_patience = self.env.timeout(patience_remain, value='gave up')
-                
-                # After insurance claim process has completed, can start FEMA and SBA process
-                # Yield the patience timeout, the FEMA request and the SBA request.
-                money_search_outcome = yield find_search_patience | (try_loan & try_fema)
-    
-                # End looping if FEMA and SBA processes have completed.
-                if try_loan.processed and try_fema.processed:
-                    break
-
-                # If patience process completes first, interrupt the FEMA
-                # and SBA processes.
-                if 'gave up' in str(money_search_outcome).lower():
-                    if try_fema.is_alive:
-                            try_fema.interrupt(self.env.now)
-                    if try_loan.is_alive:
-                        try_loan.interrupt(self.env.now)
-                    entity.gave_up_funding_search = self.env.now
-                    return
-        else:
-            # If no insurance, money search starts after disaster declaration
-            # Need to check current simulation time again when disaster declaration
-            # occurs to determine how much patience remains
-            money_search_start = max(fema_program.declaration, self.env.now)
-            patience_end = money_search_start + search_patience
-            patience_remain = patience_end - self.env.now
-            
-            # Define a timeout process to represent search patience. Pass the value
-            # "gave up" if the process completes.
-            find_search_patience = self.env.timeout(patience_remain, value='gave up')
-            
-            # At any point the entity has enough money to repair, stop looking.
-            while entity.recovery_funds.level < entity.property.damage_value:
-                # Yield the patience timeout and the loan request.
-                # No insurance so just yield FEMA & SBA loan request process.
-                money_search_outcome = yield find_search_patience | (try_loan & try_fema)
-                
-                # End looping if both recovery processes have completed
-                if try_loan.processed and try_fema.processed:
-                    break
-
-                # If patience process completes first, interrupt the insurance claim
-                # request and the loan request before ending process.
-                if 'gave up' in str(money_search_outcome).lower():
-                    if try_loan.is_alive:
-                        try_loan.interrupt(self.env.now)
-                    if try_fema.is_alive:
-                        try_fema.interrupt(self.env.now)
-                    entity.gave_up_funding_search = self.env.now
-                    return
-
-        # Record the duration when entity's search for money ends without
-        # giving up.
-        search_duration = self.env.now - money_search_start
-
-        # If entity (STILL) does not have enough repair money then indicate so and
-        # that options have been exhausted.
-        if entity.recovery_funds.level < entity.property.damage_value:
-            self.writeCompletedWithoutEnough(entity, search_duration)
-            return
-
-        # If entity completed search and obtained sufficient funding.
-        self.writeCompletedWithEnough(entity, search_duration)
+        yield from self.search(entity, search_patience, insurance = insurance_program,
+                                fema = fema_program, sba = sba_program)
 
 class Insurance_SBA_Parallel(FinancialRecoveryPolicy):
     """ A class that organizes funding requests to insurance and SBA in 
@@ -668,6 +482,8 @@ class Insurance_SBA_Parallel(FinancialRecoveryPolicy):
     Inheritance:
     FinancialRecoveryPolicy
     """
+    rounds = [(['insurance', 'sba'], 'always')]
+
     def __init__(self, env):
         FinancialRecoveryPolicy.__init__(self, env)
         """ Initiate Insurance_IA_SBA_Sequential object.
@@ -696,96 +512,8 @@ class Insurance_SBA_Parallel(FinancialRecoveryPolicy):
         entity.gave_up_funding_search -- Record time money search stops
         entity.recovery_funds.level -- Increase recovery funds amount in $
         """
-
-        # Return out of function if entity has enough money to repair and does not
-        # have any insurance coverage.
-        if (entity.recovery_funds.level >= entity.property.damage_value
-            and entity.insurance == 0.0):
-
-            self.writeHadEnough(entity)
-            return
-
-        # Define insurance claim request process. Define loan request process.
-        try_insurance = self.env.process(insurance_program.process(entity))
-        try_loan = self.env.process(sba_program.process(entity))
-
-        # If entity has insurance then yield an insurance claim request, the duration
-        # of which is limited by entity's money search patience.
-        if entity.insurance > 0.0:
-
-            # Define a timeout process to represent search patience. Pass the value
-            # "gave up" if the process completes.
-            find_search_patience = self.env.timeout(search_patience, value='gave up')
-            
-            # Record when money search starts, if don't have insurance
-            money_search_start = self.env.now
-            
-            # At any point the entity has enough money to repair, stop looking.
-            while entity.recovery_funds.level < entity.property.damage_value:
-
-                # Yield the patience timeout, the insurance claim request, and the loan request.
-                # Pass result for the process(es) that completes first.
-                money_search_outcome = yield find_search_patience | ( try_insurance & try_loan )
-
-                # Record when money search starts
-                money_search_start = entity.claim_put
-                
-                # End looping if both recovery processes have completed.
-                if try_insurance.processed and try_loan.processed:
-                    break
-
-                # If patience process completes first, interrupt the insurance claim
-                # request and the loan request before ending process.
-                if 'gave up' in str(money_search_outcome).lower():
-                    if try_insurance.is_alive:
-                        try_insurance.interrupt(self.env.now)
-                    if try_loan.is_alive:
-                        try_loan.interrupt(self.env.now)
-                    entity.gave_up_funding_search = self.env.now
-                    return
-        else:
-            # If no insurance, money search starts after disaster declaration
-            # Need to check current simulation time again when disaster declaration
-            # occurs to determine how much patience remains
-            money_search_start = max(sba_program.declaration, self.env.now)
-            patience_end = money_search_start + search_patience
-            patience_remain = patience_end - self.env.now
-            
-            # Define a timeout process to represent search patience. Pass the value
-            # "gave up" if the process completes.
-            find_search_patience = self.env.timeout(patience_remain, value='gave up')
-            
-            # Yield the patience timeout and the loan request.
-            # No insurance so just yield loan request process.
-            # Pass result for the process that completes first.
-            money_search_outcome = yield find_search_patience | try_loan
-
-            # Record when money search starts, if don't have insurance
-            if entity.insurance <= 0.0:
-                money_search_start = entity.sba_put
-            
-            # If patience process completes first, interrupt the insurance claim
-            # request and the loan request before ending process.
-            if 'gave up' in str(money_search_outcome).lower():
-                if try_loan.is_alive:
-                    try_loan.interrupt(self.env.now)
-                entity.gave_up_funding_search = self.env.now
-                return
-
-        # Record the time and duration when entity's search for money ends without
-        # giving up.
-        search_duration = self.env.now - money_search_start
-
-        # If entity (STILL) does not have enough repair money then indicate so and
-        # that options have been exhausted.
-        if entity.recovery_funds.level < entity.property.damage_value:
-
-            self.writeCompletedWithoutEnough(entity, search_duration)
-            
-            return
-
-        # If entity completed search and obtained sufficient funding.
-        self.writeCompletedWithEnough(entity, search_duration)
+        yield from self.search(entity, search_patience, insurance = insurance_program,
+                                sba = sba_program)
 
 class RepairVacantBuilding(object):
     """ A class to represent a large-scale/bulk policy for expedited repairing
@@ -840,16 +568,16 @@ class RepairVacantBuilding(object):
         """
         
         if entity.property.damage_state != 'None' and entity.property.listed:
-            if random.uniform(0, 1.0) > repair_probability:
+            if streams.uniform(self.env, entity, 'repair_probability') > repair_probability:
                 return
 
             get_building = yield building_stock.get(lambda getBuilding:
                                                     getBuilding.__dict__ == entity.property.__dict__
                                                 )
 
-            yield self.env.process(inspection_program.process(entity.property, entity))
+            yield from inspection_program.process(entity.property, entity)
             yield self.env.timeout(wait_time)
-            yield self.env.process(assessment_program.process(entity.property, entity))
-            yield self.env.process(permit_program.process(entity.property, entity))
-            yield self.env.process(repair_program.process(entity.property, entity))
+            yield from assessment_program.process(entity.property, entity)
+            yield from permit_program.process(entity.property, entity)
+            yield from repair_program.process(entity.property, entity)
             yield building_stock.put(get_building)
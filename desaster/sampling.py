@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of functions for running DESaster on a weighted, stratified sample of a
+large population of households. A sample of the io.importEntities() input is
+drawn within strata defined by damage state, tenure, and income band; each
+sampled household carries a weight (the number of households it represents).
+Recovery program staff, budgets, and materials are scaled by the sampling
+fraction so that sampled households compete for resources as the full
+population would. Weighted outputs are produced by io.output_summary(),
+io.milestone_curves(), visualize.dashboard(), and output.Output() whenever a
+'weight' attribute/column is present.
+
+Functions:
+stratifiedSample
+samplingFraction
+scalePrograms
+importSample
+estimateTotals
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from desaster.io import importEntities
+from simpy import Resource, Container
+from scipy.stats import norm
+import numpy as np
+import pandas as pd
+
+def stratifiedSample(entities_df, fraction, income_bands = 3, min_per_stratum = 2,
+                        seed = None):
+    """Return a stratified random sample of an entities dataframe with a 'weight'
+    column (households represented by each sampled household) and a 'stratum'
+    column. Strata are damage state x tenure x income quantile band. Each stratum
+    is sampled in proportion to its size but with at least min_per_stratum
+    households (or all of them, if fewer) so that every stratum is represented
+    and has an estimable variance.
+
+    Keyword Arguments:
+    entities_df -- Dataframe w/ entities' input attributes (see io.importEntities())
+    fraction -- Target sampling fraction (0 < fraction <= 1)
+    income_bands -- Number of income quantile bands used to form strata
+    min_per_stratum -- Minimum number of households sampled from each stratum
+    seed -- Seed for the sampling random number generator
+
+    Returns:
+    Dataframe with the sampled rows (index reset, as required by io.importEntities()).
+    """
+    if not 0.0 < fraction <= 1.0:
+        raise AttributeError("Sampling fraction ({0}) must be > 0 and <= 1.".format(fraction))
+
+    rng = np.random.RandomState(seed)
+
+    income = entities_df['income'].astype(float)
+    income_band = pd.qcut(income.rank(method = 'first'),
+                            min(income_bands, len(entities_df)), labels = False)
+    stratum = (entities_df['damage_state'].fillna('None').astype(str) + '|'
+                + entities_df['tenure'].astype(str) + '|'
+                + income_band.astype(str))
+
+    positions = []
+    weights = []
+    for key, rows in pd.Series(np.arange(len(entities_df))).groupby(stratum.values):
+        size = len(rows)
+        n = min(size, max(min_per_stratum, int(round(size * fraction))))
+        positions.append(rng.choice(rows.values, n, replace = False))
+        weights.append(np.full(n, size / float(n)))
+
+    positions = np.concatenate(positions)
+    order = np.argsort(positions)
+
+    sample_df = entities_df.iloc[positions[order]].reset_index(drop = True)
+    sample_df['weight'] = np.concatenate(weights)[order]
+    sample_df['stratum'] = stratum.values[positions[order]]
+
+    return sample_df
+
+def samplingFraction(sample_df):
+    """Return the realized sampling fraction of a sample from stratifiedSample()
+    (sample size / population size represented).
+    """
+    return len(sample_df) / sample_df['weight'].sum()
+
+def scalePrograms(programs, fraction):
+    """Scale the staff, budget, and materials of recovery programs by a sampling
+    fraction. Must be called before the programs are used in a simulation.
+
+    Staff are whole people, so scaled staff are rounded to the nearest integer
+    (at least 1); unlimited (inf) staff and budgets stay unlimited.
+
+    Keyword Arguments:
+    programs -- List of technical.TechnicalRecoveryProgram and/or
+                financial.FinancialRecoveryProgram objects
+    fraction -- Sampling fraction, e.g., from samplingFraction()
+
+    Attribute Changes:
+    program.staff, program.officers, program.inspectors -- Replaced with a
+                    simpy.Resource() with the scaled capacity
+    program.budget, program.materials -- Replaced with a simpy.Container() with
+                    the scaled level
+    """
+    for program in programs:
+        for name in ['staff', 'officers', 'inspectors']:
+            resource = getattr(program, name, None)
+            if not isinstance(resource, Resource):
+                continue
+            if resource.count > 0 or len(resource.queue) > 0:
+                raise AttributeError("{0} {1} already in use. Can't scale program.".format(
+                                        program.__class__.__name__, name))
+            capacity = resource.capacity
+            if capacity != float('inf'):
+                capacity = max(1, int(round(capacity * fraction)))
+            setattr(program, name, Resource(program.env, capacity = capacity))
+
+        for name in ['budget', 'materials']:
+            container = getattr(program, name, None)
+            if not isinstance(container, Container):
+                continue
+            if len(container.get_queue) > 0 or len(container.put_queue) > 0:
+                raise AttributeError("{0} {1} already in use. Can't scale program.".format(
+                                        program.__class__.__name__, name))
+            setattr(program, name, Container(program.env, init = container.level * fraction))
+
+    return programs
+
+def importSample(env, sample_df, entity_type, building_stock = None, write_story = False):
+    """Return list of entities from a sample produced by stratifiedSample(). Same
+    as io.importEntities() but each entity (and a renter's landlord) is also
+    given the sampled household's 'weight' and 'stratum' attributes, which are
+    carried through to io.households_to_df().
+
+    Keyword Arguments:
+    env -- Pointer to SimPy env environment.
+    sample_df -- Dataframe from stratifiedSample()
+    entity_type -- Indicate class of entity: Household, Owner, OwnerHousehold etc.
+    building_stock -- a SimPy FilterStore that acts as an occupied building stock.
+    write_story -- Boolean indicating whether to track a entities story.
+    """
+    entities = importEntities(env, sample_df, entity_type, building_stock, write_story)
+
+    for entity, weight, stratum in zip(entities, sample_df['weight'], sample_df['stratum']):
+        entity.weight = weight
+        entity.stratum = stratum
+        landlord = getattr(entity, 'landlord', None)
+        if landlord is not None:
+            landlord.weight = weight
+            landlord.stratum = stratum
+
+    return entities
+
+def estimateTotals(df, milestones, day = None, confidence = 0.95):
+    """Return weighted estimates of the number of households in the full
+    population that reached each milestone (by a given day), with confidence
+    bounds for the sampling error. Uses the stratified estimator of a total
+    with finite population correction:
+
+        var = sum_h N_h^2 * (1 - n_h / N_h) * s_h^2 / n_h
+
+    where N_h and n_h are the population and sample size of stratum h and s_h^2
+    is the sample variance of the milestone indicator within the stratum.
+
+    Keyword Arguments:
+    df -- Dataframe of simulation outputs w/ 'weight' and 'stratum' columns,
+            e.g., from io.households_to_df()
+    milestones -- List of milestone columns (e.g., 'inspection_get', 'repair_get')
+    day -- Count households that reached a milestone on or before this day
+            (None to count all that reached it)
+    confidence -- Confidence level of the bounds
+
+    Returns:
+    Dataframe indexed by milestone with columns 'estimate', 'std_error',
+    'lower', 'upper', 'proportion', and 'sampled'.
+    """
+    z = norm.ppf(0.5 + confidence / 2.0)
+    weight = df['weight'].astype(float).values
+    population = weight.sum()
+    strata = df['stratum'].values
+
+    estimates = pd.DataFrame(index = pd.Index(milestones, name = 'milestone'),
+                                columns = ['estimate', 'std_error', 'lower', 'upper',
+                                            'proportion', 'sampled'], dtype = float)
+
+    for milestone in milestones:
+        times = pd.to_numeric(df[milestone], errors = 'coerce')
+        if day is None:
+            reached = times.notnull().values.astype(float)
+        else:
+            reached = (times <= day).values.astype(float)
+
+        grouped = pd.DataFrame({'reached': reached, 'weight': weight}).groupby(strata)
+        n_h = grouped['reached'].count()
+        N_h = grouped['weight'].sum()
+        s2_h = grouped['reached'].var(ddof = 1).fillna(0.0)
+        variance = (N_h ** 2 * (1 - n_h / N_h).clip(lower = 0.0) * s2_h / n_h).sum()
+
+        estimate = (reached * weight).sum()
+        std_error = np.sqrt(variance)
+        estimates.loc[milestone] = [estimate, std_error,
+                                    max(0.0, estimate - z * std_error),
+                                    min(population, estimate + z * std_error),
+                                    estimate / population, reached.sum()]
+
+    return estimates
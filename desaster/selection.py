@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of functions for selecting the best of many alternatives (e.g.,
+combinations of FinancialRecoveryPolicy, FEMA budget, SBA deadline, and
+staffing) with a fixed budget of replications, by ranking and selection.
+
+Rather than giving every alternative the same number of replications,
+selectBest() gives each an initial few, then allocates the rest in rounds by
+Optimal Computing Budget Allocation (OCBA; Chen et al., 2000): alternatives
+whose means are far from the current best relative to their noise get few or
+no more replications, and the replications go to the best and to its closest
+contenders. Each round's replications run on the distributed workers.
+Replication k of every alternative uses seed + k, so alternatives are compared
+on common random numbers when the job function uses streams.RandomStreams.
+
+Functions:
+alternativeGrid
+allocateOCBA
+probabilityCorrect
+selectBest
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from desaster.distributed import BatchRunner
+from scipy.stats import norm
+import numpy as np
+import pandas as pd
+import itertools
+import os
+
+def alternativeGrid(**factors):
+    """Return a dictionary of alternatives, one per combination of factor
+    levels, keyed by a name like 'policy=Insurance_IA_SBA_Parallel, fema_budget=1e9'.
+
+    Keyword Arguments:
+    factors -- Lists of levels keyed by factor name (e.g., policy =
+                ['Insurance_IA_SBA_Sequential', 'Insurance_IA_SBA_Parallel'],
+                sba_deadline = [60, 180], inspectors = [10, 20])
+
+    Returns:
+    Dictionary of dictionaries of factor levels.
+    """
+    names = list(factors)
+    alternatives = {}
+    for levels in itertools.product(*(factors[name] for name in names)):
+        alternative = dict(zip(names, levels))
+        key = ', '.join('{0}={1}'.format(name, getattr(level, '__name__', level))
+                        for name, level in alternative.items())
+        alternatives[key] = alternative
+
+    return alternatives
+
+def allocateOCBA(means, stds, counts, increment, minimize = True):
+    """Return the number of additional replications for each alternative, by
+    OCBA, for the next increment replications.
+
+    Keyword Arguments:
+    means, stds, counts -- Arrays of each alternative's sample mean, standard
+                            deviation, and replications so far
+    increment -- Number of replications to allocate
+    minimize -- Whether the best alternative has the smallest mean (e.g., a
+                recovery time) rather than the largest
+
+    Returns:
+    Integer array of additional replications (summing to increment).
+    """
+    means = np.asarray(means, dtype = float)
+    counts = np.asarray(counts, dtype = float)
+    # Floor on the standard deviations, so zero-variance alternatives get some weight
+    stds = np.maximum(np.asarray(stds, dtype = float), 1e-9 * (1 + np.abs(means).max()))
+    k = len(means)
+
+    best = np.argmin(means) if minimize else np.argmax(means)
+    gaps = np.abs(means - means[best])
+    gaps = np.where(gaps > 0, gaps, 1e-9 * (1 + np.abs(means).max()))
+
+    # Optimal ratios: N_i proportional to (std_i / gap_i)^2 for the others, and
+    # N_best = std_best * sqrt(sum(N_i^2 / std_i^2)).
+    ratios = (stds / gaps) ** 2
+    others = np.arange(k) != best
+    ratios = ratios / ratios[others].max()
+    ratios[best] = stds[best] * np.sqrt((ratios[others] ** 2 / stds[others] ** 2).sum())
+
+    # Alternatives already above their share of the new total get none; the
+    # shares of the rest are recomputed without them.
+    total = counts.sum() + increment
+    active = np.ones(k, dtype = bool)
+    while True:
+        desired = np.zeros(k)
+        desired[active] = ratios[active] / ratios[active].sum() * (total - counts[~active].sum())
+        over = active & (desired < counts)
+        if not over.any():
+            break
+        active &= ~over
+
+    additional = np.where(active, desired - counts, 0.0)
+    additional = additional / additional.sum() * increment
+
+    # Round, giving the remainder to the largest fractions
+    allocation = np.floor(additional).astype(np.int64)
+    remainder = increment - allocation.sum()
+    allocation[np.argsort(allocation - additional)[:remainder]] += 1
+
+    return allocation
+
+def probabilityCorrect(means, stds, counts, minimize = True):
+    """Return the approximate probability that the alternative with the best
+    sample mean is the best (Bonferroni lower bound, normal approximation).
+    """
+    means = np.asarray(means, dtype = float)
+    variances = np.asarray(stds, dtype = float) ** 2 / np.asarray(counts, dtype = float)
+    best = np.argmin(means) if minimize else np.argmax(means)
+    others = np.arange(len(means)) != best
+
+    scale = np.sqrt(variances[others] + variances[best])
+    with np.errstate(divide = 'ignore'):
+        z = np.abs(means[others] - means[best]) / scale
+    return float(max(0.0, 1.0 - norm.sf(z).sum()))
+
+def selectBest(function, alternatives, metric, budget, initial = 5, increment = None,
+                minimize = True, target = None, seed = 0, measure = None, workers = None,
+                address = ('127.0.0.1', 0), authkey = None, retries = 2, heartbeat = 5.0):
+    """Select the best alternative within a budget of replications, allocating
+    the replications after the initial ones by OCBA.
+
+    Keyword Arguments:
+    function -- Module-level function function(alternative, seed) run by the
+                workers (see distributed.Coordinator()); returns a dictionary
+                of metrics, or a result that measure converts to one
+    alternatives -- Dictionary of alternatives (e.g., from alternativeGrid())
+                    keyed by name
+    metric -- Metric to rank the alternatives by, e.g., 'median_home_get'
+    budget -- Total number of replications of all alternatives
+    initial -- Replications of every alternative before allocating by OCBA
+    increment -- Replications per round (default: the number of workers, at
+                    least 2)
+    minimize -- Whether the best alternative has the smallest mean metric
+    target -- Optional probability of correct selection (e.g., 0.95) at which to
+                stop before the budget is spent
+    seed -- Seed of replication 0; replication k of each alternative uses seed + k
+    measure -- Optional function measure(result) that returns a dictionary of
+                metrics (e.g., sequential.outputMetrics())
+    workers -- Number of local worker processes to start (default:
+                os.cpu_count()); 0 to only use workers started separately
+    address, authkey, retries, heartbeat -- See distributed.Coordinator()
+
+    Returns:
+    (best, summary, runs): the name of the best alternative, a dataframe
+    indexed by alternative with the mean, std, and replications of the metric,
+    sorted best first, with the probability of correct selection in
+    summary.attrs['probability_correct'], and a dataframe of each
+    replication's metrics indexed by (alternative, replication).
+    """
+    names = list(alternatives)
+    k = len(names)
+    if k < 2:
+        raise AttributeError("At least two alternatives are needed for a selection.")
+    if initial < 2 or budget < k * initial:
+        raise AttributeError("Budget ({0}) must allow at least {1} initial replications of each of "
+                                "the {2} alternatives.".format(budget, max(initial, 2), k))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if increment is None:
+        increment = max(2, workers)
+
+    runner = BatchRunner(function, alternatives, seed, measure if measure is not None else dict,
+                            workers, address, authkey, retries, heartbeat)
+    values = runner.results  # Metrics dictionaries, by alternative and replication
+
+    def run(allocation):
+        """Run a round of replications (number per alternative) and wait for them."""
+        for name, size in zip(names, allocation):
+            if size > 0:
+                runner.submit(name, size)
+        runner.wait()
+
+    def statistics():
+        samples = []
+        for name in names:
+            if metric not in values[name][0]:
+                raise AttributeError("Metric ({0}) not returned by the replications.".format(metric))
+            samples.append(np.array([row[metric] for row in values[name]], dtype = float))
+        return (np.array([sample.mean() for sample in samples]),
+                np.array([sample.std(ddof = 1) for sample in samples]),
+                np.array([len(sample) for sample in samples]))
+
+    with runner:
+        run([initial] * k)
+        spent = k * initial
+        while spent < budget:
+            means, stds, counts = statistics()
+            if target is not None and probabilityCorrect(means, stds, counts, minimize) >= target:
+                break
+            size = min(increment, budget - spent)
+            run(allocateOCBA(means, stds, counts, size, minimize))
+            spent += size
+
+    means, stds, counts = statistics()
+    summary = pd.DataFrame({'mean': means, 'std': stds, 'replications': counts},
+                            index = pd.Index(names, name = 'alternative'))
+    summary = summary.sort_values('mean', ascending = minimize)
+    summary.attrs['probability_correct'] = probabilityCorrect(means, stds, counts, minimize)
+
+    runs = runner.table(['alternative', 'replication'])
+
+    return summary.index[0], summary, runs
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of classes and functions for global sensitivity analysis of recovery
+metrics to program parameters (e.g., inspector staff, SBA officers and
+max_loan, FEMA max_outlay and deadline, insurance deductible, repair staff and
+materials, declaration delays, and patience parameters).
+
+A SensitivityStudy has factors -- named parameters with (low, high) ranges,
+e.g., 'sba.officers': (5, 40) -- and a job function function(parameters,
+seed) that builds and runs a simulation with the parameters (see
+programArguments()) and returns a dictionary of metrics (e.g.,
+sequential.outputMetrics()). Designs are Latin hypercube samples or Saltelli
+designs built from a scrambled Sobol sequence. Design points are run on the
+distributed workers, and every point's metrics are cached on disk as they are
+completed (keyed by a hash of the parameters and seed), so points that were
+already run are never rerun: when a Sobol design is extended from n to 2n
+samples, its first n samples are the same points, and only the new ones run.
+
+sobolIndices() computes first-order (Saltelli et al., 2010) and total-effect
+(Jansen, 1999) indices, with bootstrap confidence intervals, from a Saltelli
+design of n * (factors + 2) points. firstOrderIndices() estimates first-order
+indices (correlation ratios) from any design, e.g., a Latin hypercube; total
+effects need the Saltelli design.
+
+Classes:
+SensitivityStudy
+
+Functions:
+programArguments
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from desaster.checkpoint import hashInputs
+from desaster.distributed import Coordinator, startLocalWorkers, stopWorkers
+from scipy.stats import qmc
+import json
+import os
+import numpy as np
+import pandas as pd
+
+def programArguments(parameters):
+    """Return parameters named 'program.argument' (e.g., 'sba.max_loan') as a
+    dictionary of keyword argument dictionaries by program, e.g.,
+    {'sba': {'max_loan': 200000}}, for RealPropertyLoanSBA(env, **args['sba']).
+    Parameters without a program prefix are keyed by None.
+    """
+    arguments = {}
+    for name, value in parameters.items():
+        program, _, argument = name.rpartition('.')
+        arguments.setdefault(program or None, {})[argument] = value
+
+    return arguments
+
+class SensitivityStudy(object):
+    """A class for global sensitivity analysis of a simulation's metrics to
+    named parameters, with designs evaluated in parallel and cached on disk.
+
+    Methods:
+    __init__(self, function, factors, directory = 'sensitivity', fixed = None,
+                replications = 1, seed = 0, measure = None)
+    latinHypercube(self, samples, seed = None)
+    sobolDesign(self, samples)
+    evaluate(self, design, workers = None, address = ('127.0.0.1', 0),
+                authkey = None, retries = 2, heartbeat = 5.0)
+    sobolIndices(self, samples, bootstrap = 100, confidence = 0.95, **kwargs)
+    firstOrderIndices(self, design, results, bins = 10)
+    """
+    def __init__(self, function, factors, directory = 'sensitivity', fixed = None,
+                    replications = 1, seed = 0, measure = None):
+        """Initiate a SensitivityStudy object, loading the cache in directory
+        if there is one.
+
+        Keyword Arguments:
+        function -- Module-level function function(parameters, seed) run by the
+                    workers (see distributed.Coordinator()); parameters is a
+                    dictionary of the fixed and factor values. Returns a
+                    dictionary of metrics, or a result that measure converts
+                    to one.
+        factors -- Dictionary of (low, high) ranges keyed by parameter name,
+                    e.g., {'insp.staff': (5, 50), 'fema.deadline': (180, 720)}.
+                    Factors with integer bounds take integer values.
+        directory -- Directory of the cache of evaluated points
+        fixed -- Dictionary of parameters that don't vary
+        replications -- Replications per design point (seeds seed to seed +
+                        replications - 1, the same at every point); the
+                        point's metrics are the replications' means
+        seed -- Seed of the first replication
+        measure -- Optional function measure(result) that returns a dictionary
+                    of metrics (e.g., sequential.outputMetrics())
+
+        Attribute Changes:
+        self.names -- List of factor names
+        self.cache -- Dictionary of cached metrics by point hash
+        """
+        if len(factors) == 0:
+            raise AttributeError("At least one factor is needed.")
+        for name, (low, high) in factors.items():
+            if not low < high:
+                raise AttributeError("Factor {0} range ({1}, {2}) must have low < high.".format(
+                                        name, low, high))
+
+        self.function = function
+        self.factors = factors
+        self.names = list(factors)
+        self.fixed = {} if fixed is None else dict(fixed)
+        self.replications = replications
+        self.seed = seed
+        self.measure = measure
+
+        self.directory = directory
+        self.cache_path = os.path.join(directory, 'cache.jsonl')
+        self.cache = {}
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.cache[entry['key']] = entry['metrics']
+
+    def _integer(self, name):
+        """Whether a factor takes integer values (its bounds are integers)."""
+        return all(isinstance(bound, (int, np.integer)) for bound in self.factors[name])
+
+    def _scale(self, unit):
+        """Return a design dataframe of factor values from points in the unit cube."""
+        design = {}
+        for j, name in enumerate(self.names):
+            low, high = self.factors[name]
+            if self._integer(name):
+                values = np.minimum(np.floor(low + unit[:, j] * (high - low + 1)), high).astype(np.int64)
+            else:
+                values = low + unit[:, j] * (high - low)
+            design[name] = values
+
+        return pd.DataFrame(design)
+
+    def latinHypercube(self, samples, seed = None):
+        """Return a Latin hypercube design of samples points (a dataframe with a
+        column per factor). The same samples and seed give the same points, but
+        designs of different sizes don't share points.
+        """
+        sampler = qmc.LatinHypercube(d = len(self.names), rng = self.seed if seed is None else seed)
+        return self._scale(sampler.random(samples))
+
+    def sobolDesign(self, samples):
+        """Return a Saltelli design of samples * (factors + 2) points, with
+        columns block ('A', 'B', or the factor whose column of A is taken from B)
+        and sample, and a column per factor. samples must be a power of 2; a
+        design's points are included in the design with twice the samples.
+        """
+        if samples < 2 or samples & (samples - 1):
+            raise AttributeError("Samples ({0}) must be a power of 2.".format(samples))
+
+        k = len(self.names)
+        sampler = qmc.Sobol(d = 2 * k, scramble = True, rng = self.seed)
+        points = sampler.random(samples)
+        a, b = points[:, :k], points[:, k:]
+
+        blocks = [('A', a), ('B', b)]
+        for j, name in enumerate(self.names):
+            ab = a.copy()
+            ab[:, j] = b[:, j]
+            blocks.append((name, ab))
+
+        design = []
+        for block, unit in blocks:
+            part = self._scale(unit)
+            part.insert(0, 'sample', np.arange(samples))
+            part.insert(0, 'block', block)
+            design.append(part)
+
+        return pd.concat(design, ignore_index = True)
+
+    def _parameters(self, row):
+        """Return the job parameters of a design row, as plain Python values."""
+        parameters = dict(self.fixed)
+        for name in self.names:
+            parameters[name] = int(row[name]) if self._integer(name) else float(row[name])
+        return parameters
+
+    def _key(self, parameters, seed):
+        function = '{0}.{1}'.format(self.function.__module__, self.function.__qualname__)
+        return hashInputs({'function': function, 'parameters': parameters, 'seed': seed})
+
+    def evaluate(self, design, workers = None, address = ('127.0.0.1', 0),
+                    authkey = None, retries = 2, heartbeat = 5.0):
+        """Return the metrics of every point of a design, running only the
+        (point, replication) jobs that aren't cached, and adding their metrics
+        to the cache as they are completed.
+
+        Keyword Arguments:
+        design -- Design dataframe, e.g., from latinHypercube() or sobolDesign()
+        workers -- Number of local worker processes to start (default:
+                    os.cpu_count()); 0 to only use workers started separately
+        address, authkey, retries, heartbeat -- See distributed.Coordinator()
+
+        Returns:
+        Dataframe of metrics with the design's index.
+        """
+        seeds = [self.seed + i for i in range(self.replications)]
+        points = [self._parameters(row) for row in design[self.names].to_dict('records')]
+
+        jobs = {}
+        for parameters in points:
+            for seed in seeds:
+                key = self._key(parameters, seed)
+                if key not in self.cache and key not in jobs:
+                    jobs[key] = (parameters, seed)
+
+        if jobs:
+            if workers is None:
+                workers = os.cpu_count() or 1
+            os.makedirs(self.directory, exist_ok = True)
+            keys = list(jobs)
+            coordinator = Coordinator(self.function, [jobs[key] for key in keys], address,
+                                        authkey, retries, heartbeat)
+            processes = startLocalWorkers(coordinator.address, workers, coordinator.authkey)
+            try:
+                with open(self.cache_path, 'a') as f:
+                    for job_id, parameters, seed, result in coordinator.results():
+                        metrics = self.measure(result) if self.measure is not None else result
+                        metrics = {metric: float(value) for metric, value in dict(metrics).items()}
+                        self.cache[keys[job_id]] = metrics
+                        f.write(json.dumps({'key': keys[job_id], 'parameters': parameters,
+                                            'seed': seed, 'metrics': metrics}) + '\n')
+                        f.flush()
+            finally:
+                stopWorkers(coordinator, processes)
+
+        rows = [pd.DataFrame([self.cache[self._key(parameters, seed)] for seed in seeds]).mean()
+                for parameters in points]
+
+        return pd.DataFrame(rows, index = design.index)
+
+    def sobolIndices(self, samples, bootstrap = 100, confidence = 0.95, **kwargs):
+        """Evaluate a Saltelli design and return first-order and total-effect
+        indices of every metric to every factor.
+
+        Keyword Arguments:
+        samples -- Samples of the design (a power of 2); see sobolDesign()
+        bootstrap -- Number of bootstrap resamples of the samples for the
+                        confidence intervals (0 for none)
+        confidence -- Confidence level of the intervals
+        kwargs -- Passed to evaluate() (e.g., workers)
+
+        Returns:
+        Dataframe indexed by (metric, factor) with columns first_order,
+        first_order_lower, first_order_upper, total, total_lower, total_upper,
+        and samples (the samples without missing metric values).
+        """
+        design = self.sobolDesign(samples)
+        results = self.evaluate(design, **kwargs)
+        random_state = np.random.RandomState(self.seed)
+        resamples = [random_state.randint(0, samples, samples) for i in range(bootstrap)]
+        alpha = (1 - confidence) / 2
+
+        def estimate(a, b, ab):
+            variance = np.concatenate([a, b]).var()
+            if variance == 0:
+                return np.nan, np.nan
+            first = np.mean(b * (ab - a)) / variance
+            total = 0.5 * np.mean((a - ab) ** 2) / variance
+            return first, total
+
+        rows = []
+        for metric in results.columns:
+            values = results[metric].values.reshape(len(self.names) + 2, samples)
+            a, b = values[0], values[1]
+            for j, name in enumerate(self.names):
+                ab = values[2 + j]
+                valid = ~(np.isnan(a) | np.isnan(b) | np.isnan(ab))
+                first, total = estimate(a[valid], b[valid], ab[valid])
+                row = {'metric': metric, 'factor': name, 'first_order': first, 'total': total,
+                        'samples': int(valid.sum())}
+
+                if bootstrap > 0 and valid.sum() > 1:
+                    estimates = np.array([estimate(a[index], b[index], ab[index])
+                                            for index in (sample[valid[sample]] for sample in resamples)])
+                    with np.errstate(all = 'ignore'):
+                        lower, upper = np.nanquantile(estimates, [alpha, 1 - alpha], axis = 0)
+                    row.update({'first_order_lower': lower[0], 'first_order_upper': upper[0],
+                                'total_lower': lower[1], 'total_upper': upper[1]})
+                rows.append(row)
+
+        columns = ['metric', 'factor', 'first_order', 'first_order_lower', 'first_order_upper',
+                    'total', 'total_lower', 'total_upper', 'samples']
+        return pd.DataFrame(rows).reindex(columns = columns).set_index(['metric', 'factor'])
+
+    def firstOrderIndices(self, design, results, bins = 10):
+        """Return first-order indices (correlation ratios: the variance of the
+        metric's mean in quantile bins of a factor, divided by the metric's
+        variance) of every metric to every factor, from any design (e.g., a Latin
+        hypercube) and its evaluate() results. Biased upward for small designs.
+
+        Returns:
+        Dataframe indexed by metric with a column per factor.
+        """
+        indices = pd.DataFrame(index = pd.Index(results.columns, name = 'metric'),
+                                columns = self.names, dtype = float)
+        for metric in results.columns:
+            y = results[metric]
+            valid = y.notnull()
+            variance = y[valid].var(ddof = 0)
+            for name in self.names:
+                x = design.loc[valid, name]
+                groups = pd.qcut(x.rank(method = 'first'), min(bins, int(valid.sum())), labels = False)
+                means = y[valid].groupby(groups).mean()
+                weights = y[valid].groupby(groups).size() / valid.sum()
+                between = (weights * (means - y[valid].mean()) ** 2).sum()
+                indices.loc[metric, name] = between / variance if variance > 0 else np.nan
+
+        return indices
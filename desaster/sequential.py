@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of functions for running ensembles to a target precision rather than
+for a fixed number of replications.
+
+The user names replication-level metrics (e.g., the median home_get, or the
+fraction of households that gave up their funding search) and, for each, a
+target relative half-width of its confidence interval (e.g., 0.05 for +/- 5%
+of the mean). runToPrecision() runs each scenario's replications in batches on
+the distributed workers, and after each batch checks every metric's t
+confidence interval. A scenario stops when all its metrics meet their targets
+or it reaches the maximum number of replications; the size of its next batch is
+the number of replications the current intervals project are still needed (at
+most batch), so converged or nearly converged scenarios don't use workers that
+other scenarios need. Several scenarios' batches run at the same time on one
+set of workers.
+
+Replication i of every scenario uses seed + i, so with streams.RandomStreams
+the scenarios are compared on common random numbers, and the result depends
+only on the seeds, not on the order in which jobs finish.
+
+Functions:
+outputMetrics
+intervalPrecision
+runToPrecision
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from desaster.distributed import BatchRunner
+from scipy.stats import t
+import numpy as np
+import pandas as pd
+import math
+import os
+
+def outputMetrics(df):
+    """Return common replication-level metrics of a replication's entity
+    outputs (e.g., from io.households_to_df()): the median home_get, repair_get,
+    and occupy_get of the entities that reached them, and the fractions of
+    entities that gave up their funding or home search.
+    """
+    columns = ['home_get', 'repair_get', 'occupy_get',
+                'gave_up_funding_search', 'gave_up_home_search']
+    values = df.reindex(columns = columns).apply(pd.to_numeric, errors = 'coerce')
+
+    return {'median_home_get': values['home_get'].median(),
+            'median_repair_get': values['repair_get'].median(),
+            'median_occupy_get': values['occupy_get'].median(),
+            'gave_up_funding_rate': values['gave_up_funding_search'].notnull().mean(),
+            'gave_up_home_rate': values['gave_up_home_search'].notnull().mean()}
+
+def intervalPrecision(values, confidence = 0.95):
+    """Return (mean, half-width, relative half-width) of the t confidence
+    interval of the mean of a metric's replication values (NaN values are
+    ignored). The relative half-width is infinite if there are fewer than two
+    values or the mean is 0 (and the half-width isn't).
+    """
+    values = np.asarray(values, dtype = float)
+    values = values[~np.isnan(values)]
+    n = len(values)
+    if n < 2:
+        return (values.mean() if n else np.nan), np.inf, np.inf
+
+    mean = values.mean()
+    half_width = t.ppf((1 + confidence) / 2, n - 1) * values.std(ddof = 1) / math.sqrt(n)
+    if half_width == 0:
+        relative = 0.0
+    elif mean == 0:
+        relative = np.inf
+    else:
+        relative = half_width / abs(mean)
+
+    return mean, half_width, relative
+
+def runToPrecision(function, scenarios, targets, batch = None, min_replications = 5,
+                    max_replications = 100, confidence = 0.95, seed = 0, measure = None,
+                    workers = None, address = ('127.0.0.1', 0), authkey = None,
+                    retries = 2, heartbeat = 5.0):
+    """Run replications of each scenario until every target metric's confidence
+    interval is tight enough, or the maximum number of replications is reached.
+
+    Keyword Arguments:
+    function -- Module-level function function(scenario, seed) run by the
+                workers (see distributed.Coordinator()); returns a dictionary
+                of metrics, or a result that measure converts to one
+    scenarios -- Dictionary of scenarios (e.g., dictionaries of program
+                parameters) keyed by name, or a single scenario
+    targets -- Dictionary of target relative half-widths keyed by metric, e.g.,
+                {'median_home_get': 0.02, 'gave_up_funding_rate': 0.1}
+    batch -- Maximum replications per batch of a scenario (default: the number
+                of workers, at least 2)
+    min_replications -- Replications of a scenario's first batch
+    max_replications -- Cap on a scenario's replications
+    confidence -- Confidence level of the intervals
+    seed -- Seed of replication 0; replication i uses seed + i
+    measure -- Optional function measure(result) that returns a dictionary of
+                metrics, run on the coordinator (e.g., outputMetrics() if
+                function returns entity outputs). It is cheaper to return the
+                metrics from function.
+    workers -- Number of local worker processes to start (default:
+                os.cpu_count()); 0 to only use workers started separately
+    address, authkey, retries, heartbeat -- See distributed.Coordinator()
+
+    Returns:
+    (summary, runs): a dataframe indexed by (scenario, metric) with the mean,
+    half_width, relative (half-width), target, converged, and replications, and
+    a dataframe of each replication's metrics indexed by (scenario, replication).
+    """
+    if not isinstance(scenarios, dict):
+        scenarios = {'scenario': scenarios}
+    if len(targets) == 0:
+        raise AttributeError("At least one target metric is needed.")
+    if min_replications < 2 or max_replications < min_replications:
+        raise AttributeError("Replications must satisfy 2 <= min_replications ({0}) <= "
+                                "max_replications ({1}).".format(min_replications, max_replications))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if batch is None:
+        batch = max(2, workers)
+
+    runner = BatchRunner(function, scenarios, seed, measure if measure is not None else dict,
+                            workers, address, authkey, retries, heartbeat)
+    values = runner.results  # Metrics dictionaries, by scenario and replication
+
+    def nextBatch(name):
+        """Replications still needed by a scenario, projected from its intervals."""
+        n = len(values[name])
+        if n >= max_replications:
+            return 0
+        runs = pd.DataFrame(values[name])
+        needed = n
+        for metric, target in targets.items():
+            if metric not in runs.columns:
+                raise AttributeError("Target metric ({0}) not returned by the replications.".format(metric))
+            mean, half_width, relative = intervalPrecision(runs[metric].values, confidence)
+            if relative > target:
+                # Half-width shrinks with the square root of the replications
+                projected = n * (relative / target) ** 2 if np.isfinite(relative) else n + batch
+                needed = max(needed, math.ceil(projected))
+        return min(needed - n, batch, max_replications - n)
+
+    with runner:
+        for name in scenarios:
+            runner.submit(name, min_replications)
+
+        while runner.running:
+            name, replication, metrics = runner.next()
+            # A scenario's batch is done: decide on its next one
+            if runner.outstanding[name] == 0:
+                size = nextBatch(name)
+                if size > 0:
+                    runner.submit(name, size)
+
+    runs = runner.table(['scenario', 'replication'])
+
+    summary = []
+    for name in scenarios:
+        for metric, target in targets.items():
+            mean, half_width, relative = intervalPrecision(runs.loc[name, metric].values, confidence)
+            summary.append({'scenario': name, 'metric': metric, 'mean': mean,
+                            'half_width': half_width, 'relative': relative, 'target': target,
+                            'converged': relative <= target, 'replications': len(values[name])})
+
+    return pd.DataFrame(summary).set_index(['scenario', 'metric']), runs
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of classes and functions for a persistent local simulation job server
+with warm worker processes.
+
+A SimulationServer keeps a pool of worker processes that have imported
+desaster (and so the HAZUS tables) and run a preload function once, e.g., to
+read the input spreadsheets into dataframes. Jobs -- (scenario, seed) pairs --
+are accepted from clients (e.g., dashboard notebooks) through a simple local
+API: one line of JSON per request over a TCP connection, answered by lines of
+JSON with the job's progress and, last, its result. Jobs from several clients
+run concurrently, up to the number of workers. Since the workers are already
+warm, a what-if run starts without re-importing desaster or re-reading inputs.
+
+A job function has the form function(scenario, seed, inputs, progress), where
+inputs is the return value of the preload function and progress(message) sends
+a dictionary (e.g., {'day': env.now}) to the client; reportProgress() is a
+SimPy process that does so at regular simulation intervals. A dataframe
+returned by the job function is sent to the client as a dataframe.
+
+If a worker process dies during a job (e.g., out of memory), the process pool
+breaks: every job running at that moment fails, not just the one whose worker
+died. The pool is then restarted and those jobs are resubmitted (their clients
+get a 'restarted' message), up to retries times each; a job whose worker
+keeps dying gets an error.
+
+Start a server with, e.g.,
+
+    python -m desaster.server mymodel:runScenario --preload mymodel:loadInputs
+
+and submit jobs with submitJob(). The server only listens on the local host by
+default.
+
+Classes:
+SimulationServer
+
+Functions:
+reportProgress
+submitJob
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import StringIO
+import asyncio
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import traceback
+import pandas as pd
+from simpy.events import Event, URGENT
+
+class SimulationServer(object):
+    """A class to run simulation jobs from local clients on a pool of warm
+    worker processes.
+
+    Methods:
+    __init__(self, function, preload = None, workers = None, address = ('127.0.0.1', 8765),
+                retries = 2)
+    serve(self)
+    run(self)
+    close(self)
+    """
+    def __init__(self, function, preload = None, workers = None, address = ('127.0.0.1', 8765),
+                    retries = 2):
+        """Initiate a SimulationServer object and start its worker processes.
+
+        Keyword Arguments:
+        function -- Module-level function function(scenario, seed, inputs, progress)
+                    that runs one job and returns its (JSON-serializable or
+                    dataframe) result
+        preload -- Module-level function called once in each worker; its
+                    return value is passed to function as inputs (e.g., the
+                    input dataframes). None to pass inputs = None.
+        workers -- Number of worker processes (default: os.cpu_count())
+        address -- (host, port) to listen on. Port 0 picks a free port.
+        retries -- Number of times a job is resubmitted when the pool breaks
+                    (a worker process dies) while it runs
+
+        Attribute Changes:
+        self.address -- (host, port) the server is listening on, once serving
+        self.pool -- The concurrent.futures.ProcessPoolExecutor of warm workers
+        """
+        self.function = function
+        self.preload = preload
+        self.address = address
+        self.retries = retries
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+
+        # Workers send progress messages to the server through this queue.
+        self.progress = multiprocessing.Queue()
+        self.pool = self._startPool()
+
+        self.job_ids = itertools.count()
+        self.listeners = {}
+        self.server = None
+        self.restart_lock = asyncio.Lock()
+
+    def _startPool(self):
+        """Return a new pool of workers, started (warmed up) now rather than at
+        the first jobs.
+        """
+        pool = ProcessPoolExecutor(max_workers = self.workers, initializer = _initWorker,
+                                    initargs = (self.preload, self.progress))
+        for future in [pool.submit(_ping) for i in range(self.workers)]:
+            future.result()
+        return pool
+
+    async def _restartPool(self, pool):
+        """Replace a broken pool (e.g., after a worker process died) with a new
+        one, unless another job already has.
+        """
+        async with self.restart_lock:
+            if self.pool is pool:
+                pool.shutdown(wait = False, cancel_futures = True)
+                loop = asyncio.get_running_loop()
+                self.pool = await loop.run_in_executor(None, self._startPool)
+
+    async def serve(self):
+        """Accept client connections and serve their jobs until closed (a
+        coroutine).
+        """
+        loop = asyncio.get_running_loop()
+        relay = threading.Thread(target = self._relayProgress, args = (loop,), daemon = True)
+        relay.start()
+
+        self.server = await asyncio.start_server(self._handle, *self.address)
+        self.address = self.server.sockets[0].getsockname()[:2]
+        async with self.server:
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+    def run(self):
+        """Serve jobs until interrupted (e.g., with Ctrl-C)."""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop accepting connections and shut down the worker processes."""
+        if self.server is not None:
+            self.server.close()
+        self.progress.put(None)
+        self.pool.shutdown(cancel_futures = True)
+
+    def _relayProgress(self, loop):
+        """Pass progress messages from the workers to the jobs' clients."""
+        while True:
+            message = self.progress.get()
+            if message is None:
+                return
+            key, content = message
+            listener = self.listeners.get(key)
+            if listener is not None:
+                loop.call_soon_threadsafe(listener.put_nowait, content)
+
+    async def _handle(self, reader, writer):
+        """Serve one client connection: one job per line of JSON."""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+
+                job_id = next(self.job_ids)
+                try:
+                    request = json.loads(line)
+                    scenario = request.get('scenario')
+                    seed = request.get('seed')
+                except (ValueError, AttributeError) as e:
+                    await _write(writer, {'job': job_id, 'event': 'error',
+                                            'error': "Bad request: {0}".format(e)})
+                    continue
+
+                await _write(writer, {'job': job_id, 'event': 'started'})
+                ok, result = await self._runAttempts(writer, job_id, scenario, seed)
+                if ok:
+                    await _write(writer, dict({'job': job_id, 'event': 'result'}, **result))
+                else:
+                    await _write(writer, {'job': job_id, 'event': 'error', 'error': result})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _runAttempts(self, writer, job_id, scenario, seed):
+        """Run a job, streaming its progress to the client, and resubmit it if
+        the pool breaks while it runs. Returns (ok, result or error message).
+        """
+        for attempt in range(self.retries + 1):
+            # Progress is keyed by attempt, so that messages from a lost attempt
+            # don't reach the next one.
+            key = (job_id, attempt)
+            listener = asyncio.Queue()
+            self.listeners[key] = listener
+            pool = self.pool
+
+            try:
+                future = asyncio.wrap_future(pool.submit(_runJob, self.function, key, scenario, seed))
+
+                # Stream progress until the worker's end of job message (None),
+                # or until the job fails without sending one (e.g., its worker
+                # process died).
+                while True:
+                    getter = asyncio.ensure_future(listener.get())
+                    if not future.done():
+                        await asyncio.wait([getter, future], return_when = asyncio.FIRST_COMPLETED)
+                    if future.done() and future.exception() is not None and not getter.done():
+                        getter.cancel()
+                        break
+                    content = await getter
+                    if content is None:
+                        break
+                    await _write(writer, {'job': job_id, 'event': 'progress',
+                                            'progress': content})
+
+                return await future
+            except BrokenProcessPool as e:
+                await self._restartPool(pool)
+                error = "Worker process died during the job: {0}".format(e)
+                if attempt < self.retries:
+                    await _write(writer, {'job': job_id, 'event': 'restarted',
+                                            'attempt': attempt + 1})
+            except Exception:
+                return False, traceback.format_exc()
+            finally:
+                del self.listeners[key]
+
+        return False, error
+
+async def _write(writer, message):
+    writer.write(json.dumps(message).encode() + b'\n')
+    await writer.drain()
+
+# Worker process state, set by _initWorker()
+_inputs = None
+_progress = None
+
+def _initWorker(preload, progress):
+    """Warm up a worker: import desaster and run the preload function."""
+    global _inputs, _progress
+    import desaster
+
+    _progress = progress
+    if preload is not None:
+        _inputs = preload()
+
+def _ping():
+    return os.getpid()
+
+def _runJob(function, key, scenario, seed):
+    """Run one job in a worker; return (ok, result or traceback)."""
+    def progress(content):
+        _progress.put((key, content))
+
+    try:
+        result = function(scenario, seed, _inputs, progress)
+        if isinstance(result, pd.DataFrame):
+            return True, {'dataframe': result.to_json(orient = 'split', date_format = 'iso')}
+        return True, {'result': result}
+    except Exception:
+        return False, traceback.format_exc()
+    finally:
+        # End of job: sent after (so received after) all progress messages
+        _progress.put((key, None))
+
+def reportProgress(env, progress, until, every = 30):
+    """Return a process (generator) that reports the simulation time to a job's
+    client every 'every' simulation days and at until, e.g.,
+        env.process(reportProgress(env, progress, until = 720, every = 30))
+        env.run(until = 720)
+
+    Keyword Arguments:
+    env -- simpy.Environment() object
+    progress -- The progress function passed to the job function
+    until -- Simulation time of the last report (e.g., the run's end time)
+    every -- Simulation days between reports
+    """
+    # env.run(until) stops before the events at until, so the last report is
+    # scheduled (urgently) now, before the run schedules its stop event.
+    final = Event(env)
+    final._ok = True
+    final._value = None
+    final.callbacks.append(lambda event: progress({'day': env.now, 'until': until}))
+    env.schedule(final, URGENT, max(until - env.now, 0))
+
+    return _reportEvery(env, progress, until, every)
+
+def _reportEvery(env, progress, until, every):
+    """Report the simulation time every 'every' days before until."""
+    while env.now + every < until:
+        yield env.timeout(every)
+        progress({'day': env.now, 'until': until})
+
+def submitJob(scenario, seed = None, address = ('127.0.0.1', 8765), progress = None):
+    """Submit a job to a SimulationServer and wait for its result.
+
+    Keyword Arguments:
+    scenario -- JSON-serializable scenario (e.g., a dictionary of program parameters)
+    seed -- Random seed for the job
+    address -- (host, port) of the server
+    progress -- Optional function progress(message) called with each progress
+                message (e.g., print)
+
+    Returns:
+    The job's result (a dataframe if the job function returned one).
+    """
+    with socket.create_connection(tuple(address)) as connection:
+        connection.sendall(json.dumps({'scenario': scenario, 'seed': seed}).encode() + b'\n')
+
+        with connection.makefile('r') as lines:
+            for line in lines:
+                message = json.loads(line)
+                if message['event'] == 'progress':
+                    if progress is not None:
+                        progress(message['progress'])
+                elif message['event'] == 'error':
+                    raise RuntimeError("Job {0} failed:\n{1}".format(message['job'], message['error']))
+                elif message['event'] == 'result':
+                    if 'dataframe' in message:
+                        return pd.read_json(StringIO(message['dataframe']), orient = 'split')
+                    return message['result']
+
+    raise RuntimeError("Server closed the connection before returning a result.")
+
+def _importFunction(name):
+    """Import a function given as 'module:function'."""
+    module, function = name.split(':')
+    return getattr(importlib.import_module(module), function)
+
+if __name__ == '__main__':
+    # python -m desaster.server module:function [--preload module:function]
+    #                           [--workers N] [--port PORT]
+    import argparse
+    parser = argparse.ArgumentParser(description = "DESaster simulation job server")
+    parser.add_argument('function', help = "Job function, as module:function")
+    parser.add_argument('--preload', help = "Preload function, as module:function")
+    parser.add_argument('--workers', type = int, default = None)
+    parser.add_argument('--port', type = int, default = 8765)
+    args = parser.parse_args()
+
+    # Use the importable module, so workers can unpickle its functions.
+    from desaster import server
+
+    sys.path.insert(0, os.getcwd())
+    preload = server._importFunction(args.preload) if args.preload else None
+    server.SimulationServer(server._importFunction(args.function), preload, args.workers,
+                            ('127.0.0.1', args.port)).run()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of classes for batched (e.g., daily) service of recovery program
+requests, as an alternative to individual staff requests and releases.
+
+A program with a service window collects the requests that arrive within each
+window (e.g., a day) and, at the end of the window, assigns waiting cases to
+staff in first come, first served order in a single scheduling step: each staff
+member works through cases back to back, and is assigned cases that they can
+start within the next window. Other cases wait for the next window. Completed
+cases are reported at the end of the window in which they finish, so all cases
+completing in the same window share one completion event. This models an agency
+working through its case backlog and replaces the three scheduler events per
+request of the individual discipline (staff request, timeout, release) with one
+event per case plus a few shared events per window.
+
+Classes:
+BatchedService
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from collections import deque
+from heapq import heappush, heappop, heapreplace
+from math import ceil
+from simpy.events import Event
+
+class BatchedService(object):
+    """A class to assign a program's cases to its staff in batches, once per
+    service window.
+
+    Methods:
+    __init__(self, env, program, staff = 'staff', window = 1.0)
+    serve(self, duration)
+    request(self, duration)
+    cancel(self, case)
+    """
+    def __init__(self, env, program, staff = 'staff', window = 1.0):
+        """Initiate a BatchedService object.
+
+        Keyword Arguments:
+        env -- simpy.Environment() object
+        program -- The recovery program object whose staff serve the cases
+        staff -- Name of the program's simpy.Resource() attribute that sets the
+                number of staff (e.g., 'staff', 'officers', 'inspectors'). Its
+                capacity is read at each dispatch, so changes to it (e.g., by
+                sampling.scalePrograms() or branching.applyChanges()) apply.
+        window -- Duration of the service window (e.g., 1.0 for daily batches)
+
+        Attribute Changes:
+        self.pending -- Cases waiting to be assigned to staff
+        self.free -- Heap of the times at which each staff member is next free
+        """
+        if window <= 0:
+            raise AttributeError("Service window ({0}) must be > 0.".format(window))
+
+        self.env = env
+        self.program = program
+        self.staff = staff
+        self.window = window
+
+        self.pending = deque()
+        self.free = []
+        self.dispatch = None
+        self.dispatch_time = float('-inf')
+        self.completions = {}
+
+    def serve(self, duration):
+        """A process (generator) to wait for a case to be assigned to staff and
+        completed. Use with 'yield from', e.g.:
+            yield from program.service.serve(program.duration.rvs())
+
+        If the waiting process is interrupted before the case is assigned, the
+        case is withdrawn; once assigned, the staff time is committed.
+
+        Keyword Arguments:
+        duration -- Time staff need to complete the case
+        """
+        case = self.request(duration)
+
+        try:
+            completion = yield case
+        except BaseException:
+            self.cancel(case)
+            raise
+
+        yield completion
+
+    def request(self, duration):
+        """Add a case to the waiting cases and return it. The case is a simpy
+        event that succeeds, when the case is assigned to staff, with the (shared)
+        event at which the case is completed.
+        """
+        case = _Case(self.env, duration)
+        self.pending.append(case)
+
+        if self.dispatch is None:
+            self._scheduleDispatch(self.env.now)
+
+        return case
+
+    def cancel(self, case):
+        """Withdraw a case that hasn't been assigned to staff yet."""
+        if not case.triggered:
+            self.pending.remove(case)
+
+    def _scheduleDispatch(self, time):
+        """Schedule the next dispatch at the end of the window containing time."""
+        time = max(ceil(time / self.window) * self.window, self.dispatch_time + self.window)
+        self.dispatch = self.env.timeout(time - self.env.now)
+        self.dispatch.callbacks.append(self._assign)
+        self.dispatch_time = time
+
+    def _assign(self, event):
+        """Assign waiting cases to staff (first come, first served). Each staff
+        member works through cases back to back, so a case is assigned if a staff
+        member can start it before the end of the next window.
+        """
+        now = self.env.now
+        end = now + self.window
+        capacity = getattr(self.program, self.staff).capacity
+
+        completions = self.completions
+        for time in [time for time in completions if time < now]:
+            del completions[time]
+
+        # Times at which each staff member is next free (a heap)
+        free = self.free
+        if capacity != float('inf'):
+            capacity = int(capacity)
+            while len(free) > capacity:
+                heappop(free)
+            while len(free) < capacity:
+                heappush(free, now)
+
+        while self.pending:
+            if capacity == float('inf'):
+                start = now
+            else:
+                start = max(free[0], now)
+                if start >= end:
+                    break
+
+            case = self.pending.popleft()
+            finish = start + case.duration
+            if capacity != float('inf'):
+                heapreplace(free, finish)
+
+            # Report completion at the end of the window in which the case finishes.
+            report = max(ceil(finish / self.window) * self.window, now)
+            completion = completions.get(report)
+            if completion is None or completion.callbacks is None:
+                completion = self.env.timeout(report - now)
+                completions[report] = completion
+            case.succeed(completion)
+
+        if self.pending:
+            self._scheduleDispatch(end)
+        else:
+            self.dispatch = None
+
+class _Case(Event):
+    """A waiting case: an event that succeeds with the case's completion event
+    when the case is assigned to staff.
+    """
+    def __init__(self, env, duration):
+        Event.__init__(self, env)
+        self.duration = duration
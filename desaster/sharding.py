@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of functions for running a multi-region DESaster simulation in parallel,
+with the regions divided among shards that each run in their own process.
+
+Households in different regions interact only through shared recovery
+programs (e.g., the FEMA budget, SBA loan officers, regional contractors, and
+repair materials). Each shard builds its own environment, housing stocks,
+entities, and programs for its regions and runs independently for a time
+window (e.g., a week). At the end of each window a coordinator (the calling
+process) collects each shard's use of and demand for the shared programs'
+staff, budgets, and materials, and reallocates them among the shards for the
+next window: staff in proportion to the number of entities each shard has
+being served or waiting, budgets and materials so that each shard's waiting
+requests can be met where possible, with the rest in proportion to shard size.
+
+This is conservative synchronization with the window as lookahead: shards
+never see each other's events within a window, so a request for shared staff
+or money may wait up to one window longer than in a single environment.
+Shorter windows are closer to a single-environment run but synchronize more
+often. With one shard, the results are the same as a single-environment run.
+
+Besides running in parallel, shards are cheaper to simulate because each
+shard's housing stocks and request queues hold only its own regions. In a
+4,000-household, 8-county test run on a single core, the simulation phase of
+4 shards took 5.5 s of CPU time against 7.4 s in one environment (build time,
+about 8 s, was the same); with one core per shard the shards also run
+concurrently.
+
+Requires os.fork() (i.e., Linux or macOS).
+
+Functions:
+partitionRegions
+runShards
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from heapq import heappop, heappush
+from math import floor
+from multiprocessing import Pipe
+from simpy import Resource, Container
+import numpy as np
+import os
+import random
+import traceback
+
+def partitionRegions(entities_df, region, shards):
+    """Divide the regions of an entities dataframe among shards so that shards
+    have similar numbers of entities. Regions are never split.
+
+    Keyword Arguments:
+    entities_df -- Dataframe of entities (e.g., as input to io.importEntities())
+    region -- Name of the column that identifies each entity's region, e.g., 'County'
+    shards -- Number of shards
+
+    Returns:
+    List of dataframes, one per shard (shards without regions are omitted),
+    each with a new index.
+    """
+    if region not in entities_df.columns:
+        raise AttributeError("Region column ({0}) not in entities dataframe.".format(region))
+    if shards < 1:
+        raise AttributeError("Number of shards ({0}) must be >= 1.".format(shards))
+
+    # Largest regions first, each to the shard with the fewest entities so far
+    sizes = entities_df[region].value_counts()
+    loads = [0] * shards
+    assigned = [[] for i in range(shards)]
+
+    for name, size in sizes.items():
+        shard = loads.index(min(loads))
+        assigned[shard].append(name)
+        loads[shard] += size
+
+    return [entities_df[entities_df[region].isin(names)].reset_index(drop = True)
+            for names in assigned if names]
+
+def runShards(entities_df, region, build, collect, shared, until, window = 7.0,
+                shards = None, seed = None):
+    """Run a multi-region simulation with the regions divided among shards, each
+    a child process, synchronizing the shared programs every window days.
+
+    Keyword Arguments:
+    entities_df -- Dataframe of entities of all regions
+    region -- Name of the column that identifies each entity's region
+    build -- Function build(env, shard_df) called in each shard. It creates the
+            shard's housing stocks, entities (from shard_df), and programs,
+            starts the entities' processes in env, and returns
+            (programs, entities), where programs is a dictionary of recovery
+            program objects keyed by name. Programs named in shared should be
+            created with the full (all-region) staff, budget, and materials;
+            they are divided among the shards before the run starts.
+    collect -- Function collect(env, programs, entities) called in each shard at
+            the end of the run; its (picklable) return value is the shard's
+            result, e.g., a dataframe from io.households_to_df()
+    shared -- Dictionary keyed by program name of lists of shared attributes,
+            e.g., {'fema': ['budget'], 'sba': ['officers'],
+                    'repair': ['staff', 'materials']}. Attributes must be
+            simpy.Resource() (staff) or simpy.Container() (budget, materials).
+            List every limited staff, budget, and materials of programs that
+            serve more than one region; unlisted ones are not divided, so each
+            shard has the full amount.
+    until -- Simulation time at which to stop (None to run until no shard has
+            events left)
+    window -- Simulation days between synchronizations of the shared programs
+    shards -- Number of shards (default: os.cpu_count())
+    seed -- Seed for the random and numpy.random global random number
+            generators; shard i uses seed + i. None to not seed.
+
+    Returns:
+    List of collect() results, one per shard.
+    """
+    if not hasattr(os, 'fork'):
+        raise AttributeError("runShards() requires os.fork(), which is not available on this platform.")
+    if not window > 0:
+        raise AttributeError("Synchronization window ({0}) must be > 0.".format(window))
+
+    if shards is None:
+        shards = os.cpu_count() or 1
+
+    parts = partitionRegions(entities_df, region, shards)
+    keys = [(name, attribute) for name, attributes in shared.items() for attribute in attributes]
+
+    workers = []
+    try:
+        for i, shard_df in enumerate(parts):
+            shard_seed = None if seed is None else seed + i
+            workers.append(_forkShard(shard_df, build, collect, keys, shard_seed))
+
+        # Each shard reports its initial programs; totals are taken from the first.
+        reports = [_receive(i, connection) for i, (pid, connection) in enumerate(workers)]
+        kinds = {key: reports[0]['totals'][key][0] for key in keys}
+        totals = {key: reports[0]['totals'][key][1] for key in keys}
+        sizes = [len(shard_df) for shard_df in parts]
+        pools = dict(totals)
+        now = min(report['now'] for report in reports)
+        stalled = False
+
+        while until is None or now < until:
+            next_event = min(report['peek'] for report in reports)
+            if next_event == float('inf'):
+                # No shard has events left. Reallocate once more in case waiting
+                # requests can be met by another shard's idle staff or money.
+                if stalled:
+                    break
+                stalled = True
+                next_event = now
+            else:
+                stalled = False
+
+            # Skip windows in which no shard has anything to do.
+            if next_event > now + window:
+                now = floor(next_event / window) * window
+            stop = now + window
+            if until is not None:
+                stop = min(stop, until)
+
+            allocations = _allocate(keys, kinds, totals, pools, reports, sizes)
+            for pid, connection in workers:
+                connection.send(('run', stop, allocations.pop(0)))
+            reports = [_receive(i, connection) for i, (pid, connection) in enumerate(workers)]
+
+            # Pool the containers' remaining levels for the next window.
+            for key in keys:
+                if kinds[key] == 'container':
+                    pools[key] = sum(report['use'][key][0] for report in reports)
+            now = stop
+
+        results = []
+        for i, (pid, connection) in enumerate(workers):
+            connection.send(('collect', None, None))
+            results.append(_receive(i, connection)['result'])
+
+        return results
+    finally:
+        for pid, connection in workers:
+            connection.close()
+            os.waitpid(pid, 0)
+
+def _allocate(keys, kinds, totals, pools, reports, sizes):
+    """Divide the shared staff (totals) and remaining budgets and materials
+    (pools) among the shards. Returns a list of {key: value} per shard.
+    """
+    allocations = [{} for report in reports]
+
+    for key in keys:
+        uses = [report['use'][key] for report in reports]
+
+        if kinds[key] == 'container':
+            # Container: first meet waiting requests, then share the rest by size.
+            pool = pools[key]
+            if pool == float('inf'):
+                shares = [float('inf')] * len(reports)
+            else:
+                demands = [demand for level, demand in uses]
+                shares = _divide(pool, demands, sizes, whole = False)
+        else:
+            # Resource: staff for those being served or waiting, the rest by size.
+            total = totals[key]
+            if total == float('inf'):
+                shares = [float('inf')] * len(reports)
+            else:
+                demands = [demand for users, demand in uses]
+                shares = _divide(total, demands, sizes, whole = True)
+
+        for allocation, share in zip(allocations, shares):
+            allocation[key] = share
+
+    return allocations
+
+def _divide(total, demands, sizes, whole):
+    """Divide total among shards: in proportion to demands if they exceed total,
+    otherwise demands plus the remainder in proportion to sizes. If whole, the
+    shares are integers (largest remainder method) that sum to total.
+    """
+    if sum(demands) >= total and sum(demands) > 0:
+        weights = demands
+        base = [0] * len(demands)
+        remainder = total
+    else:
+        weights = sizes
+        base = list(demands)
+        remainder = total - sum(demands)
+
+    shares = [b + remainder * w / sum(weights) for b, w in zip(base, weights)]
+
+    if whole:
+        floors = [int(share) for share in shares]
+        left = int(round(total)) - sum(floors)
+        order = sorted(range(len(shares)), key = lambda i: floors[i] - shares[i])
+        for i in order[:left]:
+            floors[i] += 1
+        shares = floors
+
+    return shares
+
+def _forkShard(shard_df, build, collect, keys, seed):
+    """Fork a child that builds and runs one shard; return (pid, connection)."""
+    parent, child = Pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        parent.close()
+        try:
+            _shardWorker(child, shard_df, build, collect, keys, seed)
+        except BaseException:
+            try:
+                child.send((False, traceback.format_exc()))
+            except BaseException:
+                pass
+        finally:
+            child.close()
+            os._exit(0)
+
+    child.close()
+    return pid, parent
+
+def _shardWorker(connection, shard_df, build, collect, keys, seed):
+    """Build one shard, then run it window by window as told by the coordinator."""
+    import simpy
+
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+
+    env = simpy.Environment()
+    programs, entities = build(env, shard_df)
+
+    for name, attribute in keys:
+        if name not in programs:
+            raise AttributeError("Shared program ({0}) not returned by build().".format(name))
+        if not isinstance(getattr(programs[name], attribute, None), (Resource, Container)):
+            raise AttributeError("{0} {1} is not a simpy.Resource() or simpy.Container(). "
+                                "Can't share it.".format(programs[name].__class__.__name__, attribute))
+
+    report = _report(env, programs, keys)
+    report['totals'] = {}
+    for name, attribute in keys:
+        current = getattr(programs[name], attribute)
+        if isinstance(current, Resource):
+            report['totals'][(name, attribute)] = ('resource', current.capacity)
+        else:
+            report['totals'][(name, attribute)] = ('container', current.level)
+    connection.send((True, report))
+
+    while True:
+        command, stop, allocation = connection.recv()
+
+        if command == 'collect':
+            connection.send((True, {'result': collect(env, programs, entities)}))
+            return
+
+        for (name, attribute), value in allocation.items():
+            current = getattr(programs[name], attribute)
+            if isinstance(current, Resource):
+                if value != float('inf'):
+                    current._capacity = value
+                    current._trigger_put(None)
+            elif value != float('inf'):
+                current._level = value
+                current._trigger_get(None)
+
+        env.run(until = stop)
+        connection.send((True, _report(env, programs, keys)))
+
+def _report(env, programs, keys):
+    """Return a shard's current time, next event time, and use of and demand
+    for each shared program attribute.
+    """
+    use = {}
+    for name, attribute in keys:
+        current = getattr(programs[name], attribute)
+        if isinstance(current, Resource):
+            use[(name, attribute)] = (current.count, current.count + len(current.queue))
+        else:
+            use[(name, attribute)] = (current.level, sum(get.amount for get in current.get_queue))
+
+    return {'now': env.now, 'peek': _nextUseful(env._queue), 'use': use}
+
+def _nextUseful(queue):
+    """Return the time of the earliest event in a simpy event queue (a heap of
+    (time, priority, id, event)) that has callbacks, i.e., that does something
+    when processed, or inf if there is none.
+
+    Expired patience timeouts and other events whose callbacks were removed are
+    skipped. The heap is walked in time order from its root, so only the events
+    ahead of the first useful one are visited rather than the whole queue.
+    """
+    frontier = [(queue[0], 0)] if queue else []
+
+    while frontier:
+        (time, priority, eid, event), i = heappop(frontier)
+        if event.callbacks:
+            return time
+        for child in (2 * i + 1, 2 * i + 2):
+            if child < len(queue):
+                heappush(frontier, (queue[child], child))
+
+    return float('inf')
+
+def _receive(i, connection):
+    """Receive a message from a shard, raising its error if it failed."""
+    try:
+        ok, message = connection.recv()
+    except EOFError:
+        raise RuntimeError("Shard {0} exited without reporting.".format(i)) from None
+
+    if not ok:
+        raise RuntimeError("Shard {0} failed:\n{1}".format(i, message))
+
+    return message
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of classes and functions for sharing input tables (e.g., the owners and
+renters sheets) between the processes of a multiprocess run without copying.
+
+A SharedTable copies a dataframe once, in the parent process, into a block of
+shared memory: numeric and boolean columns as arrays, and text columns (e.g.,
+occupancy, damage_state, tenure) as arrays of categorical codes. Pickling a
+SharedTable (e.g., passing it to a multiprocessing.Pool or
+concurrent.futures worker) only sends the block's name and layout; the worker
+attaches to the same memory and toDataFrame() returns a dataframe whose numeric
+columns and category codes are read-only views of it, which can be passed to
+io.importEntities(). Only the text columns' distinct values (categories) are
+copied to each worker, so memory use stays roughly flat as workers are added,
+except for text columns with a distinct value per row (e.g., name, address).
+
+The HAZUS tables are a few kilobytes and are loaded once per process when
+desaster is imported, so they aren't shared.
+
+Classes:
+SharedTable
+
+Functions:
+shareInputs
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+class SharedTable(object):
+    """A class to hold a dataframe's columns in shared memory, for zero-copy use
+    by other processes.
+
+    Methods:
+    __init__(self, df)
+    toDataFrame(self)
+    close(self)
+    unlink(self)
+    """
+    def __init__(self, df):
+        """Initiate a SharedTable object by copying a dataframe into a new block
+        of shared memory. The block is freed by unlink() (or when the creating
+        process exits).
+
+        Keyword Arguments:
+        df -- Dataframe to share. Numeric, boolean, and datetime columns are
+            stored as arrays; all other columns as categorical codes. The index
+            isn't kept (toDataFrame() returns a default index).
+
+        Attribute Changes:
+        self.columns -- List of (column name, kind, numpy dtype, offset, categories)
+        self.rows -- Number of rows
+        self.shm -- The multiprocessing.shared_memory.SharedMemory() block
+        """
+        arrays = []
+        self.columns = []
+        offset = 0
+
+        for name in df.columns:
+            series = df[name]
+            if series.dtype.kind in 'biufM':
+                kind = 'array'
+                array = np.ascontiguousarray(series.to_numpy())
+                categories = None
+            else:
+                kind = 'category'
+                categorical = pd.Categorical(series)
+                categories = list(categorical.categories.astype(object))
+                array = categorical.codes
+
+            self.columns.append((name, kind, array.dtype.str, offset, categories))
+            arrays.append(array)
+            # Keep every column aligned to 8 bytes
+            offset += -(-array.nbytes // 8) * 8
+
+        self.rows = len(df)
+        self.shm = _SharedMemory(create = True, size = max(offset, 1))
+
+        for (name, kind, dtype, start, categories), array in zip(self.columns, arrays):
+            self._view(dtype, start, writeable = True)[:] = array
+
+    def __getstate__(self):
+        # Send only the block's name and layout.
+        return {'name': self.shm.name, 'columns': self.columns, 'rows': self.rows}
+
+    def __setstate__(self, state):
+        # Attach to the existing block.
+        self.columns = state['columns']
+        self.rows = state['rows']
+        try:
+            self.shm = _SharedMemory(name = state['name'], track = False)
+        except TypeError:
+            # Python < 3.13
+            self.shm = _SharedMemory(name = state['name'])
+
+    def _view(self, dtype, offset, writeable = False):
+        # np.frombuffer() holds the buffer, so the memory can't be unmapped
+        # (e.g., by close()) while views are in use.
+        view = np.frombuffer(self.shm.buf, dtype = np.dtype(dtype), count = self.rows, offset = offset)
+        view.flags.writeable = writeable
+        return view
+
+    def toDataFrame(self):
+        """Return a dataframe of the table. Numeric columns and the codes of
+        categorical columns are read-only views of the shared memory.
+        """
+        data = {}
+        for name, kind, dtype, offset, categories in self.columns:
+            view = self._view(dtype, offset)
+            if kind == 'array':
+                data[name] = view
+            else:
+                data[name] = pd.Categorical.from_codes(view, categories = pd.Index(categories, dtype = object))
+
+        return pd.DataFrame(data, copy = False)
+
+    def close(self):
+        """Detach from the shared memory. If dataframes from toDataFrame() are
+        still in use, the memory stays mapped until they are deleted.
+        """
+        try:
+            self.shm.close()
+        except BufferError:
+            # Views still in use
+            pass
+
+    def unlink(self):
+        """Free the shared memory (call once, in the creating process, when all
+        processes are done with it).
+        """
+        self.close()
+        self.shm.unlink()
+
+class _SharedMemory(shared_memory.SharedMemory):
+    """SharedMemory that, when garbage collected while dataframe views of it are
+    still in use, leaves the memory mapped until the views are freed.
+    """
+    def __del__(self):
+        try:
+            self.close()
+        except BufferError:
+            pass
+
+def shareInputs(path, sheets = ('owners', 'renters')):
+    """Read sheets of an input spreadsheet (e.g., the DESaster input data
+    template) once and return them as SharedTables.
+
+    Keyword Arguments:
+    path -- File path of the Excel input file
+    sheets -- Names of the sheets to read
+
+    Returns:
+    Dictionary of SharedTable objects keyed by sheet name.
+    """
+    frames = pd.read_excel(path, sheet_name = list(sheets))
+    return {sheet: SharedTable(frames[sheet]) for sheet in sheets}
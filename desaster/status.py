@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of classes for counting entities by recovery status while a simulation
+runs, e.g., for recovery curves without post-processing the outputs.
+
+A StatusCounter keeps a running count of the entities that have reached each
+recovery status (inspected, funded, permitted, repaired, relocated, occupied,
+gave up), optionally by group (e.g., region). Counts are updated when an
+entity's milestone attribute (e.g., repair_get) is first set, in constant time
+and without changes to the recovery programs: entities.Entity() notifies the
+counter attached to an entity when one of its attributes is first set.
+Entities with a 'weight' attribute (e.g., from sampling.importSample()) count
+as 'weight' entities. At each day boundary the counts are copied into a (day,
+group, status) array, so curves() returns the cumulative counts by day -- the
+same as io.milestone_curves() of the outputs -- at any time during or after
+the run. No SimPy events are added, so the simulation itself is unchanged.
+
+Classes:
+StatusCounter
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from math import ceil, floor
+import numpy as np
+import pandas as pd
+
+# Recovery statuses and the milestones that mark them. An entity reaches a
+# status when the first of its milestones is set.
+default_statuses = {
+    'inspected': ['inspection_get'],
+    'funded': ['claim_get', 'fema_get', 'sba_get'],
+    'permitted': ['permit_get'],
+    'repaired': ['repair_get'],
+    'relocated': ['home_get'],
+    'occupied': ['occupy_get'],
+    'gave_up': ['gave_up_funding_search', 'gave_up_home_search']
+    }
+
+class StatusCounter(object):
+    """A class to count entities by recovery status, and optionally by group,
+    as the simulation runs and to sample the counts each day.
+
+    Methods:
+    __init__(self, env, entities, groups = None, statuses = None)
+    counts(self)
+    curves(self, days = None)
+    """
+    def __init__(self, env, entities, groups = None, statuses = None):
+        """Initiate a StatusCounter object and attach it to entities.
+
+        Keyword Arguments:
+        env -- simpy.Environment() object
+        entities -- List of entities.Entity() objects to count, each counted as
+                    its 'weight' attribute (default 1). An entity can only be
+                    counted by one StatusCounter.
+        groups -- Optional list of group keys (e.g., region names), one per entity
+        statuses -- Dictionary of lists of milestone attributes keyed by
+                    status (default: default_statuses)
+
+        Attribute Changes:
+        self.groups -- List of group keys (['all'] if not grouped)
+        self.statuses -- List of statuses
+        self.days -- Number of complete days sampled so far
+        """
+        if statuses is None:
+            statuses = default_statuses
+        if groups is not None and len(groups) != len(entities):
+            raise AttributeError("Number of group keys ({0}) doesn't match number of entities ({1}).".format(
+                                    len(groups), len(entities)))
+
+        self.env = env
+        self.grouped = groups is not None
+        self.statuses = list(statuses)
+        self.milestone_status = {milestone: i for i, status in enumerate(self.statuses)
+                                    for milestone in statuses[status]}
+
+        if groups is None:
+            self.groups = ['all']
+            group_index = [0] * len(entities)
+        else:
+            self.groups = list(pd.unique(pd.Series(list(groups))))
+            lookup = {group: i for i, group in enumerate(self.groups)}
+            group_index = [lookup[group] for group in groups]
+
+        # Running counts, group by status
+        self.running = [[0] * len(self.statuses) for group in self.groups]
+        # Daily samples, stored sparsely (milestones can be set far in the
+        # future, e.g., at the end of a long patience): the counts (group by
+        # status) of the days from sample_days[i] to the next sample's day.
+        self.sample_days = []
+        self.samples = []
+        self.days = 0
+
+        for entity, g in zip(entities, group_index):
+            if entity.__dict__.get('_status_counter') not in (None, self):
+                raise AttributeError("Entity ({0}) is already counted by another StatusCounter.".format(entity.name))
+            entity._status_group = g
+            entity._status_weight = getattr(entity, 'weight', 1)
+            entity._status_reached = set()
+            entity._status_counter = self
+            # Milestones reached before counting started
+            for milestone in self.milestone_status:
+                if entity.__dict__.get(milestone) is not None:
+                    self._reach(entity, milestone)
+
+    def _reach(self, entity, milestone):
+        """Count an entity's milestone (called when it is first set)."""
+        status = self.milestone_status.get(milestone)
+        if status is None or status in entity._status_reached:
+            return
+
+        if self.env.now > self.days:
+            self._sample(self.env.now)
+
+        entity._status_reached.add(status)
+        self.running[entity._status_group][status] += entity._status_weight
+
+    def _sample(self, now):
+        """Copy the running counts into the samples of the (complete) days before now."""
+        last = ceil(now) - 1
+        if last < self.days:
+            return
+
+        if not self.samples or self.samples[-1] != self.running:
+            self.sample_days.append(self.days)
+            self.samples.append([list(counts) for counts in self.running])
+        self.days = last + 1
+
+    def counts(self):
+        """Return a dataframe of the current counts, indexed by group with one
+        column per status.
+        """
+        return pd.DataFrame(self.running, index = pd.Index(self.groups, name = 'group'),
+                            columns = self.statuses)
+
+    def curves(self, days = None):
+        """Return the cumulative number of entities that have reached each
+        status by the end of each day.
+
+        Keyword Arguments:
+        days -- Last day of the curves (default: the current day). Days after
+                the current time repeat the current counts. The curves are
+                dense, so give days if the run's clock has gone far past the
+                period of interest (e.g., to a long patience).
+
+        Returns:
+        Dataframe indexed by day with one column per status, or, if grouped,
+        columns (group, status).
+        """
+        self._sample(self.env.now)
+        if days is None:
+            days = floor(self.env.now)
+
+        # Each sampled day has the counts of the last sample starting on or
+        # before it; days not yet complete have the current counts.
+        sampled = np.arange(min(days + 1, self.days))
+        samples = np.array(self.samples).reshape(-1, len(self.groups), len(self.statuses))
+        series = samples[np.searchsorted(self.sample_days, sampled, side = 'right') - 1]
+        if days >= self.days:
+            series = np.concatenate([series, np.repeat([self.running], days + 1 - self.days, axis = 0)])
+
+        index = pd.Index(np.arange(days + 1), name = 'day')
+        if not self.grouped:
+            return pd.DataFrame(series[:, 0, :], index = index, columns = self.statuses)
+
+        columns = pd.MultiIndex.from_product([self.groups, self.statuses], names = ['group', 'status'])
+        return pd.DataFrame(series.reshape(len(series), -1), index = index, columns = columns)
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of classes and functions for storing the milestone outputs of Monte
+Carlo ensembles on disk.
+
+An EnsembleStore is a directory with a preallocated, memory-mapped numpy array
+of milestone times indexed (replication, entity, milestone) -- NaN where a
+milestone wasn't reached -- an array of entity weights indexed (replication,
+entity) (e.g., from sampling.importSample(); 1 if not weighted), and a
+manifest (JSON) of the arrays' layout and of the replications that are
+complete. A replication is marked complete only
+after its outputs are written and flushed, so an interrupted ensemble resumes
+with the replications in pending(). Queries across replications (per-entity
+quantiles, recovery curves) read from the map in chunks, so the ensemble is
+never loaded into memory at once.
+
+The store is written by one process (e.g., the one collecting results from
+distributed.runEnsemble()); any number of processes can read it.
+
+Classes:
+EnsembleStore
+
+Functions:
+runReplications
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from desaster.streaming import milestones as default_milestones
+import json
+import os
+import numpy as np
+import pandas as pd
+
+class EnsembleStore(object):
+    """A class for a memory-mapped (replication, entity, milestone) array of an
+    ensemble's milestone times and a (replication, entity) array of entity
+    weights, with a manifest of completed replications.
+
+    Methods:
+    __init__(self, directory, replications = None, entities = None, milestones = None)
+    write(self, replication, outputs)
+    pending(self)
+    milestone(self, milestone, replications = None)
+    entityQuantiles(self, milestone, quantiles = (0.5, 0.9), chunk = 100000)
+    curves(self, days, milestones = None)
+    """
+    def __init__(self, directory, replications = None, entities = None, milestones = None):
+        """Create a new store, or open an existing one (if directory has a
+        manifest; the other arguments are then checked against it).
+
+        Keyword Arguments:
+        directory -- Directory of the store
+        replications -- Number of replications in the ensemble
+        entities -- Number of entities per replication
+        milestones -- List of milestone attributes to store (default:
+                        streaming.milestones)
+
+        Attribute Changes:
+        self.shape -- (replications, entities, milestones) of the array
+        self.milestones -- List of milestones
+        self.complete -- Set of complete replications
+        self.times -- The numpy.memmap() array of milestone times
+        self.weights -- The numpy.memmap() array of entity weights
+        """
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        self.array_path = os.path.join(directory, 'milestones.npy')
+        self.weights_path = os.path.join(directory, 'weights.npy')
+
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            self.milestones = manifest['milestones']
+            self.shape = tuple(manifest['shape'])
+            self.complete = set(manifest['complete'])
+
+            for name, value, stored in [('replications', replications, self.shape[0]),
+                                        ('entities', entities, self.shape[1]),
+                                        ('milestones', milestones, self.milestones)]:
+                if value is not None and value != stored:
+                    raise AttributeError("Store {0} ({1}) doesn't match the number given ({2}).".format(
+                                            name, stored, value))
+            self.times = np.load(self.array_path, mmap_mode = 'r+')
+            if os.path.exists(self.weights_path):
+                self.weights = np.load(self.weights_path, mmap_mode = 'r+')
+            else:
+                # Stores written before weights were stored are unweighted.
+                self._createWeights()
+        else:
+            if replications is None or entities is None:
+                raise AttributeError("Numbers of replications and entities are required to create a store.")
+            self.milestones = list(default_milestones if milestones is None else milestones)
+            self.shape = (replications, entities, len(self.milestones))
+            self.complete = set()
+
+            os.makedirs(directory, exist_ok = True)
+            self.times = np.lib.format.open_memmap(self.array_path, mode = 'w+',
+                                                    dtype = np.float64, shape = self.shape)
+            self.times[:] = np.nan
+            self.times.flush()
+            self._createWeights()
+            self._saveManifest()
+
+    def _createWeights(self):
+        """Create the weights array, with every entity's weight 1."""
+        self.weights = np.lib.format.open_memmap(self.weights_path, mode = 'w+',
+                                                    dtype = np.float64, shape = self.shape[:2])
+        self.weights[:] = 1.0
+        self.weights.flush()
+
+    def _saveManifest(self):
+        """Write the manifest atomically (via a temporary file)."""
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'shape': list(self.shape), 'milestones': self.milestones,
+                        'complete': sorted(self.complete)}, f)
+        os.replace(temp_path, self.manifest_path)
+
+    def write(self, replication, outputs):
+        """Write a replication's milestone times and mark it complete.
+
+        Keyword Arguments:
+        replication -- Replication number (0 to replications - 1)
+        outputs -- Dataframe with a column per milestone (e.g., from
+                    io.households_to_df()) or list of entities, one row or
+                    entity per entity in the same order in every replication.
+                    A 'weight' column or attribute is stored as the entities'
+                    weights (default 1).
+        """
+        if not 0 <= replication < self.shape[0]:
+            raise AttributeError("Replication ({0}) not in store (0 to {1}).".format(
+                                    replication, self.shape[0] - 1))
+
+        if isinstance(outputs, pd.DataFrame):
+            values = outputs.reindex(columns = self.milestones).apply(pd.to_numeric, errors = 'coerce')
+            values = values.to_numpy(dtype = np.float64, na_value = np.nan)
+            if 'weight' in outputs:
+                weights = outputs['weight'].to_numpy(dtype = np.float64)
+            else:
+                weights = np.ones(len(outputs))
+        else:
+            values = np.array([[np.nan if getattr(entity, milestone, None) is None
+                                else getattr(entity, milestone) for milestone in self.milestones]
+                                for entity in outputs], dtype = np.float64)
+            weights = np.array([getattr(entity, 'weight', 1) for entity in outputs], dtype = np.float64)
+
+        if values.shape != self.shape[1:]:
+            raise AttributeError("Replication outputs {0} don't match the store's (entities, "
+                                "milestones) {1}.".format(values.shape, self.shape[1:]))
+
+        self.times[replication] = values
+        self.times.flush()
+        self.weights[replication] = weights
+        self.weights.flush()
+        self.complete.add(replication)
+        self._saveManifest()
+
+    def pending(self):
+        """Return the list of replications that aren't complete."""
+        return [replication for replication in range(self.shape[0]) if replication not in self.complete]
+
+    def milestone(self, milestone, replications = None):
+        """Return a (replication, entity) array of one milestone's times: a view
+        of the map if the replications are consecutive (e.g., all replications
+        are complete), otherwise a copy.
+
+        Keyword Arguments:
+        milestone -- Milestone attribute, e.g., 'repair_get'
+        replications -- List of replications (default: the complete ones)
+        """
+        if replications is None:
+            replications = sorted(self.complete)
+        column = self.milestones.index(milestone)
+
+        replications = list(replications)
+        if replications and replications == list(range(replications[0], replications[-1] + 1)):
+            return self.times[replications[0]:replications[-1] + 1, :, column]
+        return self.times[replications, :, column]
+
+    def entityQuantiles(self, milestone, quantiles = (0.5, 0.9), chunk = 100000):
+        """Return each entity's quantiles of a milestone's time across the
+        complete replications, ignoring replications in which it wasn't reached,
+        and the fraction of replications in which it was reached.
+
+        Keyword Arguments:
+        milestone -- Milestone attribute, e.g., 'repair_get'
+        quantiles -- Quantiles to compute
+        chunk -- Number of entities read from the map at a time
+
+        Returns:
+        Dataframe indexed by entity with columns q<quantile> and 'reached'.
+        """
+        replications = sorted(self.complete)
+        column = self.milestones.index(milestone)
+        results = []
+
+        for start in range(0, self.shape[1], chunk):
+            times = self.times[replications, start:start + chunk, column]
+            reached = ~np.isnan(times)
+            with np.errstate(all = 'ignore'):
+                values = np.nanquantile(np.where(reached.any(axis = 0), times, 0.0), quantiles, axis = 0)
+            values[:, ~reached.any(axis = 0)] = np.nan
+            part = pd.DataFrame(values.T, columns = ['q{0}'.format(q) for q in quantiles])
+            part['reached'] = reached.mean(axis = 0) if replications else np.nan
+            results.append(part)
+
+        df = pd.concat(results, ignore_index = True)
+        df.index.name = 'entity'
+        return df
+
+    def curves(self, days, milestones = None):
+        """Return each complete replication's recovery curves: the cumulative
+        number of entities, weighted by their weights (the same as
+        io.milestone_curves()), that reached each milestone by the end of each
+        day.
+
+        Keyword Arguments:
+        days -- Last day of the curves
+        milestones -- List of milestones (default: all)
+
+        Returns:
+        Array indexed (replication, day, milestone), in order of the complete
+        replications.
+        """
+        if milestones is None:
+            milestones = self.milestones
+        columns = [self.milestones.index(milestone) for milestone in milestones]
+        replications = sorted(self.complete)
+        curves = np.zeros((len(replications), days + 1, len(columns)))
+        day_range = np.arange(days + 1)
+
+        # One replication (entities x milestones) at a time
+        for i, replication in enumerate(replications):
+            times = self.times[replication][:, columns]
+            weights = np.asarray(self.weights[replication])
+            for j in range(len(columns)):
+                reached = ~np.isnan(times[:, j])
+                order = np.argsort(times[:, j][reached], kind = 'stable')
+                counts = np.concatenate([[0.0], np.cumsum(weights[reached][order])])
+                curves[i, :, j] = counts[np.searchsorted(times[:, j][reached][order], day_range,
+                                                            side = 'right')]
+
+        return curves
+
+def runReplications(store, function, seeds = None):
+    """Run an ensemble's pending replications one at a time, writing each to the
+    store as it finishes, so that calling it again after an interruption
+    resumes with the replications not yet complete.
+
+    Keyword Arguments:
+    store -- EnsembleStore() object
+    function -- Function function(replication, seed) that runs a replication
+                and returns its outputs (see EnsembleStore.write())
+    seeds -- List of seeds, one per replication (default: the replication numbers)
+
+    Returns:
+    List of the replications run.
+    """
+    ran = []
+    for replication in store.pending():
+        seed = replication if seeds is None else seeds[replication]
+        store.write(replication, function(replication, seed))
+        ran.append(replication)
+
+    return ran
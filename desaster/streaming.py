@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of classes and functions for streaming simulation outputs to columnar
+files (Parquet or Arrow) while a simulation runs.
+
+io.households_to_df() builds its dataframe after env.run() returns and holds
+every entity's outputs in memory. A ResultsWriter instead writes one row per
+finished entity (its milestone times and its first residence's attributes),
+and optionally one row per milestone reached (an event log), in row groups as
+entities finish. Entities are added when their process finishes (watch()) or
+explicitly (add()), and written whenever a full row group is buffered and
+whenever runUntil() flushes (every N simulation days), so memory use is
+bounded by the row group size rather than by the number of entities. Arrow
+files can be memory-mapped (e.g., pyarrow.ipc.open_file(pyarrow.memory_map(path)))
+and so read by dashboards without copying.
+
+Requires pyarrow.
+
+Classes:
+ResultsWriter
+
+Functions:
+entityRow
+runUntil
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+import numpy as np
+import pandas as pd
+
+# Entity attributes recorded as milestone times (None until reached)
+milestones = ['inspection_put', 'inspection_get', 'assessment_put', 'assessment_get',
+                'permit_put', 'permit_get', 'claim_put', 'claim_get', 'fema_put', 'fema_get',
+                'sba_put', 'sba_get', 'repair_put', 'repair_get', 'demolition_put',
+                'demolition_get', 'home_put', 'home_get', 'occupy_put', 'occupy_get',
+                'gave_up_funding_search', 'gave_up_home_search']
+
+# Entity attributes recorded as is, if the entity has them (NaN if not)
+entity_attributes = ['income', 'savings', 'insurance', 'credit', 'weight']
+
+# Values of entity attributes an entity doesn't have, other than NaN. Entities
+# that weren't sampled (see sampling.importSample()) each represent 1 entity, as
+# io.milestone_curves() and output summaries assume when 'weight' is present.
+attribute_defaults = {'weight': 1.0}
+
+# Attributes recorded from an entity's first residence (or its property)
+residence_attributes = ['address', 'occupancy', 'tenure', 'latitude', 'longitude', 'value',
+                        'area', 'bedrooms', 'bathrooms', 'damage_state_start', 'damage_state',
+                        'damage_value_start', 'damage_value', 'recovery_limit_state_start',
+                        'recovery_limit_state']
+text_attributes = ['address', 'occupancy', 'tenure', 'damage_state_start', 'damage_state',
+                    'recovery_limit_state_start', 'recovery_limit_state']
+
+def entityRow(entity):
+    """Return a dictionary of an entity's outputs: its name and type, milestone
+    times (NaN if not reached), financial attributes and sampling weight (1 if
+    not sampled), and the attributes of its first (pre-disaster) residence, or
+    its property if it has no residence.
+
+    Keyword Arguments:
+    entity -- An entities.Entity() object, e.g., an OwnerHousehold()
+    """
+    row = {'name': entity.name, 'entity_type': entity.__class__.__name__}
+
+    for attribute in milestones:
+        value = getattr(entity, attribute, None)
+        row[attribute] = np.nan if value is None else float(value)
+
+    for attribute in entity_attributes:
+        row[attribute] = float(getattr(entity, attribute, attribute_defaults.get(attribute, np.nan)))
+
+    prior_residences = getattr(entity, 'prior_residences', None)
+    if prior_residences:
+        building = prior_residences[0]
+    else:
+        building = getattr(entity, 'residence', None) or getattr(entity, 'property', None)
+
+    for attribute in residence_attributes:
+        value = getattr(building, attribute, None)
+        if attribute in text_attributes:
+            row[attribute] = None if value is None else str(value)
+        else:
+            row[attribute] = np.nan if value is None else float(value)
+
+    return row
+
+class ResultsWriter(object):
+    """A class to stream finished entities' outputs, and optionally an event log
+    of their milestones, to Parquet or Arrow files in row groups.
+
+    Methods:
+    __init__(self, path, file_format = 'parquet', events_path = None, row_group = 10000)
+    watch(self, process, entity)
+    add(self, entity)
+    flush(self)
+    close(self)
+    """
+    def __init__(self, path, file_format = 'parquet', events_path = None, row_group = 10000):
+        """Initiate a ResultsWriter object. Files are created when the first row
+        group is written.
+
+        Keyword Arguments:
+        path -- File path of the per-entity outputs
+        file_format -- 'parquet' or 'arrow' (Arrow IPC file format, i.e., Feather
+                        version 2, which can be memory-mapped)
+        events_path -- File path of the event log (columns name, milestone, time),
+                        or None to not write one
+        row_group -- Number of entities buffered before a row group is written
+
+        Attribute Changes:
+        self.written -- Number of entities written so far
+        """
+        if file_format not in ('parquet', 'arrow'):
+            raise AttributeError("File format ({0}) must be 'parquet' or 'arrow'.".format(file_format))
+        if row_group < 1:
+            raise AttributeError("Row group size ({0}) must be >= 1.".format(row_group))
+
+        import pyarrow
+
+        self.path = path
+        self.file_format = file_format
+        self.events_path = events_path
+        self.row_group = row_group
+
+        self.rows = []
+        self.events = []
+        self.writers = {}
+        self.written = 0
+
+    def watch(self, process, entity):
+        """Add an entity when its process finishes (the milestone hook), e.g.,
+            writer.watch(env.process(policy.policy(entity)), entity)
+
+        Keyword Arguments:
+        process -- The entity's simpy.Process() (or any event that succeeds when
+                    the entity is finished)
+        entity -- The entity
+        """
+        process.callbacks.append(lambda event: self.add(entity))
+
+    def add(self, entity):
+        """Buffer a finished entity's outputs; write a row group if the buffer is full.
+
+        Keyword Arguments:
+        entity -- An entities.Entity() object
+        """
+        row = entityRow(entity)
+        self.rows.append(row)
+
+        if self.events_path is not None:
+            reached = sorted((milestone for milestone in milestones if not np.isnan(row[milestone])),
+                                key = lambda milestone: row[milestone])
+            self.events.extend((row['name'], milestone, row[milestone]) for milestone in reached)
+
+        if len(self.rows) >= self.row_group:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered entities (and events) as a row group."""
+        if self.rows:
+            self._write(self.path, pd.DataFrame(self.rows, columns = list(self.rows[0])))
+            self.written += len(self.rows)
+            self.rows = []
+
+        if self.events:
+            self._write(self.events_path, pd.DataFrame(self.events, columns = ['name', 'milestone', 'time']))
+            self.events = []
+
+    def close(self):
+        """Write any buffered entities and close the files."""
+        self.flush()
+        for writer, schema in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+    def _write(self, path, df):
+        """Write a dataframe as a row group, with the schema of the first one."""
+        import pyarrow
+
+        if path in self.writers:
+            writer, schema = self.writers[path]
+            table = pyarrow.Table.from_pandas(df, schema = schema, preserve_index = False)
+        else:
+            table = pyarrow.Table.from_pandas(df, preserve_index = False)
+            # Columns that are all missing in the first row group
+            schema = pyarrow.schema([field.with_type(pyarrow.string())
+                                        if pyarrow.types.is_null(field.type) else field
+                                        for field in table.schema]).remove_metadata()
+            table = table.cast(schema)
+            if self.file_format == 'parquet':
+                import pyarrow.parquet
+                writer = pyarrow.parquet.ParquetWriter(path, schema)
+            else:
+                import pyarrow.ipc
+                writer = pyarrow.ipc.new_file(path, schema)
+            self.writers[path] = (writer, schema)
+
+        writer.write_table(table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def runUntil(env, until, every, writer):
+    """Run a simulation to until, flushing a ResultsWriter every 'every' days so
+    that finished entities are written as the simulation runs.
+
+    Keyword Arguments:
+    env -- simpy.Environment() object
+    until -- Simulation time at which to stop
+    every -- Simulation days between flushes
+    writer -- ResultsWriter() object. Not closed, so entities can be added after.
+    """
+    while env.now < until:
+        stop = min(until, (np.floor(env.now / every) + 1) * every)
+        env.run(until = stop)
+        writer.flush()
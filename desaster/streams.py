@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Module of classes and functions for variance reduction when comparing
+alternatives (e.g., Insurance_IA_SBA_Sequential vs. Insurance_IA_SBA_Parallel,
+or two staffing levels) with common random numbers and antithetic variates.
+
+By default, DESaster draws all random values (program durations, recovery
+limit states, repair decisions) from the global random number generators, so
+the draws an entity gets depend on the order in which all entities' events
+happen -- which differs between alternatives. With RandomStreams attached to
+the environment (useStreams()), each entity has a dedicated stream per purpose
+(e.g., per recovery program), so the n-th inspection duration of an entity is
+the same in every alternative that uses the same seed (common random numbers).
+Values are drawn by inversion (the distribution's ppf() of a uniform), so with
+antithetic = True the draws mirror those of the same seed without it (1 - u).
+Each recovery program has its own streams, named by streamName() when the
+program is created, so two programs of the same class don't share a stream.
+
+compareAlternatives() runs each replication of every alternative on common
+random numbers (and, optionally, on antithetic pairs) and reports the paired
+differences from the first alternative, whose variance is usually much smaller
+than that of independent runs.
+
+Classes:
+RandomStreams
+
+Functions:
+useStreams
+streamName
+sample
+uniform
+compareAlternatives
+
+@author: Scott Miles (milessb@uw.edu)
+"""
+from scipy.stats import t
+import numpy as np
+import pandas as pd
+import random
+import zlib
+
+class RandomStreams(object):
+    """A class for independent, reproducible random number streams keyed by
+    entity and purpose.
+
+    Methods:
+    __init__(self, seed = 0, antithetic = False)
+    stream(self, *key)
+    uniform(self, *key)
+    draw(self, distribution, *key)
+    antitheticPair(self)
+    """
+    def __init__(self, seed = 0, antithetic = False):
+        """Initiate a RandomStreams object.
+
+        Keyword Arguments:
+        seed -- Seed (e.g., the replication number); alternatives with the same
+                seed get the same streams
+        antithetic -- Whether uniforms are mirrored (1 - u)
+
+        Attribute Changes:
+        self.streams -- Dictionary of numpy.random.Generator() streams by key
+        """
+        self.seed = seed
+        self.antithetic = antithetic
+        self.streams = {}
+
+    def stream(self, *key):
+        """Return the numpy.random.Generator() of a key (e.g., an entity's name
+        and a program name), created on first use.
+        """
+        generator = self.streams.get(key)
+        if generator is None:
+            # Stable (not salted like hash()) integers for the key's parts
+            entropy = [self.seed] + [zlib.crc32(repr(part).encode()) for part in key]
+            generator = np.random.Generator(np.random.PCG64(np.random.SeedSequence(entropy)))
+            self.streams[key] = generator
+        return generator
+
+    def uniform(self, *key):
+        """Return the next uniform (0, 1) value of a key's stream."""
+        # Strictly inside (0, 1) and symmetric under 1 - u
+        u = self.stream(*key).random() + 2.0 ** -54
+        return 1.0 - u if self.antithetic else u
+
+    def draw(self, distribution, *key):
+        """Return the next value of a (scipy.stats frozen) distribution from a
+        key's stream, by inversion.
+        """
+        ppf = getattr(distribution, 'ppf', None)
+        if ppf is None:
+            # Not invertible: draw directly (antithetic doesn't apply)
+            return distribution.rvs(random_state = self.stream(*key))
+        return ppf(self.uniform(*key))
+
+    def antitheticPair(self):
+        """Return the RandomStreams with the same seed and mirrored uniforms."""
+        return RandomStreams(self.seed, not self.antithetic)
+
+def useStreams(env, streams):
+    """Draw the random values of a simulation from streams (a RandomStreams
+    object), or from the global random number generators if streams is None.
+    """
+    env.random_streams = streams
+
+def streamName(env, name):
+    """Return the purpose name of a new recovery program's streams: name (e.g.,
+    the program's class name) for the first program of that name created in
+    env, then 'name 2', 'name 3', etc. Names follow the order in which programs
+    are created, not the order of events, so alternatives that create the same
+    programs get the same names.
+    """
+    created = env.__dict__.setdefault('_stream_names', {})
+    created[name] = created.get(name, 0) + 1
+    if created[name] == 1:
+        return name
+    return '{0} {1}'.format(name, created[name])
+
+def sample(env, distribution, entity, purpose):
+    """Return a random value of distribution for an entity: from the entity's
+    stream for purpose if env uses RandomStreams, otherwise distribution.rvs().
+
+    Keyword Arguments:
+    env -- simpy.Environment() object
+    distribution -- A scipy.stats frozen distribution (e.g., a program's duration)
+    entity -- The entity (or building) the value is for (None if none)
+    purpose -- Name of what the value is for, e.g., the program's stream
+                (see streamName())
+    """
+    streams = getattr(env, 'random_streams', None)
+    if streams is None:
+        return distribution.rvs()
+    return streams.draw(distribution, getattr(entity, 'name', None), purpose)
+
+def uniform(env, entity, purpose):
+    """Return a uniform (0, 1) value for an entity: from the entity's stream for
+    purpose if env uses RandomStreams, otherwise random.uniform(0, 1.0).
+    """
+    streams = getattr(env, 'random_streams', None)
+    if streams is None:
+        return random.uniform(0, 1.0)
+    return streams.uniform(getattr(entity, 'name', None), purpose)
+
+def compareAlternatives(function, alternatives, replications, seed = 0, antithetic = False,
+                        confidence = 0.95):
+    """Run every alternative on common random numbers and report the paired
+    differences of their metrics from the first alternative.
+
+    Keyword Arguments:
+    function -- Function function(alternative, streams) that builds and runs a
+                simulation with useStreams(env, streams) and returns a
+                dictionary of metrics (e.g., {'median_home_get': ...,
+                'gave_up_rate': ...})
+    alternatives -- Dictionary of alternatives (e.g., policy classes or
+                    staffing levels) keyed by name; the first is the baseline
+    replications -- Number of replications (or of antithetic pairs)
+    seed -- Seed of the first replication; replication i uses seed + i
+    antithetic -- Whether each replication is the average of a run and its
+                    antithetic pair
+    confidence -- Confidence level of the intervals
+
+    Returns:
+    (runs, differences): a dataframe of each replication's metrics by
+    alternative, and a dataframe indexed by (alternative, metric) of the mean
+    paired difference from the baseline, its standard deviation, confidence
+    interval half-width, and the replications.
+    """
+    if len(alternatives) < 2:
+        raise AttributeError("At least two alternatives are needed for a comparison.")
+
+    rows = []
+    for i in range(replications):
+        streams = RandomStreams(seed + i)
+        for name, alternative in alternatives.items():
+            metrics = pd.Series(function(alternative, RandomStreams(streams.seed)), dtype = float)
+            if antithetic:
+                pair = pd.Series(function(alternative, streams.antitheticPair()), dtype = float)
+                metrics = (metrics + pair) / 2
+            rows.append(dict({'replication': i, 'alternative': name}, **metrics.to_dict()))
+
+    runs = pd.DataFrame(rows).set_index(['replication', 'alternative'])
+
+    names = list(alternatives)
+    baseline = runs.xs(names[0], level = 'alternative')
+    summary = []
+    for name in names[1:]:
+        differences = runs.xs(name, level = 'alternative') - baseline
+        for metric in runs.columns:
+            values = differences[metric].dropna()
+            n = len(values)
+            std = values.std() if n > 1 else np.nan
+            half_width = t.ppf((1 + confidence) / 2, n - 1) * std / np.sqrt(n) if n > 1 else np.nan
+            summary.append({'alternative': name, 'metric': metric, 'difference': values.mean(),
+                            'std': std, 'half_width': half_width, 'replications': n})
+
+    return runs, pd.DataFrame(summary).set_index(['alternative', 'metric'])
@@ -40,7 +40,8 @@ class Building(object):
     """
     def __init__(self, owner = None, occupancy = None, tenure = None, address = None, longitude = None,
                     latitude = None, value = None, cost = None, area = None,
-                    listed = False, damage_state = None, building_stock = None):
+                    listed = False, damage_state = None, building_stock = None,
+                    check = True, random_streams = None):
         """
 
         Keyword Arguments:
@@ -55,6 +56,10 @@ class Building(object):
         listed -- Whether building is for rent or sale.
         damage_state -- Building's damage state (e.g., HAZUS damage states)
         building_stock -- The the building's associated building stock FilterStore
+        check -- Whether to parse listed (e.g., from 'True'). False if the inputs
+                were checked by io.validateEntities().
+        random_streams -- Optional streams.RandomStreams() for the recovery
+                limit state draw (default: the global random number generator)
         
         Modified Attributes:
         self.damage_value -- Calculated using setStructuralDamageValueHAZUS()
@@ -68,9 +73,12 @@ class Building(object):
         self.occupancy = occupancy  # Occupancy type of building
         self.tenure = tenure # Whether owner occupied, rental, shelter, hotel, condo, etc.
         self.area = area  # Floor area of building
-        try:
-            self.listed = distutils.util.strtobool(listed)
-        except:
+        if check:
+            try:
+                self.listed = distutils.util.strtobool(listed)
+            except:
+                self.listed = listed
+        else:
             self.listed = listed
         self.address = address # Address of building
         self.latitude = latitude
@@ -87,7 +95,7 @@ class Building(object):
         self.damage_value_start = self.damage_value # Archive original damage value
         
         # Set Burton et al. recovery-based limit state
-        setRecoveryLimitState(self)
+        setRecoveryLimitState(self, random_streams)
         self.recovery_limit_state_start = self.recovery_limit_state # Archive original damage value
 
 class SingleFamilyResidential(Building):
@@ -99,7 +107,7 @@ class SingleFamilyResidential(Building):
     def __init__(self, owner = None, occupancy = None, tenure = None, address = None, longitude = None,
                     latitude = None, value = None, cost = None, area = None,
                     bedrooms = None, bathrooms = None, listed = False, damage_state = None,
-                    building_stock = None):
+                    building_stock = None, check = True, random_streams = None):
         """
         Keyword Arguments:
         owner -- entities.Owner or subclass that represents building owner.
@@ -115,6 +123,10 @@ class SingleFamilyResidential(Building):
         listed -- Whether building is for rent or sale.
         damage_state -- Building's damage state (e.g., HAZUS damage states)
         building_stock -- The the building's associated building stock FilterStore
+        check -- Whether to check the occupancy type. False if the inputs were
+                checked by io.validateEntities().
+        random_streams -- Optional streams.RandomStreams() for the recovery
+                limit state draw
         
         Modified Attributes:
         self.damage_value -- Calculated using setStructuralDamageValueHAZUS()
@@ -125,14 +137,14 @@ class SingleFamilyResidential(Building):
 
         Building.__init__(self, owner, occupancy, tenure, address, longitude,
                         latitude, value, cost, area,
-                        listed, damage_state, building_stock) 
+                        listed, damage_state, building_stock, check, random_streams) 
 
         self.bedrooms = bedrooms  # Number of bedrooms in building
         self.bathrooms = bathrooms # Number of bedrooms in building
 
         # Verify that building dataframe has expected occupancy types
         # Raise warning, if not (but continue with simulation)
-        if not occupancy.lower() in ('single family dwelling', 'mobile home'):
+        if check and not occupancy.lower() in ('single family dwelling', 'mobile home'):
             warnings.showwarning('Warning: SingleFamilyResidential not compatible with given occupancy type: {0}'.format(
                     occupancy.title()), DeprecationWarning, filename = sys.stderr,
                                     lineno=661)
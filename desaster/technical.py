@@ -30,6 +30,9 @@ from desaster.hazus import building_repair_times
 import random
 from simpy import Interrupt
 from simpy import Resource, Container
+from desaster.service import BatchedService
+from desaster import streams
+from desaster.checkpoint import ProgramTask
 
 class TechnicalRecoveryProgram(object):
     """The base class for operationalizing technical recovery programs.
@@ -40,27 +43,55 @@ class TechnicalRecoveryProgram(object):
     useless and should only be used as an example of how to implement a process in a
     subclass of TechnicalRecoveryProgram.
 
+    The subclasses' process() methods run step(), the program's logic for one
+    request, in a checkpoint.ProgramTask; pipeline.PipelineEngine runs the same
+    step() inline. Subclasses set milestone and override update() and
+    writeDone() (and, if needed, prepare() and supply()).
+
     Methods:
-    __init__(self, env, duration, staff=float('inf'))
+    __init__(self, env, duration, staff=float('inf'), service_window=None)
     process(self, entity = None)
+    step(self, task, structure, entity, event)
+    prepare(self, task, structure, entity)
+    supply(self, task, structure)
+    update(self, structure)
     writeCompleted(self):
+    writeDone(self, entity, structure)
+    writeGaveUp(self, entity, now)
     """
-    def __init__(self, env, duration, staff=float('inf')):
+    # Name of the entity attributes that record the request (e.g., 'inspection'
+    # for inspection_put and inspection_get)
+    milestone = None
+
+    def __init__(self, env, duration, staff=float('inf'), service_window=None):
         """Initiate a TechnicalRecoveryProgram object.
 
         Keyword Arguments:
         env -- simpy.Envionment() object
         duration -- distributions.ProbabilityDistribution() object
         staff -- Integer, indicating number of staff assigned to the programs
+        service_window -- If not None, requests are served in batches, once per
+                            window (e.g., 1.0 for daily); see service.BatchedService()
 
         Attribute Changes:
         self.staff -- A simpy.Resource() object with a capacity == staff arg
         self.duration -- A function that is used to calculate random durations
                             for the program process
+        self.service -- A service.BatchedService() object if service_window is
+                            not None, else None
+        self.stream -- Name of the program's random number streams (see
+                            streams.streamName())
         """
         self.env = env
         self.staff = Resource(self.env, capacity=staff)
         self.duration = duration
+        self.stream = streams.streamName(env, self.__class__.__name__)
+        self.service_window = service_window
+
+        if service_window is not None:
+            self.service = BatchedService(self.env, self, 'staff', service_window)
+        else:
+            self.service = None
         # self.duration = duration.duration()
 
     def process(self, structure):
@@ -108,6 +139,143 @@ class TechnicalRecoveryProgram(object):
 
         self.writeCompleted()
         
+    def step(self, task, structure, entity, event):
+        """Advance an entity's request for the program's work on a structure.
+        The request's state is held by task (a checkpoint.ProgramTask, e.g., a
+        pipeline.PipelineTask).
+
+        Keyword Arguments:
+        task -- The checkpoint.ProgramTask running the request
+        structure -- Some structures.py object, such as structures.SingleFamilyResidential()
+        entity -- An entity (e.g., entities.OwnerHousehold()) that initiates
+                    and benefits from the process.
+        event -- The processed event the request was waiting on
+
+        Returns:
+        The next event to wait on, or None when the request is finished.
+        """
+        env = self.env
+        sub = task.sub
+
+        # Handle an interrupt from another process: withdraw the request.
+        if event is not None and not event.ok:
+            task.withdraw()
+            self.writeGaveUp(entity, event.value.cause)
+            return None
+
+        if sub == 0:
+            # Record time that the request is put in.
+            setattr(entity, self.milestone + '_put', env.now)
+
+            # Wait for anything needed before the request (e.g., recovery funds).
+            task.sub = 1
+            prepared = self.prepare(task, structure, entity)
+            if prepared is not None:
+                return prepared
+            sub = 1
+
+        if sub == 1:
+            task.get = None
+            task.container = None
+
+            if self.service is not None:
+                # Wait for the request to be served in a batch with others.
+                task.request = self.service.request(streams.sample(env, self.duration, entity, self.stream))
+                task.resource = self.service
+                task.sub = 6
+                return task.request
+
+            # Request staff.
+            task.request = self.staff.request()
+            task.resource = self.staff
+            task.sub = 2
+            return task.request
+
+        if sub == 6:
+            # Case assigned to staff; wait for its completion.
+            task.request = None
+            task.resource = None
+            task.sub = 7
+            return event.value
+
+        if sub == 2 or sub == 7:
+            # Get the entity's building/structure so that the building stock's
+            # FilterStore is informed of attribute changes to the building/structure.
+            # Also means that only one process at a time can access the building.
+            task.get = structure.stock.get(_SameStructure(structure))
+            task.store = structure.stock
+            task.sub = sub + 1
+            return task.get
+
+        if sub == 3 or sub == 8:
+            task.item = event.value
+            task.get = None
+
+        if sub == 3:
+            # Wait for anything else needed (e.g., construction materials).
+            task.sub = 4
+            supplied = self.supply(task, structure)
+            if supplied is not None:
+                return supplied
+            sub = 4
+
+        if sub == 4:
+            task.get = None
+            task.container = None
+
+            # Yield timeout equivalent to program's process duration.
+            task.sub = 5
+            return env.timeout(streams.sample(env, self.duration, entity, self.stream))
+
+        if sub == 5:
+            # Release staff after process duration is complete.
+            self.staff.release(task.request)
+            task.request = None
+            task.resource = None
+            sub = 8
+
+        if sub == 8:
+            self.update(structure)
+
+            # Put the structure back in the building stock to register attribute change.
+            task.sub = 9
+            put = structure.stock.put(task.item)
+            task.item = None
+            task.store = None
+            return put
+
+        # Record time that the request is fulfilled.
+        setattr(entity, self.milestone + '_get', env.now)
+
+        self.writeDone(entity, structure)
+
+        return None
+
+    def prepare(self, task, structure, entity):
+        """Return an event to wait for before the request is put in (e.g., a
+        withdrawal of recovery funds), or None. Gets must be recorded in
+        task.get and task.container so an interrupted request can be withdrawn.
+        """
+        return None
+
+    def supply(self, task, structure):
+        """Return an event to wait for once staff and the structure are available
+        (e.g., construction materials), or None.
+        """
+        return None
+
+    def update(self, structure):
+        """Update the structure's attributes when the program's work is done."""
+        pass
+
+    def writeDone(self, entity, structure):
+        """Write the outcome of a completed request to the entity's story."""
+        pass
+
+    def writeGaveUp(self, entity, now):
+        """Write an interrupted request to the entity's story."""
+        pass
+
     def writeCompleted(self):
         if entity.write_story and entity != None:
             entity.story.append("{0} process completed for {1} after {2} days, leaving ${3:,.0f} of materials. ".format(
@@ -123,22 +291,28 @@ class InspectionProgram(TechnicalRecoveryProgram):
     based on inputted damage_state and HAZUS lookup tables.
 
     Methods:
-    __init__(self, env, duration, staff=float('inf'))
+    __init__(self, env, duration, staff=float('inf'), service_window=None)
     process(self, structure, entity, callbacks = None)
+    update(self, structure)
+    writeDone(self, entity, structure)
     writeInspected(self, entity, structure):
     """
-    def __init__(self, env, duration, staff=float('inf')):
+    milestone = 'inspection'
+
+    def __init__(self, env, duration, staff=float('inf'), service_window=None):
         """Initiate an InspectionProgram object.
 
         Keyword Arguments:
         env -- simpy.Envionment() object
         duration -- io.ProbabilityDistribution() object
         staff -- Integer, indicating number of staff assigned to the program
+        service_window -- If not None, requests are served in batches, once per
+                            window (e.g., 1.0 for daily); see service.BatchedService()
 
         Inheritance:
         technical.TechnicalRecoveryProgram()
         """
-        TechnicalRecoveryProgram.__init__(self, env, duration, staff)
+        TechnicalRecoveryProgram.__init__(self, env, duration, staff, service_window)
 
     def process(self, structure, entity, callbacks = None):
         """Process to allocate staff and simulate duration associated
@@ -157,40 +331,20 @@ class InspectionProgram(TechnicalRecoveryProgram):
         entity.inspection_get -- Time structure was inspected
         structure.inspected = True, if successfully inspected
         """
-        
-        # Put in request for an inspector (shared resource)
-        entity.inspection_put = self.env.now
+        yield from ProgramTask(self.env, self.step, structure, entity).join()
 
-        # Request inspectors
-        staff_request = self.staff.request()
-        yield staff_request
-        
-        # Get the entity's building/structure so that the building stock's 
-        # FilterStore is informed of attribute changes to the building/structure
-        # Also means that only one process at a time can access the building
-        get_structure = yield structure.stock.get(lambda getStructure:
-                                                    getStructure.__dict__ == structure.__dict__
-                                            )
-        
-        # Yield timeout equivalent to time from hazard event to end of inspection.
-        yield self.env.timeout(self.duration.rvs())
+        if callbacks is not None:
+            yield from callbacks
+        else:
+            pass
 
+    def update(self, structure):
         # Set attribute of structure to indicate its been inspected.
         structure.inspected = True
 
-        # Release inspectors now that inspection is complete.
-        self.staff.release(staff_request)
-        
-        # Put the property back in the building stock to register attribute change.
-        yield structure.stock.put(get_structure)
-
-        # Only record inspection time and write story if structure associated with
-        # an entity.
-        if entity != None:
-            entity.inspection_get = self.env.now
-
+    def writeDone(self, entity, structure):
         self.writeInspected(entity, structure)
-        
+
     def writeInspected(self, entity, structure):
         if entity.write_story:
             entity.story.append(
@@ -219,22 +373,28 @@ class EngineeringAssessment(TechnicalRecoveryProgram):
     based on inputted damage_state and HAZUS lookup tables.
 
     Methods:
-    __init__(self, env, duration, staff=float('inf'))
+    __init__(self, env, duration, staff=float('inf'), service_window=None)
     process(self, structure, entity, callbacks = None)
+    update(self, structure)
+    writeDone(self, entity, structure)
     writeAssessed(self, entity):
     """
-    def __init__(self, env, duration, staff=float('inf'), ):
+    milestone = 'assessment'
+
+    def __init__(self, env, duration, staff=float('inf'), service_window=None):
         """Initiate EngineeringAssessment object.
 
         Keyword Arguments:
         env -- simpy.Envionment() object
         duration -- io.ProbabilityDistribution() object
         staff -- Integer, indicating number of staff assigned to the program
+        service_window -- If not None, requests are served in batches, once per
+                            window (e.g., 1.0 for daily); see service.BatchedService()
 
         Inheritance:
         technical.TechnicalRecoveryProgram()
         """
-        TechnicalRecoveryProgram.__init__(self, env, duration, staff)
+        TechnicalRecoveryProgram.__init__(self, env, duration, staff, service_window)
 
     def process(self, structure, entity, callbacks = None):
         """Define process for entity to request an engineering assessment of their
@@ -253,39 +413,20 @@ class EngineeringAssessment(TechnicalRecoveryProgram):
         entity.assessment_put -- Record when assessment request submitted
         entity.assessment_put -- Record when assessment request fulfilled
         """
-        # Record time that assessment request put in.
-        entity.assessment_put = self.env.now
+        yield from ProgramTask(self.env, self.step, structure, entity).join()
 
-        # Request an engineer.
-        staff_request = self.staff.request()
-        yield staff_request
-        
-        # Get the entity's building/structure to register attribute changes w/ FilterStore
-        get_structure = yield structure.stock.get(lambda getStructure:
-                                                    getStructure.__dict__ == structure.__dict__
-                                            )
-
-        # Yield process timeout for duration necessary to assess entity's structure.
-        yield self.env.timeout(self.duration.rvs())
-
-        # Release engineer so it can assess other structures.
-        self.staff.release(staff_request)
+        if callbacks is not None:
+            yield from callbacks
+        else:
+            pass
 
+    def update(self, structure):
+        # Set attribute of structure to indicate its been assessed.
         structure.assessment = True
-        
-        # Put the property back in the building stock to register attribute change.
-        yield structure.stock.put(get_structure)
-
-        # Record time when assessment complete.
-        entity.assessment_get = self.env.now
 
+    def writeDone(self, entity, structure):
         self.writeAssessed(entity)
 
-        if callbacks is not None:
-            yield env.process(callbacks)
-        else:
-            pass
-
     def writeAssessed(self, entity):
         if entity.write_story:
             entity.story.append(
@@ -299,22 +440,28 @@ class PermitProgram(TechnicalRecoveryProgram):
     repairs or construction.
 
     Methods:
-    __init__(self, env, duration, staff=float('inf'))
+    __init__(self, env, duration, staff=float('inf'), service_window=None)
     process(self, structure, entity, callbacks = None)
+    update(self, structure)
+    writeDone(self, entity, structure)
     writePermitted(self, entity):
     """
-    def __init__(self, env, duration, staff=float('inf'), ):
+    milestone = 'permit'
+
+    def __init__(self, env, duration, staff=float('inf'), service_window=None):
         """Initiate PermitProgram object.
 
         Keyword Arguments:
         env -- simpy.Envionment() object
         duration -- io.ProbabilityDistribution() object
         staff -- Integer, indicating number of staff assigned to the program
+        service_window -- If not None, requests are served in batches, once per
+                            window (e.g., 1.0 for daily); see service.BatchedService()
 
         Inheritance:
         technical.TechnicalRecoveryProgram()
         """
-        TechnicalRecoveryProgram.__init__(self, env, duration, staff)
+        TechnicalRecoveryProgram.__init__(self, env, duration, staff, service_window)
 
     def process(self, structure, entity, callbacks = None):
         """Define process for entity to request a building permit for their
@@ -333,39 +480,20 @@ class PermitProgram(TechnicalRecoveryProgram):
         entity.permit_get -- Records sim time of permit reciept
         structure.permit = True, if successfully permitted
         """
-        # Record time permit application submitted.
-        entity.permit_put = self.env.now
+        yield from ProgramTask(self.env, self.step, structure, entity).join()
 
-        # Request permit processor / building official.
-        staff_request = self.staff.request()
-        yield staff_request
-        
-        # Get the entity's building/structure to register attribute changes w/ FilterStore
-        get_structure = yield structure.stock.get(lambda getStructure:
-                                                    getStructure.__dict__ == structure.__dict__
-                                            )
-
-        # Yield process timeout equal to duration required to review permit request.
-        yield self.env.timeout(self.duration.rvs())
-
-        # Release permit process to allow them to review other requests.
-        self.staff.release(staff_request)
+        if callbacks is not None:
+            yield from callbacks
+        else:
+            pass
 
+    def update(self, structure):
+        # Set attribute of structure to indicate its been permitted.
         structure.permit = True
-        
-        # Put the property back in the building stock to register attribute change.
-        yield structure.stock.put(get_structure)
-
-        # Record time that permit is granted.
-        entity.permit_get = self.env.now
 
+    def writeDone(self, entity, structure):
         self.writePermitted(entity)
 
-        if callbacks is not None:
-            yield self.env.process(callbacks)
-        else:
-            pass
-
     def writePermitted(self, entity):
         if entity.write_story:
             entity.story.append(
@@ -386,9 +514,15 @@ class RepairProgram(TechnicalRecoveryProgram):
     Methods:
     __init__(self, env, duration, staff=float('inf'))
     process(self, structure, entity, callbacks = None)
+    prepare(self, task, structure, entity)
+    supply(self, task, structure)
+    update(self, structure)
+    writeDone(self, entity, structure)
     writeRepaired(self, entity, structure):
     writeGaveUp(self, entity, now):
     """
+    milestone = 'repair'
+
     def __init__(self, env, duration, staff=float('inf'), materials=float('inf')):
         """Initiate RepairProgram object.
 
@@ -424,70 +558,45 @@ class RepairProgram(TechnicalRecoveryProgram):
         structure.damage_state -- Set to 'None' if successful.
         structure.damage_value = Set to $0.0 if successful.
         """
-        # Use exception handling in case process is interrupted by another process.
-        try:
-            # % of damage value related to building materials (vs. labor and profit)
-            # **** PERHAPS PROMOTE TO A FUNCTION ARGUMENT ***
-            materials_cost_pct = 1.0
-
-            materials_cost = structure.damage_value * materials_cost_pct
-
-            # Record time put in request for home repair.
-            entity.repair_put = self.env.now
-            
-            # Withdraw recovery funds equal to the repair value (assumed to be
-            # same as damage value). If no enough available, process waits until 
-            # there is.
-            yield entity.recovery_funds.get(structure.damage_value)
-
-            # Put in request for contractors to repair home.
-            staff_request = self.staff.request()
-            yield staff_request
-            
-            # Get the entity's building/structure to register attribute changes w/ FilterStore
-            get_structure = yield structure.stock.get(lambda getStructure:
-                                                        getStructure.__dict__ == structure.__dict__
-                                                )
-
-            # Get the repair time for the entity from io.py
-            # which imports the HAZUS repair time look up table.
-            # Rebuild time is based on occupancy type and damage state.
-            # Set the program's distribution.loc (e.g., mean) to repair time
-            self.duration.loc = building_repair_times.ix[structure.occupancy][structure.damage_state]
-
-            # Obtain necessary construction materials from regional inventory.
-            # materials_cost_pct is % of damage value related to building materials
-            # (vs. labor and profit)
-            yield self.materials.get(materials_cost)
-
-            # Yield timeout equivalent to repair time.
-            yield self.env.timeout(self.duration.rvs())
-
-            # Release contractors.
-            self.staff.release(staff_request)
-
-            # After successful repair, set damage to None & $0.
-            structure.damage_state = 'None'
-            structure.damage_value = 0.0
-            
-            # Put the property back in the building stock to register attribute change.
-            yield structure.stock.put(get_structure)
-
-            # Record time when entity gets home.
-            entity.repair_get = self.env.now
-
-            self.writeRepaired(entity, structure)
-
-        # Handle any interrupt thrown by another process
-        except Interrupt as i:
-            self.writeGaveUp(entity, i.cause)
+        yield from ProgramTask(self.env, self.step, structure, entity).join()
 
         if callbacks is not None:
-            yield env.process(callbacks)
-
+            yield from callbacks
         else:
             pass
-            
+
+    def prepare(self, task, structure, entity):
+        # Withdraw recovery funds equal to the repair value (assumed to be
+        # same as damage value). If no enough available, process waits until
+        # there is.
+        task.get = entity.recovery_funds.get(structure.damage_value)
+        task.container = entity.recovery_funds
+        return task.get
+
+    def supply(self, task, structure):
+        # Get the repair time for the entity from io.py
+        # which imports the HAZUS repair time look up table.
+        # Rebuild time is based on occupancy type and damage state.
+        # Set the program's distribution.loc (e.g., mean) to repair time
+        self.duration.loc = building_repair_times.ix[structure.occupancy][structure.damage_state]
+
+        # Obtain necessary construction materials from regional inventory.
+        # materials_cost_pct is % of damage value related to building materials
+        # (vs. labor and profit)
+        # **** PERHAPS PROMOTE TO AN ATTRIBUTE ***
+        materials_cost_pct = 1.0
+        task.get = self.materials.get(structure.damage_value * materials_cost_pct)
+        task.container = self.materials
+        return task.get
+
+    def update(self, structure):
+        # After successful repair, set damage to None & $0.
+        structure.damage_state = 'None'
+        structure.damage_value = 0.0
+
+    def writeDone(self, entity, structure):
+        self.writeRepaired(entity, structure)
+
     def writeRepaired(self, entity, structure):
         if entity.write_story:
             entity.story.append(
@@ -510,8 +619,12 @@ class DemolitionProgram(TechnicalRecoveryProgram):
     Methods:
     __init__(self, env, duration, staff=float('inf'))
     process(self, structure, entity, callbacks = None)
+    update(self, structure)
+    writeDone(self, entity, structure)
     writeDemolished(self, entity, structure):
     """
+    milestone = 'demolition'
+
     def __init__(self, env, duration, staff=float('inf')):
         """Initiate RepairProgram object.
 
@@ -541,41 +654,20 @@ class DemolitionProgram(TechnicalRecoveryProgram):
         entity.demolition_get -- Record time demolition finished
         structure.damage_state -- Set to 'Complete' if successful.
         """
-        # Record time put in request for home repair.
-        entity.demolition_put = self.env.now
-
-        # Put in request for contractors to repair home.
-        staff_request = self.staff.request()
-        yield staff_request
-        
-        # Get the entity's building/structure to register attribute changes w/ FilterStore
-        get_structure = yield structure.stock.get(lambda getStructure:
-                                                    getStructure.__dict__ == structure.__dict__
-                                            )
+        yield from ProgramTask(self.env, self.step, structure, entity).join()
 
-        # Yield timeout equivalent to repair time.
-        yield self.env.timeout(self.duration.rvs())
-
-        # Release contractors.
-        self.staff.release(staff_request)
+        if callbacks is not None:
+            yield from callbacks
+        else:
+            pass
 
-        # After successful repair, set damage to Complete.
+    def update(self, structure):
+        # After successful demolition, set damage to Complete.
         structure.damage_state = 'Complete'
-        
-        # Put the property back in the building stock to register attribute change.
-        yield structure.stock.put(get_structure)
-
-        # Record time when entity gets home.
-        entity.demolition_get = self.env.now
 
+    def writeDone(self, entity, structure):
         self.writeDemolished(entity, structure)
 
-        if callbacks is not None:
-            yield env.process(callbacks)
-
-        else:
-            pass
-            
     def writeDemolished(self, entity, structure):
         # If True, write outcome of successful repair to story.
         if entity.write_story:
@@ -585,3 +677,15 @@ class DemolitionProgram(TechnicalRecoveryProgram):
                     entity.demolition_get
                 )
             )
+
+class _SameStructure(object):
+    """FilterStore filter matching a structure (picklable version of a lambda
+    filter, so requests can be checkpointed).
+    """
+    __slots__ = ('structure',)
+
+    def __init__(self, structure):
+        self.structure = structure
+
+    def __call__(self, building):
+        return building.__dict__ == self.structure.__dict__
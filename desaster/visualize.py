@@ -48,6 +48,14 @@ def dashboard(df, sim_time = 180, lat = 43.223628, lon = -90.294633,
 
 
     NUM_HOMES = df.shape[0] #the total number of entities
+
+    # Sampled entities (see sampling.importSample()) each represent 'weight' entities
+    if 'weight' in df:
+        weights = df['weight'].astype(float).reset_index(drop = True)
+        NUM_HOMES = weights.sum()
+    else:
+        weights = None
+
     NUM_CAT = len(statuses) #the total number of categories
 
     # assign colors to the sequential housing statuses.
@@ -67,7 +75,7 @@ def dashboard(df, sim_time = 180, lat = 43.223628, lon = -90.294633,
 
     for i in range(0, sim_time):
 
-        single_home_status = np.empty(shape = [2860,1], dtype = object)
+        single_home_status = np.empty(shape = [df.shape[0],1], dtype = object)
         curr_max = i
         curr = 0
         for row in df_onlyState.itertuples(index = False):
@@ -94,7 +102,10 @@ def dashboard(df, sim_time = 180, lat = 43.223628, lon = -90.294633,
 
     status_count_list = []
     for time in range(0, sim_time):
-        status_count_list.append(pd.Series(data = home_status[time].value_counts(), name = str(time)))
+        if weights is None:
+            status_count_list.append(pd.Series(data = home_status[time].value_counts(), name = str(time)))
+        else:
+            status_count_list.append(pd.Series(data = weights.groupby(home_status[time]).sum(), name = str(time)))
 
     #concatenate and fill NaN with zeroes. re-index rows to correct order
     status_count_df = pd.concat(status_count_list, axis = 1).fillna(value = 0).reindex(statuses)
@@ -308,3 +319,48 @@ def folium_map(df, lat = 43.223628, lon = -90.294633, outfile = 'folium_map.html
     map_name = outfile
     map.save(outfile)
     wb.get(chrome_path).open(outfile, new=2, autoraise = True)
+
+def ensemble_plot(aggregated, group = None, outfile = 'ensemble_curves.html'):
+    """Plot an ensemble's mean recovery curves with quantile bands and
+    confidence intervals, from aggregation.aggregateCurves().
+
+    Keyword Arguments:
+    aggregated -- Dataframe from aggregation.aggregateCurves()
+    group -- Group to plot (default: the first group)
+    outfile -- File path of the HTML output
+    """
+    if group is None:
+        group = aggregated['group'].iloc[0]
+    df = aggregated[aggregated['group'] == group]
+    statuses = list(pd.unique(df['status']))
+
+    colors_only = bokeh.palettes.d3['Category20'][max(3, len(statuses))]
+
+    output_file(outfile)
+
+    line_plot = figure(title = 'Number of Households By Status vs. Simulated Time '
+                                '({0} replications, group {1})'.format(df['replications'].iloc[0], group),
+                        plot_width = 1000, plot_height = 600, x_axis_label = 'Day',
+                        y_axis_label = 'Households', tools = 'pan, wheel_zoom, reset, save')
+
+    for status, color in zip(statuses, colors_only):
+        status_df = df[df['status'] == status]
+        days = status_df['day'].tolist()
+
+        # Quantile band (spread of the replications) and confidence interval of the mean
+        line_plot.patch(days + days[::-1], status_df['upper'].tolist() + status_df['lower'].tolist()[::-1],
+                        color = color, alpha = 0.15, line_width = 0, legend = str(status))
+        line_plot.patch(days + days[::-1], status_df['ci_upper'].tolist() + status_df['ci_lower'].tolist()[::-1],
+                        color = color, alpha = 0.35, line_width = 0, legend = str(status))
+
+        source = ColumnDataSource(status_df)
+        line_plot.line(x = 'day', y = 'mean', source = source, color = color, alpha = 0.8,
+                        legend = str(status), line_width = 2)
+
+    hover = HoverTool(tooltips = [('status', '@status'), ('day', '@day'), ('mean', '@mean'),
+                                    ('band', '@lower to @upper'), ('CI', '@ci_lower to @ci_upper')])
+    line_plot.add_tools(hover)
+    line_plot.legend.location = "top_left"
+    line_plot.legend.click_policy = "hide"
+
+    show(line_plot)